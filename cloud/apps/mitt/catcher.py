@@ -2,22 +2,27 @@
 from __future__ import annotations
 
 import asyncio
-import bz2
+import time
 from typing import Any, Awaitable, Callable
 
 from bson import BSON, InvalidBSON
 
+from ..util import timeseries
+from ..util.batch import decode_batch, is_columnar, iter_records
+from ..util.compression import decompress
 from ..util.config import get_redis_conn, get_topic, load_config
 from ..util.daemon import Daemon
 from ..util.faults import assess_metrics
 from ..util.logger import make_logger, setup_logging
 from ..util.managers.nats_manager import nats_manager
 from ..util.redis.access import GraphManager
+from ..util.tracing import TRACE_KEY, LatencyHistograms, publish_time, stage_latencies
 
 setup_logging()
 logger = make_logger("Cloud")
 config = load_config()
 DATA_TOPIC = get_topic("publish")
+PRIORITY_TOPIC = get_topic("priority")
 nats_manager.set_server(config["nats"]["server"])
 
 try:
@@ -67,17 +72,24 @@ class Cloud:
     def __init__(self, redis_conn: Any) -> None:
         self.redis_conn = redis_conn
         self.subscription = None
+        self.priority_subscription = None
         self.message_count = 0
+        self.latency = LatencyHistograms()
 
     async def start(self) -> None:
         await nats_manager.connect()
         self.subscription = await nats_manager.nats.subscribe(DATA_TOPIC, cb=self.process_message)
         logger.info("[Cloud] Subscribed to NATS topic %s", DATA_TOPIC)
+        if PRIORITY_TOPIC:
+            self.priority_subscription = await nats_manager.nats.subscribe(PRIORITY_TOPIC, cb=self.process_message)
+            logger.info("[Cloud] Subscribed to priority NATS topic %s", PRIORITY_TOPIC)
 
     async def stop(self) -> None:
-        if self.subscription is not None:
+        for subscription in (self.subscription, self.priority_subscription):
+            if subscription is None:
+                continue
             try:
-                await self.subscription.unsubscribe()
+                await subscription.unsubscribe()
             except Exception:
                 logger.exception("[Cloud] Failed to unsubscribe")
         await nats_manager.disconnect()
@@ -85,10 +97,23 @@ class Cloud:
     async def process_message(self, msg: Any) -> None:
         self.message_count += 1
         try:
-            data = BSON(bz2.decompress(msg.data)).decode()
-        except (InvalidBSON, OSError, ValueError) as exc:
+            raw = decompress(msg.data)
+        except Exception as exc:
+            logger.error("[Cloud] Invalid compressed batch: %s", exc)
+            return
+        published_at = publish_time(getattr(msg, "headers", None))
+        if is_columnar(raw):
+            await self.process_columnar(raw, published_at)
+            return
+        if timeseries.is_timeseries(raw):
+            await self.process_columnar(raw, published_at, decode=timeseries.decode_batch)
+            return
+        try:
+            data = BSON(raw).decode()
+        except (InvalidBSON, ValueError) as exc:
             logger.error("[Cloud] Invalid compressed BSON: %s", exc)
             return
+        decoded_at = time.time()
         records = data.get("cache", []) if isinstance(data, dict) and isinstance(data.get("cache"), list) else [data]
         for item in records:
             if isinstance(item, bytes):
@@ -97,15 +122,37 @@ class Cloud:
                 except Exception:
                     logger.exception("[Cloud] Failed to decode cached item")
                     continue
+            await self.process_one_record(item, (published_at, decoded_at))
+
+    async def process_columnar(self, raw: bytes, published_at: float | None = None,
+                               decode: Callable[[bytes], tuple] = decode_batch) -> None:
+        try:
+            columns, extra = decode(raw)
+        except (InvalidBSON, ValueError, IndexError) as exc:
+            logger.error("[Cloud] Invalid columnar batch: %s", exc)
+            return
+        decoded_at = time.time()
+        for item in iter_records(columns):
             await self.process_one_record(item)
+        for item in extra:
+            if isinstance(item, bytes):
+                try:
+                    item = BSON(item).decode()
+                except Exception:
+                    logger.exception("[Cloud] Failed to decode cached item")
+                    continue
+            await self.process_one_record(item, (published_at, decoded_at))
 
-    async def process_one_record(self, payload: Any) -> None:
+    async def process_one_record(self, payload: Any, trace_times: tuple | None = None) -> None:
         if not isinstance(payload, dict):
             return
         mac = _normalize_mac(payload.get("macaddr") or payload.get("monitor_mac"))
         if mac is None:
             logger.warning("[Cloud] Record has no valid MAC address")
             return
+        if "rollup_interval" in payload:
+            self.store_rollup(mac, payload)
+            return
         voltage = _as_float(payload.get("Vi"))
         current = _as_float(payload.get("Ii"))
         power = _as_float(payload.get("Pi"))
@@ -124,9 +171,35 @@ class Cloud:
         }
         key = f"sitearray:monitor:{mac}"
         self.redis_conn.hset(key, mapping=values)
+        trace = payload.get(TRACE_KEY)
+        if trace is not None and trace_times is not None:
+            self.record_trace(trace, *trace_times)
         logger.info("%s V=%.2f I=%.2f P=%.2f T=%.2f G=%.1f expected=%.2f ratio=%.3f %s", mac, voltage, current, power, temperature, irradiance, assessment.expected_power, assessment.performance_ratio, status)
 
 
+    def store_rollup(self, mac: str, payload: dict) -> None:
+        """
+        Keep the latest mesh-side aggregate per interval under
+        ``sitearray:rollup:{interval}:{mac}``. Aggregates carry ``Vi_mean``
+        and the like instead of raw readings, so they never reach the live
+        monitor key or the fault assessment.
+        """
+        key = f"sitearray:rollup:{payload['rollup_interval']}:{mac}"
+        values = {field: str(value) for field, value in payload.items()
+                  if field not in ("macaddr", "monitor_mac", TRACE_KEY)}
+        self.redis_conn.hset(key, mapping=values)
+        logger.debug("%s rollup %ss at %s", mac, payload["rollup_interval"], payload.get("freezetime"))
+
+    def record_trace(self, trace: Any, published_at: float | None, decoded_at: float) -> None:
+        try:
+            self.latency.observe(stage_latencies(trace, published_at, decoded_at, time.time()))
+        except (TypeError, ValueError, IndexError):
+            logger.warning("[Cloud] Malformed trace: %r", trace)
+            return
+        if self.latency.due():
+            self.latency.save(self.redis_conn)
+
+
 class Catcher:
     def __init__(self, site: str = "TEST", db: int = 3) -> None:
         self.redis_conn = get_redis_conn(db=db)
@@ -6,6 +6,7 @@ from pydantic import BaseModel
 from .commissioning.commission_sitegraph import load_site_graph
 from .util.config import get_redis_conn, load_config
 from .util.logger import make_logger
+from .util.tracing import load_summary as load_latency_summary
 from .util.faults import (
     set_fault,
     normalize_fault_token
@@ -123,4 +124,10 @@ def api_faults_profile():
         _, up = normalize_fault_token(status)
         profile[up] = profile.get(up, 0) + 1
 
-    return {"GLOBAL": profile}
\ No newline at end of file
+    return {"GLOBAL": profile}
+
+
+@router.get("/trace/latency")
+def api_trace_latency():
+    """Per-stage latency histograms of traced records (see util/tracing.py)."""
+    return load_latency_summary(get_redis_conn(db=3))
@@ -0,0 +1,167 @@
+"""
+Columnar uplink batch format
+----------------------------
+
+Encodes a batch of telemetry records as one little-endian array per field
+instead of one BSON document per record, so field names are written once per
+batch and the receiver can decode every column with ``np.frombuffer``.
+
+Layout (all integers little-endian)::
+
+    magic    4s   b"MESH"
+    version  u8   SCHEMA_VERSION
+    flags    u8   reserved
+    extra    u16  reserved
+    count    u32  number of columnar records
+    blob_len u32  length of the trailing BSON blob (0 if none)
+    columns       count * itemsize bytes per field, in SCHEMA order
+    blob          BSON {"cache": [...]} of records that do not fit the schema
+
+The 4th magic byte is non-zero, so a columnar batch can never be mistaken
+for a BSON document (whose int32 length is capped at 16 MiB).
+
+Records carrying a latency trace (``trace`` key, see DAQ.util.tracing) also
+ride in the BSON blob so the trace reaches the receiver intact.
+"""
+
+import struct
+from datetime import datetime, timezone
+
+import numpy as np
+from bson import BSON
+
+MAGIC = b"MESH"
+SCHEMA_VERSION = 1
+HEADER = struct.Struct("<4sBBHII")
+
+RECORD_TYPE = "mon"
+TRACE_KEY = "trace"
+
+# Electrical/environmental values are sent as fixed point with 0.01
+# resolution, which is exact for DataIndication samples (int16 / 100 or / 10).
+FIXED_POINT = 100
+
+# (field, dtype) in wire order
+SCHEMA = (
+    ("macaddr", "<u8"),
+    ("freezetime", "<f8"),
+    ("localtime", "<f8"),
+    ("Vi", "<i4"),
+    ("Vo", "<i4"),
+    ("Ii", "<i4"),
+    ("Io", "<i4"),
+    ("Pi", "<i4"),
+    ("Po", "<i4"),
+    ("temperature", "<i4"),
+    ("irradiance", "<i4"),
+    ("op_stat", "<u2"),
+    ("reg_stat", "<u2"),
+)
+FIELDS = tuple(name for name, _ in SCHEMA)
+DTYPES = {name: np.dtype(dtype) for name, dtype in SCHEMA}
+SCALED = ("Vi", "Vo", "Ii", "Io", "Pi", "Po", "temperature", "irradiance")
+
+
+def is_columnar(raw) -> bool:
+    return bytes(raw[:4]) == MAGIC
+
+
+def _epoch(value) -> float:
+    if isinstance(value, datetime):
+        return value.timestamp()
+    return float(value or 0.0)
+
+
+def _mac_int(value) -> int:
+    if isinstance(value, int):
+        return value
+    return int(value, 16)
+
+
+def _fits_schema(record) -> bool:
+    if not isinstance(record, dict) or record.get("type") != RECORD_TYPE or TRACE_KEY in record:
+        return False
+    if "rollup_interval" in record:
+        # Aggregates carry per-field statistics instead of the raw columns
+        return False
+    try:
+        _mac_int(record.get("macaddr"))
+    except (TypeError, ValueError):
+        return False
+    return True
+
+
+def columns_from_records(records):
+    """Build column arrays from ``mon`` record dicts."""
+    count = len(records)
+    columns = {
+        "macaddr": np.fromiter((_mac_int(r["macaddr"]) for r in records), DTYPES["macaddr"], count),
+        "freezetime": np.fromiter((_epoch(r.get("freezetime")) for r in records), DTYPES["freezetime"], count),
+        "localtime": np.fromiter((_epoch(r.get("localtime")) for r in records), DTYPES["localtime"], count),
+    }
+    for name in SCALED:
+        values = np.fromiter((r.get(name) or 0.0 for r in records), np.float64, count)
+        columns[name] = np.rint(values * FIXED_POINT).astype(DTYPES[name])
+    for name in ("op_stat", "reg_stat"):
+        columns[name] = np.fromiter((r.get(name) or 0 for r in records), DTYPES[name], count)
+    return columns
+
+
+def encode_batch(records) -> bytes:
+    """
+    Encode records into a columnar batch. Records that are not ``mon`` dicts
+    (e.g. collector device readings or pre-encoded BSON) ride along in the
+    trailing BSON blob.
+    """
+    rows, extra = [], []
+    for record in records:
+        (rows if _fits_schema(record) else extra).append(record)
+
+    blob = BSON.encode({"cache": extra}) if extra else b""
+    parts = [HEADER.pack(MAGIC, SCHEMA_VERSION, 0, 0, len(rows), len(blob))]
+    if rows:
+        columns = columns_from_records(rows)
+        parts.extend(columns[name].tobytes() for name in FIELDS)
+    parts.append(blob)
+    return b"".join(parts)
+
+
+def decode_batch(raw):
+    """
+    Decode a columnar batch.
+
+    :return: ``(columns, extra)`` where ``columns`` maps field name to a
+        NumPy array (fixed-point fields already scaled back to float) and
+        ``extra`` is the list of records carried in the BSON blob.
+    """
+    magic, version, _flags, _reserved, count, blob_len = HEADER.unpack_from(raw)
+    if magic != MAGIC:
+        raise ValueError("Not a columnar batch")
+    if version != SCHEMA_VERSION:
+        raise ValueError(f"Unsupported columnar batch version {version}")
+
+    offset = HEADER.size
+    columns = {}
+    for name in FIELDS:
+        dtype = DTYPES[name]
+        columns[name] = np.frombuffer(raw, dtype=dtype, count=count, offset=offset)
+        offset += dtype.itemsize * count
+    for name in SCALED:
+        columns[name] = columns[name] / FIXED_POINT
+
+    extra = []
+    if blob_len:
+        extra = BSON(bytes(raw[offset:offset + blob_len])).decode().get("cache", [])
+    return columns, extra
+
+
+def iter_records(columns):
+    """Yield per-record dicts from decoded columns (macaddr as 16 hex digits)."""
+    values = [columns[name].tolist() for name in FIELDS]
+    for row in zip(*values):
+        record = dict(zip(FIELDS, row))
+        record["type"] = RECORD_TYPE
+        record["macaddr"] = f"{record['macaddr']:016X}"
+        record["freezetime"] = datetime.fromtimestamp(record["freezetime"], timezone.utc)
+        record["localtime"] = datetime.fromtimestamp(record["localtime"], timezone.utc)
+        yield record
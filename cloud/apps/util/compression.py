@@ -0,0 +1,116 @@
+"""
+Compression codec registry for uplink batches
+---------------------------------------------
+
+Every compressed batch is wrapped in a 3-byte envelope so the receiver can
+pick the matching decompressor without configuration::
+
+    magic  2s  b"MZ"
+    codec  u8  codec id (see CODEC_IDS)
+
+Bare bz2 streams (``BZh`` prefix) from older senders are still accepted.
+
+Codec names select algorithm and level, e.g. ``bz2``, ``zlib-1``, ``zlib-6``,
+``zlib-9``, ``lzma``, ``zstd-3``, ``lz4``. zstd and lz4 are registered only
+when the ``zstandard`` / ``lz4`` packages are installed.
+"""
+
+import bz2
+import lzma
+import struct
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame as lz4frame
+except ImportError:
+    lz4frame = None
+
+MAGIC = b"MZ"
+ENVELOPE = struct.Struct("<2sB")
+LEGACY_BZ2 = b"BZh"
+
+# Algorithm ids on the wire; levels do not affect decompression
+CODEC_IDS = {
+    "none": 0,
+    "bz2": 1,
+    "zlib": 2,
+    "lzma": 3,
+    "zstd": 4,
+    "lz4": 5,
+}
+
+DEFAULT_CODEC = "bz2"
+
+
+class Codec:
+    """A named compress/decompress pair bound to a wire codec id."""
+
+    def __init__(self, name, codec_id, compress, decompress):
+        self.name = name
+        self.codec_id = codec_id
+        self.compress = compress
+        self.decompress = decompress
+
+    def __repr__(self):
+        return f"<Codec {self.name} id={self.codec_id}>"
+
+
+CODECS = {}            # name -> Codec
+DECOMPRESSORS = {}     # codec id -> decompress callable
+
+
+def register(name, algorithm, compress, decompress):
+    codec = Codec(name, CODEC_IDS[algorithm], compress, decompress)
+    CODECS[name] = codec
+    DECOMPRESSORS.setdefault(codec.codec_id, decompress)
+    return codec
+
+
+register("none", "none", bytes, bytes)
+register("bz2", "bz2", bz2.compress, bz2.decompress)
+for _level in (1, 6, 9):
+    register(f"zlib-{_level}", "zlib", lambda data, level=_level: zlib.compress(data, level), zlib.decompress)
+register("lzma", "lzma", lzma.compress, lzma.decompress)
+
+if zstandard is not None:
+    for _level in (1, 3, 9, 19):
+        register(
+            f"zstd-{_level}", "zstd",
+            lambda data, level=_level: zstandard.ZstdCompressor(level=level).compress(data),
+            lambda data: zstandard.ZstdDecompressor().decompress(data),
+        )
+
+if lz4frame is not None:
+    register("lz4", "lz4", lz4frame.compress, lz4frame.decompress)
+
+
+def get_codec(name=None):
+    """Look up a codec by name; bare algorithm names pick a default level."""
+    name = name or DEFAULT_CODEC
+    codec = CODECS.get(name) or CODECS.get({"zlib": "zlib-6", "zstd": "zstd-3"}.get(name, ""))
+    if codec is None:
+        raise ValueError(f"Unknown or unavailable compression codec {name!r}; available: {sorted(CODECS)}")
+    return codec
+
+
+def compress(data, codec):
+    """Compress ``data`` with ``codec`` and prefix the codec envelope."""
+    return ENVELOPE.pack(MAGIC, codec.codec_id) + codec.compress(data)
+
+
+def decompress(blob):
+    """Decompress an enveloped batch (or a legacy bare bz2 stream)."""
+    if blob[:2] == MAGIC:
+        _, codec_id = ENVELOPE.unpack_from(blob)
+        decompressor = DECOMPRESSORS.get(codec_id)
+        if decompressor is None:
+            raise ValueError(f"Unsupported compression codec id {codec_id}")
+        return decompressor(blob[ENVELOPE.size:])
+    if blob[:3] == LEGACY_BZ2:
+        return bz2.decompress(blob)
+    raise ValueError("Unrecognized compressed batch header")
@@ -1,5 +1,4 @@
 import asyncio
-import bz2
 from bson import BSON
 import multiprocessing
 import os
@@ -9,6 +8,7 @@ import time
 import uuid
 from multiprocessing import util
 from multiprocessing.managers import SyncManager
+from apps.util import compression
 from apps.util.hex import _h
 from apps.util.logger import make_logger
 from apps.util.utctime import utcepochnow
@@ -283,6 +283,7 @@ class BSONHandler(IHandler):
 class CompressionHandler(IHandler):
     def compile(self, data_queue, processed_queue):
         cache = {'cache': [], 'last_processed': time.time()}
+        codec = compression.get_codec(self.get('codec'))
         self.state['num_records'] = 0
 
         while self._check_living():
@@ -298,7 +299,7 @@ class CompressionHandler(IHandler):
             ):
                 self.logger.info(f"[COMPRESS] Compressing {len(cache['cache'])} records")
                 self.state['num_records'] = max(self.state['num_records'], len(cache['cache']))
-                processed_queue.put(bz2.compress(BSON.encode(cache)))
+                processed_queue.put(compression.compress(BSON.encode(cache), codec))
                 cache = {'cache': [], 'last_processed': time.time()}
 
             self.loop(data_queue, processed_queue)
@@ -307,7 +308,7 @@ class CompressionHandler(IHandler):
         while self._check_living():
             try:
                 meta, rdata = data_queue.get(timeout=5)
-                cache = BSON(bz2.decompress(rdata)).decode()
+                cache = BSON(compression.decompress(rdata)).decode()
 
                 for item in cache.get('cache', []):
                     processed_queue.put((meta, item))
@@ -0,0 +1,318 @@
+"""
+Time-series uplink batch format
+-------------------------------
+
+Encodes the ``mon`` records of a batch in the style of Facebook's Gorilla:
+records are grouped into one series per MAC, each timestamp column is
+delta-of-delta coded and each measurement column is XOR coded against the
+previous value of the same (MAC, field) series. Regular sample times and
+unchanged values cost a couple of bits, so the format pays off when a
+batch holds many samples per device.
+
+Unlike Gorilla the control codes are not interleaved with the payload:
+every field is written as three bitstreams (fixed-width codes, fixed-width
+XOR windows, variable-width payload), so both ends are vectorized and the
+receiver decodes each column straight into a NumPy array.
+
+Layout (integers little-endian, bitstreams MSB first)::
+
+    magic    4s   b"MTSB"
+    version  u8   SCHEMA_VERSION
+    flags    u8   reserved
+    extra    u16  reserved
+    series   u32  number of series
+    count    u32  number of records in all series
+    blob_len u32  length of the trailing BSON blob (0 if none)
+    macaddr       series * u64
+    points        series * u32, records per series
+    fields        for each of TIME_FIELDS + VALUE_FIELDS (if count > 0):
+        lengths   3 * u32, byte lengths of the three streams
+        codes     count * TIME_CODE_BITS or VALUE_CODE_BITS
+        windows   WINDOW_BITS per NEW code (value fields only)
+        payload   variable-width payload of every record
+    blob          BSON {"cache": [...]} of records that do not fit the schema
+
+Timestamps are integer microseconds. The code of each sample selects the
+payload width: the first sample of a series is stored raw, later ones as
+the change in delta from the previous sample (two's complement)::
+
+    0  delta unchanged        3  |dod| < 2**11, 12 bits
+    1  |dod| < 2**6, 7 bits   4  |dod| < 2**31, 32 bits
+    2  |dod| < 2**8, 9 bits   5  anything else, 64 bits
+                              6  first sample, 64 bits
+
+Values use the columnar format's 0.01 fixed point, held as float64 so
+their low mantissa bits are zero, and are XORed with the previous value::
+
+    0  SAME    unchanged, no payload
+    1  RAW     first sample of a series, 64 bits
+    2  REUSE   meaningful bits inside the last window
+    3  NEW     new window (5 bits leading zeros, 6 bits length) in the
+               windows stream, then its meaningful bits
+
+Records come back grouped by MAC, in arrival order within each MAC.
+Records outside the ``mon`` schema and traced records ride in the BSON
+blob exactly as in the columnar format.
+"""
+
+import struct
+
+import numpy as np
+from bson import BSON
+
+from .batch import DTYPES, FIXED_POINT, SCALED, _fits_schema, columns_from_records
+
+MAGIC = b"MTSB"
+SCHEMA_VERSION = 1
+HEADER = struct.Struct("<4sBBHIII")
+LENGTHS = struct.Struct("<III")
+
+TIME_FIELDS = ("freezetime", "localtime")
+VALUE_FIELDS = SCALED + ("op_stat", "reg_stat")
+FIELDS = ("macaddr",) + TIME_FIELDS + VALUE_FIELDS
+
+MICROS = 1_000_000
+
+TIME_CODE_BITS = 3
+TIME_RAW = 6
+# Payload width per time code, and the |dod| limits of codes 1..4
+TIME_WIDTHS = np.array([0, 7, 9, 12, 32, 64, 64])
+TIME_LIMITS = np.array([1, 2 ** 6, 2 ** 8, 2 ** 11, 2 ** 31])
+
+VALUE_CODE_BITS = 2
+WINDOW_BITS = 11
+SAME, RAW, REUSE, NEW = range(4)
+
+
+def is_timeseries(raw) -> bool:
+    return bytes(raw[:4]) == MAGIC
+
+
+# ---------------------
+# Bit packing
+# ---------------------
+
+def _bit_length(values):
+    """Bit length of each uint64 (0 for 0); exact because each half fits a double."""
+    high = (values >> np.uint64(32)).astype(np.float64)
+    low = (values & np.uint64(0xFFFFFFFF)).astype(np.float64)
+    return np.where(high > 0, 32 + np.frexp(high)[1], np.frexp(low)[1]).astype(np.int64)
+
+
+def _pack_bits(widths, values):
+    """Concatenate the low ``widths[i]`` bits of each ``values[i]``, MSB first."""
+    bits = np.unpackbits(values.astype(">u8").view(np.uint8).reshape(-1, 8), axis=1)
+    keep = np.arange(64) >= (64 - np.asarray(widths))[:, None]
+    return np.packbits(bits[keep]).tobytes()
+
+
+def _unpack_fixed(stream, width, count):
+    """Inverse of :func:`_pack_bits` for ``count`` fields of one small ``width``."""
+    bits = np.unpackbits(np.frombuffer(stream, dtype=np.uint8), count=width * count)
+    return bits.reshape(count, width).astype(np.int64) @ (1 << np.arange(width - 1, -1, -1))
+
+
+def _unpack_bits(stream, widths):
+    """Inverse of :func:`_pack_bits`: split ``stream`` into fields of ``widths`` bits."""
+    data = np.concatenate([np.frombuffer(stream, dtype=np.uint8), np.zeros(9, dtype=np.uint8)])
+    offsets = np.cumsum(widths) - widths
+    first_byte = offsets >> 3
+    skip = (offsets & 7).astype(np.uint64)
+
+    # The 64 bits starting at each offset: 8 whole bytes, shifted, plus the spill-over byte
+    top = data[first_byte[:, None] + np.arange(8)].view(">u8").ravel().astype(np.uint64)
+    top = (top << skip) | (data[first_byte + 8].astype(np.uint64) >> (np.uint64(8) - skip))
+    shift = np.minimum(64 - widths, 63).astype(np.uint64)
+    return np.where(widths > 0, top >> shift, np.uint64(0))
+
+
+def _segment_cumsum(values, starts, lengths):
+    """Cumulative sum restarting at every series start."""
+    total = np.cumsum(values)
+    return total - np.repeat((total - values)[starts], lengths)
+
+
+# ---------------------
+# Columns
+# ---------------------
+
+def encode_times(stamps, starts):
+    """Codes and payload streams of one int64 microsecond column."""
+    delta = np.diff(stamps, prepend=stamps[:1])
+    delta[starts] = 0
+    dod = np.diff(delta, prepend=delta[:1])
+    dod[starts] = 0
+
+    codes = np.searchsorted(TIME_LIMITS, np.abs(dod), side="right")
+    codes[starts] = TIME_RAW
+    widths = TIME_WIDTHS[codes]
+    payload = dod.view(np.uint64) & ((np.uint64(1) << np.minimum(widths, 63).astype(np.uint64)) - np.uint64(1))
+    payload[widths == 64] = dod.view(np.uint64)[widths == 64]
+    payload[starts] = stamps[starts].view(np.uint64)
+    return _pack_bits(np.full(len(codes), TIME_CODE_BITS), codes.astype(np.uint64)), b"", _pack_bits(widths, payload)
+
+
+def decode_times(codes_stream, payload_stream, starts, lengths):
+    codes = _unpack_fixed(codes_stream, TIME_CODE_BITS, lengths.sum())
+    widths = TIME_WIDTHS[codes]
+    payload = _unpack_bits(payload_stream, widths)
+
+    # Sign-extend the delta-of-deltas; raw timestamps and 64-bit dods are already int64
+    sign = (payload >> np.maximum(widths - 1, 0).astype(np.uint64)) & np.uint64(1)
+    dod = payload.view(np.int64)
+    short = (widths > 0) & (widths < 64)
+    dod[short] -= sign[short].astype(np.int64) << widths[short]
+    first = dod[starts]
+    dod[starts] = 0
+
+    delta = _segment_cumsum(dod, starts, lengths)
+    return _segment_cumsum(delta, starts, lengths) + np.repeat(first, lengths)
+
+
+def encode_values(bits, starts):
+    """Codes, windows and payload streams of one XOR-coded uint64 column."""
+    xor = bits ^ np.r_[bits[:1], bits[:-1]]
+    xor[starts] = 0
+    leading = np.minimum(64 - _bit_length(xor), 31)
+    trailing = _bit_length(xor & (~xor + np.uint64(1))) - 1
+
+    count = len(bits)
+    codes = np.where(xor == 0, SAME, NEW)
+    codes[starts] = RAW
+    widths = np.zeros(count, dtype=np.int64)
+    widths[starts] = 64
+    payload = np.where(codes == RAW, bits, np.uint64(0))
+
+    # Whether a value fits the stored window depends on every earlier
+    # choice, so only this part is a Python loop
+    changed = np.flatnonzero(codes == NEW)
+    series = np.searchsorted(starts, changed, side="right")
+    windows = []
+    window_leading = window_trailing = window_series = -1
+    for i, xored, lz, tz, owner in zip(changed.tolist(), xor[changed].tolist(), leading[changed].tolist(),
+                                       trailing[changed].tolist(), series.tolist()):
+        if owner == window_series and lz >= window_leading and tz >= window_trailing:
+            codes[i] = REUSE
+            widths[i] = 64 - window_leading - window_trailing
+            payload[i] = xored >> window_trailing
+        else:
+            meaningful = 64 - lz - tz
+            windows.append((lz << 6) | (meaningful & 0x3F))
+            widths[i] = meaningful
+            payload[i] = xored >> tz
+            window_leading, window_trailing, window_series = lz, tz, owner
+
+    return (
+        _pack_bits(np.full(count, VALUE_CODE_BITS), codes.astype(np.uint64)),
+        _pack_bits(np.full(len(windows), WINDOW_BITS), np.array(windows, dtype=np.uint64)),
+        _pack_bits(widths, payload),
+    )
+
+
+def decode_values(codes_stream, windows_stream, payload_stream, starts, lengths):
+    count = lengths.sum()
+    codes = _unpack_fixed(codes_stream, VALUE_CODE_BITS, count)
+    new = codes == NEW
+    windows = np.zeros(count, dtype=np.int64)
+    windows[new] = _unpack_fixed(windows_stream, WINDOW_BITS, new.sum())
+
+    # A REUSE takes the window of the latest NEW, which is in its own series
+    windows = windows[np.maximum.accumulate(np.where(new, np.arange(count), 0))]
+    meaningful = windows & 0x3F
+    meaningful[meaningful == 0] = 64
+    trailing = 64 - (windows >> 6) - meaningful
+
+    widths = np.where(codes == SAME, 0, np.where(codes == RAW, 64, meaningful))
+    xor = _unpack_bits(payload_stream, widths)
+    shifted = (codes == REUSE) | new
+    xor[shifted] <<= trailing[shifted].astype(np.uint64)
+
+    # Prefix XOR per series; the RAW value at a series start restarts the chain
+    chained = np.bitwise_xor.accumulate(xor)
+    return chained ^ np.repeat((chained ^ xor)[starts], lengths)
+
+
+# ---------------------
+# Batches
+# ---------------------
+
+def encode_batch(records) -> bytes:
+    """
+    Encode records into a time-series batch. Records that are not ``mon``
+    dicts ride along in the trailing BSON blob.
+    """
+    rows, extra = [], []
+    for record in records:
+        (rows if _fits_schema(record) else extra).append(record)
+
+    blob = BSON.encode({"cache": extra}) if extra else b""
+    if not rows:
+        return HEADER.pack(MAGIC, SCHEMA_VERSION, 0, 0, 0, 0, len(blob)) + blob
+
+    columns = columns_from_records(rows)
+    order = np.argsort(columns["macaddr"], kind="stable")
+    columns = {name: column[order] for name, column in columns.items()}
+    macs = columns["macaddr"]
+    starts = np.flatnonzero(np.r_[True, macs[1:] != macs[:-1]])
+    lengths = np.diff(np.r_[starts, len(macs)])
+
+    parts = [
+        HEADER.pack(MAGIC, SCHEMA_VERSION, 0, 0, len(starts), len(rows), len(blob)),
+        macs[starts].astype("<u8").tobytes(),
+        lengths.astype("<u4").tobytes(),
+    ]
+    streams = [encode_times(np.rint(columns[name] * MICROS).astype(np.int64), starts) for name in TIME_FIELDS]
+    streams += [encode_values(columns[name].astype(np.float64).view(np.uint64), starts) for name in VALUE_FIELDS]
+    for field_streams in streams:
+        parts.append(LENGTHS.pack(*map(len, field_streams)))
+        parts.extend(field_streams)
+    parts.append(blob)
+    return b"".join(parts)
+
+
+def decode_batch(raw):
+    """
+    Decode a time-series batch.
+
+    :return: ``(columns, extra)`` like :func:`DAQ.util.batch.decode_batch`:
+        field name to NumPy array (fixed-point fields scaled back to float)
+        and the list of records carried in the BSON blob.
+    """
+    magic, version, _flags, _reserved, series, count, blob_len = HEADER.unpack_from(raw)
+    if magic != MAGIC:
+        raise ValueError("Not a time-series batch")
+    if version != SCHEMA_VERSION:
+        raise ValueError(f"Unsupported time-series batch version {version}")
+
+    raw = memoryview(raw)
+    offset = HEADER.size
+    macs = np.frombuffer(raw, dtype="<u8", count=series, offset=offset)
+    offset += 8 * series
+    lengths = np.frombuffer(raw, dtype="<u4", count=series, offset=offset).astype(np.int64)
+    offset += 4 * series
+    if lengths.sum() != count:
+        raise ValueError(f"Time-series batch holds {lengths.sum()} records, header says {count}")
+    starts = np.cumsum(lengths) - lengths
+
+    columns = {"macaddr": np.repeat(macs, lengths).astype(DTYPES["macaddr"])}
+    for name in TIME_FIELDS + VALUE_FIELDS:
+        if not count:
+            columns[name] = np.zeros(0, dtype=DTYPES[name] if name in ("op_stat", "reg_stat") else np.float64)
+            continue
+        sizes = LENGTHS.unpack_from(raw, offset)
+        offset += LENGTHS.size
+        streams = []
+        for size in sizes:
+            streams.append(raw[offset:offset + size])
+            offset += size
+        if name in TIME_FIELDS:
+            columns[name] = decode_times(streams[0], streams[2], starts, lengths) / MICROS
+        elif name in SCALED:
+            columns[name] = decode_values(*streams, starts, lengths).view(np.float64) / FIXED_POINT
+        else:
+            columns[name] = decode_values(*streams, starts, lengths).view(np.float64).astype(DTYPES[name])
+
+    extra = []
+    if blob_len:
+        extra = BSON(bytes(raw[offset:offset + blob_len])).decode().get("cache", [])
+    return columns, extra
@@ -0,0 +1,136 @@
+"""
+Per-stage latency aggregation for traced records.
+
+Records sampled by the DAQ carry ``trace = [rx_wall, rx_mono, parse_us,
+enqueue_us, flush_us]`` (monotonic microseconds since gateway receive) and
+their batch arrives with the publish wall-clock time in the
+``Mesh-Trace-Publish`` NATS header. The catcher adds decode and Redis-write
+times and folds each record into one histogram per stage:
+
+    parse     gateway receive -> Message decoded
+    enqueue   decoded -> record handed to the batching chain
+    batch     enqueued -> batch flushed by CompressionHandler
+    publish   flushed -> published (compression, Pitcher queue, rate limit)
+    transit   published -> batch decoded here (network, NATS, decompress)
+    store     decoded -> Redis write done
+    total     gateway receive -> Redis write done
+
+``transit``, ``store`` and ``total`` compare wall clocks across hosts, so they
+include any clock offset between the site and the cloud.
+
+Histograms are persisted to the ``trace:latency`` Redis hash so the API
+process can serve them.
+"""
+
+from __future__ import annotations
+
+import json
+import time
+from bisect import bisect_left
+from typing import Any
+
+TRACE_KEY = "trace"
+PUBLISH_HEADER = "Mesh-Trace-Publish"
+REDIS_KEY = "trace:latency"
+
+RX_WALL, RX_MONO, PARSE, ENQUEUE, FLUSH = range(5)
+
+STAGES = ("parse", "enqueue", "batch", "publish", "transit", "store", "total")
+
+# Seconds
+BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0,
+)
+
+
+def publish_time(headers: dict | None) -> float | None:
+    if not headers or PUBLISH_HEADER not in headers:
+        return None
+    try:
+        return float(headers[PUBLISH_HEADER])
+    except (TypeError, ValueError):
+        return None
+
+
+def stage_latencies(trace: list, published_at: float | None, decoded_at: float, stored_at: float) -> dict[str, float]:
+    """Seconds spent in each stage; stages without a stamp are left out."""
+    rx_wall = float(trace[RX_WALL])
+    parse_us, enqueue_us, flush_us = (int(value) for value in trace[PARSE:FLUSH + 1])
+    latencies = {"parse": parse_us / 1e6}
+    if enqueue_us:
+        latencies["enqueue"] = (enqueue_us - parse_us) / 1e6
+    if flush_us:
+        latencies["batch"] = (flush_us - (enqueue_us or parse_us)) / 1e6
+    if published_at is not None:
+        last_us = flush_us or enqueue_us or parse_us
+        latencies["publish"] = published_at - (rx_wall + last_us / 1e6)
+        latencies["transit"] = decoded_at - published_at
+    latencies["store"] = stored_at - decoded_at
+    latencies["total"] = stored_at - rx_wall
+    return latencies
+
+
+class LatencyHistograms:
+    """Fixed-bucket histograms per stage, persisted to Redis periodically."""
+
+    def __init__(self, save_interval: float = 10.0) -> None:
+        self.save_interval = save_interval
+        self.counts = {stage: [0] * (len(BUCKETS) + 1) for stage in STAGES}
+        self.sums = dict.fromkeys(STAGES, 0.0)
+        self.traced = 0
+        self._saved_at = time.monotonic()
+
+    def observe(self, latencies: dict[str, float]) -> None:
+        self.traced += 1
+        for stage, seconds in latencies.items():
+            seconds = max(seconds, 0.0)
+            self.counts[stage][bisect_left(BUCKETS, seconds)] += 1
+            self.sums[stage] += seconds
+
+    def due(self) -> bool:
+        return time.monotonic() - self._saved_at >= self.save_interval
+
+    def save(self, redis_conn: Any) -> None:
+        mapping = {
+            stage: json.dumps({"counts": self.counts[stage], "sum": self.sums[stage]})
+            for stage in STAGES
+        }
+        mapping["buckets"] = json.dumps(BUCKETS)
+        mapping["traced"] = str(self.traced)
+        redis_conn.hset(REDIS_KEY, mapping=mapping)
+        self._saved_at = time.monotonic()
+
+
+def _quantile(counts: list[int], total: int, q: float) -> float | str | None:
+    """Upper bound of the bucket holding quantile ``q`` ("+Inf" past the last)."""
+    if not total:
+        return None
+    target = q * total
+    running = 0
+    for bound, count in zip(BUCKETS + (float("inf"),), counts):
+        running += count
+        if running >= target:
+            return bound if bound != float("inf") else "+Inf"
+    return "+Inf"
+
+
+def load_summary(redis_conn: Any) -> dict[str, Any]:
+    """Read persisted histograms and summarize each stage."""
+    raw = redis_conn.hgetall(REDIS_KEY) or {}
+    summary: dict[str, Any] = {"traced": int(raw.get("traced", 0) or 0), "stages": {}}
+    for stage in STAGES:
+        if stage not in raw:
+            continue
+        data = json.loads(raw[stage])
+        counts = data["counts"]
+        total = sum(counts)
+        summary["stages"][stage] = {
+            "count": total,
+            "mean": data["sum"] / total if total else None,
+            "p50": _quantile(counts, total, 0.50),
+            "p90": _quantile(counts, total, 0.90),
+            "p99": _quantile(counts, total, 0.99),
+            "buckets": dict(zip([str(b) for b in BUCKETS] + ["+Inf"], counts)),
+        }
+    return summary
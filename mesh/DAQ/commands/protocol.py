@@ -1,22 +1,37 @@
 # DAQ/commands/protocol.py
 import struct
+import numpy as np
 from DAQ.util.hex import _u, _h
 
 command_mapper = {}
+command_table = [None] * 256  # int command id -> class, filled by CommandMeta
+
+# mesh_ctrl, addr, request_id, shc, sql, hc, ql, type, part (17 bytes)
+HEADER = struct.Struct(">B8sHBBBBBB")
 
 
 def safe_int16(val):
     return max(0, min(32767, int(val)))
 
 def parse_commands(msg, payload):
-    if not payload:
-        return []
-    cmd_byte = payload[0:1].hex().upper()  # First byte is command ID
-    body = payload[1:]
-    cmd_class = command_mapper.get(cmd_byte, RawResponse)
-    cmd_instance = cmd_class(header=msg, raw=body)
-    cmd_instance.parse(body)
-    return [cmd_instance]
+    """Parse length-prefixed commands out of ``payload`` (bytes or memoryview)."""
+    view = memoryview(payload)
+    end = len(view)
+    commands = []
+    i = 0
+    while i < end:
+        cmd_len = view[i]
+        if i + 1 + cmd_len > end:
+            raise ValueError("Malformed payload: cmd_len exceeds bounds")
+
+        body = view[i + 2: i + 1 + cmd_len]
+        cmd_class = (command_table[view[i + 1]] if cmd_len else None) or RawResponse
+        cmd_instance = cmd_class(header=msg, raw=body)
+        cmd_instance.parse(body)
+        commands.append(cmd_instance)
+
+        i += 1 + cmd_len
+    return commands
 
 
 class CommandMeta(type):
@@ -25,6 +40,7 @@ class CommandMeta(type):
         cmd = attrs.get('CMD', None)
         if cmd and name not in ['CommandMeta', 'CommandBase']:
             command_mapper[cmd] = newclass
+            command_table[int(cmd, 16)] = newclass
         return newclass
 
 
@@ -85,12 +101,91 @@ class DataIndication(CommandBase):
     LEGACY_SAMPLE_SIZE = 14  # timestamp + six electrical int16 values
     SOLAR_SAMPLE_SIZE = 18   # legacy fields + temperature + irradiance
 
+    STATUS = struct.Struct(">HH")
+
+    # Big-endian on-the-wire sample layouts
+    LEGACY_DTYPE = np.dtype([
+        ('timestamp', '>u2'),
+        ('Vi', '>i2'), ('Vo', '>i2'), ('Ii', '>i2'),
+        ('Io', '>i2'), ('Pi', '>i2'), ('Po', '>i2'),
+    ])
+    SOLAR_DTYPE = np.dtype(LEGACY_DTYPE.descr + [
+        ('temperature', '>i2'), ('irradiance', '>i2'),
+    ])
+
+    FIELDS = ('Vi', 'Vo', 'Ii', 'Io', 'Pi', 'Po', 'temperature', 'irradiance')
+    SCALE = {
+        'Vi': 100.0, 'Vo': 100.0, 'Ii': 100.0, 'Io': 100.0,
+        'Pi': 100.0, 'Po': 100.0, 'temperature': 100.0, 'irradiance': 10.0,
+    }
+
     def _init(self):
-        self.data = []
+        self._data = []
+        self._columns = None
         self._parsed = False
         self.op_stat = 0
         self.reg_stat = 0
 
+    @property
+    def data(self):
+        """Per-sample dicts, materialized from :attr:`columns` on first use."""
+        if self._data is None:
+            self._data = self.rows(self._columns)
+        return self._data
+
+    @data.setter
+    def data(self, value):
+        self._data = value
+        self._columns = None
+
+    @property
+    def columns(self):
+        """Decoded samples as a dict of 1-D arrays keyed by field name."""
+        if self._columns is None:
+            data = self._data or []
+            self._columns = {'timestamp': np.array([d['timestamp'] for d in data], dtype=np.int64)}
+            for field in self.FIELDS:
+                self._columns[field] = np.array([d.get(field, 0.0) for d in data], dtype=np.float64)
+        return self._columns
+
+    @classmethod
+    def decode_samples(cls, data_raw):
+        """
+        Batch-decode a sample block into scaled column arrays.
+
+        Raises ValueError when the block is not a whole number of solar or
+        legacy samples.
+        """
+        if len(data_raw) % cls.SOLAR_SAMPLE_SIZE == 0:
+            dtype = cls.SOLAR_DTYPE
+        elif len(data_raw) % cls.LEGACY_SAMPLE_SIZE == 0:
+            dtype = cls.LEGACY_DTYPE
+        else:
+            raise ValueError(
+                f"Unsupported DataIndication payload length: {len(data_raw)}"
+            )
+
+        samples = np.frombuffer(data_raw, dtype=dtype)
+        columns = {'timestamp': samples['timestamp'].astype(np.int64)}
+        for field in cls.FIELDS:
+            if field in dtype.names:
+                columns[field] = samples[field] / cls.SCALE[field]
+            else:
+                columns[field] = np.zeros(len(samples), dtype=np.float64)
+        return columns
+
+    @classmethod
+    def rows(cls, columns, order=None):
+        """Turn column arrays back into per-sample dicts (optionally reordered)."""
+        if not columns:
+            return []
+        keys = ('timestamp',) + cls.FIELDS
+        if order is None:
+            values = [columns[k].tolist() for k in keys]
+        else:
+            values = [columns[k][order].tolist() for k in keys]
+        return [dict(zip(keys, sample)) for sample in zip(*values)]
+
     def parse(self, raw=None):
         if raw is not None:
             self.raw = raw
@@ -100,42 +195,9 @@ class DataIndication(CommandBase):
             if len(self.raw) < 4:
                 raise ValueError("Payload too short to contain op_stat and reg_stat")
 
-            self.op_stat, self.reg_stat = struct.unpack(">HH", self.raw[:4])
-            data_raw = self.raw[4:]
-
-            if len(data_raw) % self.SOLAR_SAMPLE_SIZE == 0:
-                sample_size = self.SOLAR_SAMPLE_SIZE
-            elif len(data_raw) % self.LEGACY_SAMPLE_SIZE == 0:
-                sample_size = self.LEGACY_SAMPLE_SIZE
-            else:
-                raise ValueError(
-                    f"Unsupported DataIndication payload length: {len(data_raw)}"
-                )
-
-            for i in range(0, len(data_raw), sample_size):
-                chunk = data_raw[i:i + sample_size]
-                if sample_size == self.SOLAR_SAMPLE_SIZE:
-                    timestamp, Vi, Vo, Ii, Io, Pi, Po, temperature, irradiance = struct.unpack(
-                        ">Hhhhhhhhh", chunk
-                    )
-                else:
-                    timestamp, Vi, Vo, Ii, Io, Pi, Po = struct.unpack(
-                        ">Hhhhhhh", chunk
-                    )
-                    temperature = 0
-                    irradiance = 0
-
-                self.data.append({
-                    'timestamp': timestamp,
-                    'Vi': Vi / 100.0,
-                    'Vo': Vo / 100.0,
-                    'Ii': Ii / 100.0,
-                    'Io': Io / 100.0,
-                    'Pi': Pi / 100.0,
-                    'Po': Po / 100.0,
-                    'temperature': temperature / 100.0,
-                    'irradiance': irradiance / 10.0,
-                })
+            self.op_stat, self.reg_stat = self.STATUS.unpack_from(self.raw)
+            self._columns = self.decode_samples(self.raw[4:])
+            self._data = None
         except Exception as e:
             print(f"[DataIndication] parse() error: {e}")
 
@@ -163,14 +225,23 @@ class DataIndication(CommandBase):
             'macaddr': self.header.addr if self.header else "unknown",
             'op_stat': self.op_stat,
             'reg_stat': self.reg_stat,
-            'data': sorted(self.data, key=lambda x: x['timestamp'])
+            'data': self._sorted_data(),
         }
 
+    def _sorted_data(self):
+        if self._data is None:
+            # Sort the columns rather than the dicts; stable like sorted()
+            order = np.argsort(self._columns['timestamp'], kind='stable')
+            return self.rows(self._columns, order)
+        return sorted(self._data, key=lambda x: x['timestamp'])
+
     def add_data(
         self, timestamp, Vi, Vo, Ii, Io, Pi, Po,
         temperature=0.0, irradiance=0.0,
     ):
-        self.data.append({
+        data = self.data
+        self._columns = None
+        data.append({
             'timestamp': int(timestamp),
             'Vi': round(Vi, 2),
             'Vo': round(Vo, 2),
@@ -255,6 +326,7 @@ class Message:
         self.commands = []
         self.raw = b""
         self.received_on = None
+        self.trace = None  # DAQ.util.tracing list when this frame is sampled
 
     def set_addr(self, macaddr=None):
         self.addr = macaddr.zfill(self.LEN_ADDR * 2) if macaddr else 'F' * (self.LEN_ADDR * 2)
@@ -283,25 +355,38 @@ class Message:
 
     @classmethod
     def compile(cls, payload: bytes):
+        return cls.decode(payload)
+
+    @classmethod
+    def decode(cls, raw, received_on=None):
+        """
+        Single-pass decoder for an MI frame body.
+
+        ``raw`` may be bytes, bytearray or memoryview; the header is unpacked
+        with one precompiled struct and command bodies are memoryview slices
+        of ``raw``, so nothing is copied until a command parses its fields.
+        """
+        view = memoryview(raw)
+        (ctrl, addr, request_id, shc, sql, hc, ql, dt, parts) = HEADER.unpack_from(view)
+
         msg = cls()
-        tokens, remaining = cls.tokenize_string(payload, cls.LEN_ORDER)
-        msg.mesh_ctrl = MeshCtrl(tokens[0][0])
-        msg.addr = _h(tokens[1][::-1])
-        msg.request_id = safe_int16.from_bytes(tokens[2], 'big')
-        msg.source_hopcount = tokens[3][0]
-        msg.source_queue_length = tokens[4][0]
-        msg.hopcount = tokens[5][0]
-        msg.queue_length = tokens[6][0]
-        dt = tokens[7][0]
+        msg.raw = raw
+        msg.received_on = received_on
+        msg.mesh_ctrl = MeshCtrl(ctrl)
+        msg.addr = _h(addr[::-1])
+        msg.request_id = request_id
+        msg.source_hopcount = shc
+        msg.source_queue_length = sql
+        msg.hopcount = hc
+        msg.queue_length = ql
         msg._reserved = dt >> 4
         msg.dtype = dt & 0x0F
-        parts = tokens[8][0]
         msg.partnum = (parts >> 4) + 1
         msg.numparts = (parts & 0x0F) + 1
-        msg.payload = remaining
+        msg.payload = view[HEADER.size:]
 
         try:
-            msg.commands = parse_commands(msg, remaining)
+            msg.commands = parse_commands(msg, msg.payload)
         except Exception:
             import traceback
             traceback.print_exc()
@@ -309,7 +394,6 @@ class Message:
 
         return msg
 
-
     @staticmethod
     def tokenize_string(raw, chunks):
         tokens, i = [], 0
@@ -320,52 +404,7 @@ class Message:
 
     @staticmethod
     def from_raw(message_type, length, raw, received_on):
-        msg = Message()
-        msg.raw = raw
-        msg.received_on = received_on
-
-        tokens, payload = Message.tokenize_string(raw, Message.LEN_ORDER)
-
-        msg.mesh_ctrl = MeshCtrl(tokens[0][0])
-        msg.addr = _h(tokens[1][::-1])
-        msg.request_id = int.from_bytes(tokens[2], 'big')
-        msg.source_hopcount = tokens[3][0]
-        msg.source_queue_length = tokens[4][0]
-        msg.hopcount = tokens[5][0]
-        msg.queue_length = tokens[6][0]
-        dt = tokens[7][0]
-        msg._reserved = dt >> 4
-        msg.dtype = dt & 0x0F
-        parts = tokens[8][0]
-        msg.partnum = (parts >> 4) + 1
-        msg.numparts = (parts & 0x0F) + 1
-
-        msg.payload = payload
-        msg.commands = []
-
-        try:
-            i = 0
-            while i < len(payload):
-                cmd_len = payload[i]
-                if i + 1 + cmd_len > len(payload):
-                    raise ValueError("Malformed payload: cmd_len exceeds bounds")
-
-                cmd_data = payload[i + 1: i + 1 + cmd_len]
-                cmd_byte = cmd_data[0:1].hex().upper()
-
-                cmd_class = command_mapper.get(cmd_byte, RawResponse)
-                cmd_instance = cmd_class(header=msg, raw=cmd_data[1:])
-                cmd_instance.parse(cmd_data[1:])
-                msg.commands.append(cmd_instance)
-
-                i += 1 + cmd_len
-
-        except Exception:
-            import traceback
-            traceback.print_exc()
-            msg.commands = []
-
-        return msg
+        return Message.decode(raw, received_on)
 
     def __repr__(self):
         return f"<Message [{', '.join(repr(c) for c in self.commands)}]>"
@@ -1,8 +1,20 @@
+import asyncio
+import queue
+import threading
+import time
 from collections import defaultdict
-from DAQ.util.hex import uint32_to_sint32, int_to_float, _u
+from contextlib import contextmanager
+import numpy as np
+from DAQ.util.config import load_config
+from DAQ.util.hex import uint32_to_sint32, int_to_float
 from DAQ.devices import IConnector
+from pymodbus import Framer
 from pymodbus.client import ModbusTcpClient, ModbusSerialClient
 from pymodbus.pdu import ExceptionResponse
+try:
+    from pymodbus.client import AsyncModbusTcpClient, AsyncModbusSerialClient
+except ImportError:
+    AsyncModbusTcpClient = AsyncModbusSerialClient = None
 
 EXCEPTIONS = {
     1: 'ILLEGAL FUNCTION',
@@ -22,22 +34,337 @@ FORMAT_UINT32   = 4
 FORMAT_FLOAT    = 5
 FORMAT_BITMAP   = 6
 
-def get_modbus_client(transport_type, **kwargs):
+#: Protocol limit for one read_holding_registers/read_input_registers request
+MAX_READ_REGISTERS = 125
+
+#: Numeric formats decoded straight from the big-endian register bytes
+BLOCK_DTYPES = {
+    FORMAT_SINT16: np.dtype('>i2'),
+    FORMAT_UINT16: np.dtype('>u2'),
+    FORMAT_SINT32: np.dtype('>i4'),
+    FORMAT_UINT32: np.dtype('>u4'),
+    FORMAT_FLOAT: np.dtype('>f4'),
+}
+
+
+class ReadBlock(object):
+    """One register read covering ``members``: (name, register offset, register count)."""
+
+    __slots__ = ('execute', 'start', 'count', 'members')
+
+    def __init__(self, execute, start, count, members):
+        self.execute = execute
+        self.start = start
+        self.count = count
+        self.members = members
+
+    def __repr__(self):
+        return '<ReadBlock %s %d+%d %s>' % (self.execute, self.start, self.count,
+                                            [m[0] for m in self.members])
+
+
+def plan_reads(address_map, names, max_registers=MAX_READ_REGISTERS, max_gap=0):
+    """
+    Group ``names`` by their ``execute`` function and merge address ranges
+    that are at most ``max_gap`` registers apart into blocks of up to
+    ``max_registers``. Addresses in ``address_map`` are 1-based and
+    inclusive; block starts are 0-based protocol addresses.
+    """
+    spans = defaultdict(list)
+    for name in names:
+        mapper = address_map[name]
+        first, last = mapper['address']
+        spans[mapper['execute']].append((first - 1, last - first + 1, name))
+
+    blocks = []
+    for execute in spans:
+        current = None
+        for start, count, name in sorted(spans[execute]):
+            if current is not None:
+                end = max(current.start + current.count, start + count)
+                if start - (current.start + current.count) <= max_gap \
+                and end - current.start <= max_registers:
+                    current.count = end - current.start
+                    current.members.append((name, start - current.start, count))
+                    continue
+            current = ReadBlock(execute, start, count, [(name, 0, count)])
+            blocks.append(current)
+
+    return blocks
+
+def new_modbus_client(transport_type, use_async=False, **kwargs):
+    """Build an unconnected pymodbus client for one endpoint."""
+    if use_async:
+        tcp_class, serial_class = AsyncModbusTcpClient, AsyncModbusSerialClient
+    else:
+        tcp_class, serial_class = ModbusTcpClient, ModbusSerialClient
+
     if transport_type == 'tcp':
-        client = ModbusTcpClient(host=kwargs['host'],
-                                 port=kwargs.get('port'))
+        client = tcp_class(host=kwargs['host'],
+                           port=kwargs.get('port'))
 
     elif transport_type == 'serial':
-        method = kwargs['method']
-        del kwargs['method']
-        client = ModbusSerialClient(method=method, **kwargs)
+        kwargs = dict(kwargs)
+        method = kwargs.pop('method')
+        client = serial_class(framer=Framer(method), **kwargs)
 
     elif transport_type in ['ascii', 'rtu', 'binary']:
-        client = ModbusSerialClient(method=transport_type, **kwargs)
+        client = serial_class(framer=Framer(transport_type), **kwargs)
+
+    else:
+        raise ValueError('Unknown Modbus transport %r' % (transport_type,))
 
     return client
 
+
+def _is_open(client):
+    if hasattr(client, 'connected'):
+        return bool(client.connected)
+    return bool(client.is_socket_open())
+
+
+class ModbusBus(object):
+    """
+    Connections to one Modbus endpoint, shared by every device behind it.
+
+    A serial bus has a single connection, so requests from all of its
+    devices are serialized; a TCP gateway allows up to ``size`` requests at
+    once, each on its own connection. Connections are opened lazily, reused,
+    and dropped after an I/O error. Failed connects back off exponentially
+    (``backoff_initial`` doubling up to ``backoff_max``) so an unreachable
+    gateway is not hammered by every poll.
+    """
+
+    def __init__(self, pool, key, transport_type, kwargs, size):
+        self.pool = pool
+        self.key = key
+        self.transport_type = transport_type
+        self.kwargs = kwargs
+        self.size = size
+        self.refs = 0
+
+        self.requests = 0
+        self.errors = 0
+        self.connects = 0
+
+        self._slots = threading.BoundedSemaphore(size)
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._retry_at = 0.0
+
+    def __repr__(self):
+        return '<ModbusBus %s x%d>' % (':'.join(str(part) for part in self.key), self.size)
+
+    @contextmanager
+    def lease(self):
+        """Check out one connected client for the duration of a request."""
+        if not self._slots.acquire(timeout=self.pool.request_timeout):
+            raise ConnectionError('%r: timed out waiting for a free connection' % (self,))
+        try:
+            client = self._checkout()
+            try:
+                yield client
+            except Exception:
+                self.errors += 1
+                self._discard(client)
+                raise
+            else:
+                self.requests += 1
+                self._idle.put(client)
+        finally:
+            self._slots.release()
+
+    def _checkout(self):
+        try:
+            client = self._idle.get_nowait()
+        except queue.Empty:
+            client = new_modbus_client(self.transport_type, use_async=self.pool.use_async, **self.kwargs)
+
+        if not _is_open(client):
+            self._connect(client)
+        return client
+
+    def _connect(self, client):
+        with self._lock:
+            wait = self._retry_at - time.monotonic()
+            if wait > 0:
+                raise ConnectionError('%r: reconnecting in %.1fs' % (self, wait))
+
+        try:
+            connected = self.pool.run(client.connect())
+        except Exception:
+            connected = False
+
+        with self._lock:
+            if not connected:
+                delay = min(self.pool.backoff_initial * 2 ** self._failures, self.pool.backoff_max)
+                self._failures += 1
+                self._retry_at = time.monotonic() + delay
+                raise ConnectionError('%r: connect failed; retrying in %.1fs' % (self, delay))
+            self._failures = 0
+            self.connects += 1
+
+    def _discard(self, client):
+        try:
+            self.pool.run(client.close())
+        except Exception:
+            pass
+
+    def close(self):
+        while True:
+            try:
+                self._discard(self._idle.get_nowait())
+            except queue.Empty:
+                break
+
+
+class BusClient(object):
+    """
+    Per-device handle on a shared :class:`ModbusBus`.
+
+    Exposes the pymodbus request methods the connectors use; every call
+    leases a bus connection, so connectors keep calling ``self.client``
+    exactly as they did with a dedicated client.
+    """
+
+    def __init__(self, bus, unit=None):
+        self.bus = bus
+        self.unit = unit
+        self._closed = False
+        bus.refs += 1
+
+    def _call(self, method, *args, **kwargs):
+        if self.unit is not None:
+            kwargs['slave'] = self.unit
+        with self.bus.lease() as client:
+            return self.bus.pool.run(getattr(client, method)(*args, **kwargs))
+
+    def read_holding_registers(self, address, count=1, **kwargs):
+        return self._call('read_holding_registers', address, count=count, **kwargs)
+
+    def read_input_registers(self, address, count=1, **kwargs):
+        return self._call('read_input_registers', address, count=count, **kwargs)
+
+    def write_register(self, address, value, **kwargs):
+        return self._call('write_register', address, value, **kwargs)
+
+    def write_registers(self, address, values, **kwargs):
+        return self._call('write_registers', address, values, **kwargs)
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self.bus.pool.release(self.bus)
+
+
+class ModbusClientPool(object):
+    """
+    Shared Modbus connections keyed by transport endpoint.
+
+    TCP endpoints are keyed by ``(host, port)`` and get ``tcp_connections``
+    concurrent connections; serial endpoints are keyed by their port (the
+    device path) and get exactly one. With ``async_client`` the pool uses
+    pymodbus' asyncio clients on the event loop passed to :meth:`bind_loop`,
+    and blocking callers (connectors running on the collector's I/O threads)
+    wait on the result; without a bound loop it falls back to the
+    synchronous clients.
+
+      devices:
+        modbus:
+          tcp_connections: 2
+          backoff_initial: 1.0
+          backoff_max: 60.0
+          request_timeout: 10.0
+          async_client: false
+    """
+
+    def __init__(self, tcp_connections=2, backoff_initial=1.0, backoff_max=60.0,
+                 request_timeout=10.0, async_client=False):
+        self.tcp_connections = max(1, int(tcp_connections))
+        self.backoff_initial = backoff_initial
+        self.backoff_max = backoff_max
+        self.request_timeout = request_timeout
+        self.async_client = bool(async_client) and AsyncModbusTcpClient is not None
+        self.loop = None
+        self.buses = {}
+        self._lock = threading.Lock()
+
+    @property
+    def use_async(self):
+        return self.async_client and self.loop is not None
+
+    def bind_loop(self, loop):
+        self.loop = loop
+
+    def run(self, result):
+        """Wait for ``result`` on the bound loop if it is a coroutine (async clients)."""
+        if asyncio.iscoroutine(result):
+            return asyncio.run_coroutine_threadsafe(result, self.loop).result(self.request_timeout)
+        return result
+
+    @staticmethod
+    def endpoint(transport_type, kwargs):
+        if transport_type == 'tcp':
+            return ('tcp', kwargs['host'], kwargs.get('port') or 502)
+        if 'port' in kwargs:
+            return ('serial', kwargs['port'])
+        return ('serial',) + tuple(sorted((key, str(value)) for key, value in kwargs.items()))
+
+    def client(self, transport_type, unit=None, **kwargs):
+        key = self.endpoint(transport_type, kwargs)
+        with self._lock:
+            bus = self.buses.get(key)
+            if bus is None:
+                size = self.tcp_connections if transport_type == 'tcp' else 1
+                bus = self.buses[key] = ModbusBus(self, key, transport_type, kwargs, size)
+            return BusClient(bus, unit)
+
+    def release(self, bus):
+        with self._lock:
+            bus.refs -= 1
+            if bus.refs <= 0:
+                self.buses.pop(bus.key, None)
+                bus.close()
+
+    def close(self):
+        with self._lock:
+            buses, self.buses = list(self.buses.values()), {}
+        for bus in buses:
+            bus.close()
+
+
+_modbus_pool = None
+_modbus_pool_lock = threading.Lock()
+
+
+def get_modbus_pool():
+    """The process-wide :class:`ModbusClientPool`, built from ``devices.modbus`` on first use."""
+    global _modbus_pool
+    with _modbus_pool_lock:
+        if _modbus_pool is None:
+            _modbus_pool = ModbusClientPool(**(load_config().get('devices', {}).get('modbus') or {}))
+        return _modbus_pool
+
+
+def get_modbus_client(transport_type, unit=None, **kwargs):
+    """A handle on the shared connection(s) for this endpoint; see :class:`ModbusClientPool`."""
+    return get_modbus_pool().client(transport_type, unit=unit, **kwargs)
+
 class GenericModbusConnector(IConnector):
+    """
+    Base for Modbus connectors described by an ``ADDRESS_MAP``.
+
+    :meth:`read_all` plans its reads with :func:`plan_reads`, so contiguous
+    or nearly contiguous variables (up to ``MAX_READ_GAP`` unused registers
+    apart) come back in one request per block, and decodes every block with
+    decoders compiled once per variable. If a device rejects a merged block
+    (ILLEGAL DATA ADDRESS, e.g. a hole in its register map), that request
+    set is re-planned without merging.
+    """
+
+    MAX_READ_REGISTERS = MAX_READ_REGISTERS
+    MAX_READ_GAP = 8
 
     def read_uint16(self, registers, mapper):
         value = registers[0]
@@ -49,7 +376,8 @@ class GenericModbusConnector(IConnector):
         return value
 
     def read_sint16(self, registers, mapper):
-        return uint32_to_sint32(self.read_uint16(registers, mapper))
+        value = self.read_uint16(registers, mapper)
+        return value - (1 << 16) if value & 0x8000 else value
 
     def read_sint32(self, registers, mapper):
         return uint32_to_sint32(self.read_uint32(registers, mapper))
@@ -58,9 +386,8 @@ class GenericModbusConnector(IConnector):
         return int_to_float(self.read_uint32(registers, mapper))
 
     def read_ascii(self, registers, mapper):
-        value = ''.join([hex(x)[2:] for x in registers])
-        value = _u(value).strip()
-        return value
+        value = np.asarray(registers, dtype='>u2').tobytes()
+        return value.decode('ascii', 'replace').strip('\x00 ')
 
     def read_bitmap(self, registers, mapper):
         bits = bin(registers[0])[2:].rjust(16, '0')
@@ -86,37 +413,67 @@ class GenericModbusConnector(IConnector):
         self.client.write_register(address-1, value)
 
     def read(self, address, r):
-        return self.client.read_holding_registers(address-1, r)
+        return self.client.read_holding_registers(address-1, count=r)
+
+    def _compile_decoder(self, mapper):
+        """Return ``decode(buf, registers, offset, count)`` for one ADDRESS_MAP entry."""
+        fmt = mapper['format']
+
+        if isinstance(fmt, str):
+            method = getattr(self, fmt)
+            return lambda buf, registers, offset, count: method(registers[offset:offset + count], mapper)
+
+        if fmt in BLOCK_DTYPES:
+            dtype = BLOCK_DTYPES[fmt]
+            return lambda buf, registers, offset, count: np.frombuffer(buf, dtype, 1, offset * 2)[0].item()
+
+        if fmt == FORMAT_ASCII:
+            return lambda buf, registers, offset, count: \
+                buf[offset * 2:(offset + count) * 2].decode('ascii', 'replace').strip('\x00 ')
+
+        if fmt == FORMAT_BITMAP:
+            return lambda buf, registers, offset, count: self.read_bitmap(registers[offset:offset + count], mapper)
+
+        raise ValueError('Unsupported Modbus format %r' % (fmt,))
+
+    def decoder(self, var):
+        decoders = self.__dict__.setdefault('_decoders', {})
+        decode = decoders.get(var)
+        if decode is None:
+            decode = decoders[var] = self._compile_decoder(self.ADDRESS_MAP[var])
+        return decode
+
+    def read_plan(self, register_names):
+        plans = self.__dict__.setdefault('_read_plans', {})
+        key = tuple(register_names)
+        plan = plans.get(key)
+        if plan is None:
+            plan = plans[key] = plan_reads(self.ADDRESS_MAP, key,
+                                           self.MAX_READ_REGISTERS, self.MAX_READ_GAP)
+        return plan
+
+    def read_block(self, block):
+        """Issue one read for ``block``; returns {name: (value, valid)}."""
+        reader = getattr(self.client, block.execute)
+        rr = reader(block.start, count=block.count)
+
+        if isinstance(rr, ExceptionResponse) or getattr(rr, 'isError', lambda: False)():
+            code = getattr(rr, 'exception_code', None)
+            error = EXCEPTIONS.get(code, 'MODBUS ERROR %s' % code)
+            return {name: (error, False) for name, _, _ in block.members}
+
+        registers = rr.registers
+        buf = np.asarray(registers, dtype='>u2').tobytes()
+        return {
+            name: (self.decoder(name)(buf, registers, offset, count), True)
+            for name, offset, count in block.members
+        }
 
     def read_from_map(self, var):
         mapper = self.ADDRESS_MAP[var]
-
-        reader = getattr(self.client, mapper['execute'])
-
-        start = mapper['address'][0] - 1
-        count = mapper['address'][1] - start
-
-        rr = reader(start, count)
-        valid = True
-
-        if isinstance(rr, ExceptionResponse):
-            value = EXCEPTIONS[rr.exception_code]
-            valid = False
-        elif isinstance(mapper['format'], str) \
-        and callable(getattr(self, mapper['format'])):
-            value = getattr(self, mapper['format'])(rr.registers, mapper)
-        elif mapper['format'] == FORMAT_SINT32:
-            value = self.read_sint32(rr.registers, mapper)
-        elif mapper['format'] == FORMAT_UINT16:
-            value = self.read_uint16(rr.registers, mapper)
-        elif mapper['format'] == FORMAT_FLOAT:
-            value = self.read_float(rr.registers, mapper)
-        elif mapper['format'] == FORMAT_ASCII:
-            value = self.read_ascii(rr.registers, mapper)
-        elif mapper['format'] == FORMAT_BITMAP:
-            value = self.read_bitmap(rr.registers, mapper)
-
-        return value, valid
+        first, last = mapper['address']
+        block = ReadBlock(mapper['execute'], first - 1, last - first + 1, [(var, 0, last - first + 1)])
+        return self.read_block(block)[var]
 
     def register_names(self):
         return list(self.ADDRESS_MAP.keys())
@@ -130,12 +487,19 @@ class GenericModbusConnector(IConnector):
         for var in register_names:
             assert var in self.ADDRESS_MAP
 
-            value, is_valid = self.read_from_map(var)
+        for block in self.read_plan(register_names):
+            results = self.read_block(block)
 
-            if is_valid:
-                data[var] = value
-            else:
-                data[var] = None
+            if len(block.members) > 1 \
+            and results[block.members[0][0]][0] == EXCEPTIONS[2]:
+                # The device has a hole inside this merged range; read these
+                # variables one by one and stop merging for this name set
+                self._read_plans[tuple(register_names)] = plan_reads(
+                    self.ADDRESS_MAP, tuple(register_names), self.MAX_READ_REGISTERS, max_gap=-1)
+                results = {name: self.read_from_map(name) for name, _, _ in block.members}
+
+            for var, (value, is_valid) in results.items():
+                data[var] = value if is_valid else None
 
         return data
 
@@ -327,7 +691,7 @@ class SharkModbusConnector(GenericModbusConnector):
     FORCE_METER_RESTART = 25000
     RESET_ENERGY_ACCUMULATORS = 40100
 
-    def __init__(self, host, port, password=None, client=None):
+    def __init__(self, host, port, password=None, client=None, unit=None):
         self.host = host
         self.port = port
         self.verified = False
@@ -338,7 +702,7 @@ class SharkModbusConnector(GenericModbusConnector):
             self.password = password
 
         if client is None:
-            self.client = get_modbus_client('tcp', host=self.host, port=self.port)
+            self.client = get_modbus_client('tcp', unit=unit, host=self.host, port=self.port)
         else:
             self.client = client
 
@@ -496,6 +860,8 @@ class SatconPowerGateInverterConnector(GenericModbusConnector):
 
         value = value * mapper['format_scaling']
 
+        return value
+
     def read_kw(self, registers, mapper):
         value = self.read_scale(registers, mapper)
 
@@ -510,6 +876,8 @@ class SatconPowerGateInverterConnector(GenericModbusConnector):
 
         value = value * mapper['format_scaling']
 
+        return value
+
 class SatconPowerGatePlusSolsticeInverterConnector(object):#SatconPowerGateInverterConnector):
     __identifiers__ = ['SATCON POWERGATE PLUS INVERTER', 'SATCON SOLSTICE INVERTER']
     __dtype__ = 'inv'
@@ -15,17 +15,24 @@ logger = make_logger("GatewayManager")
 cfg = load_config()
 
 class GatewayManager:
-    def __init__(self, host: str, port: int, recv_queue: asyncio.Queue):
+    def __init__(self, host: str, port: int, recv_queue: asyncio.Queue,
+                 reuse_port: bool = False, autodiscovery: bool = True):
         self.host = host
         self.port = port
         self.recv_queue = recv_queue
+        self.reuse_port = reuse_port
+        self.autodiscovery = autodiscovery
 
         self.tcp_server = None
         self.udp_transport = None
 
     async def start(self):
         logger.info("Starting GatewayManager...")
-        self.tcp_server, self.udp_transport = await start_gateway_servers(self.recv_queue)
+        self.tcp_server, self.udp_transport = await start_gateway_servers(
+            self.recv_queue,
+            reuse_port=self.reuse_port,
+            autodiscovery=self.autodiscovery,
+        )
         logger.info("GatewayManager started.")
 
     async def stop(self):
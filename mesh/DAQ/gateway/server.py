@@ -10,12 +10,16 @@ Config-driven from config.yaml:
     ad_host: "0.0.0.0"
     ad_listen_port: 59991
     ad_respond_port: 59992
+    transport: "buffered"      # "buffered" (BufferedProtocol) or "stream" (StreamReader)
+    recv_buffer: 65536         # Per-connection receive buffer for "buffered"
 """
 
 import asyncio
+import logging
 import socket
 from DAQ.util.logger import make_logger
 from DAQ.util.config import load_config
+from DAQ.util import tracing
 from DAQ.util.utctime import utcepochnow
 from DAQ.util.hex import _h
 from DAQ.commands.protocol import Message
@@ -27,6 +31,12 @@ comm_host = cfg["gateway"]["comm_host"]
 comm_port = cfg["gateway"]["comm_port"]
 ad_listen_port = cfg["gateway"]["ad_listen_port"]
 ad_respond_port = cfg["gateway"]["ad_respond_port"]
+transport_mode = cfg["gateway"].get("transport", "buffered")
+recv_buffer_size = cfg["gateway"].get("recv_buffer", 65536)
+
+MI_MARKER = b"MI"
+MI_HEADER_LEN = 3           # "MI" + length byte
+MI_MAX_FRAME = MI_HEADER_LEN + 255
 
 # TCP Handler (MI protocol)
 async def handle_tcp_connection(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, recv_queue: asyncio.Queue):
@@ -45,17 +55,22 @@ async def handle_tcp_connection(reader: asyncio.StreamReader, writer: asyncio.St
 
             raw_payload = await reader.readexactly(length)
             timestamp = utcepochnow()
+            trace = tracing.sample() if tracing.enabled else None
 
-            logger.debug(f"[TCP] MI:{length}:{_h(raw_payload)}")
-
+            # Parse once here; DAQProcess consumes the decoded Message as-is.
             try:
-                msg = Message.from_raw(Message.MESH_INDICATION, length, raw_payload, timestamp)
-                logger.debug(f"[TCP] Parsed message with {len(msg.commands)} command(s)")
+                msg = Message.decode(raw_payload, timestamp)
             except Exception:
                 logger.exception("[TCP] Failed to parse message")
                 continue
+            if trace is not None:
+                tracing.stamp(trace, tracing.PARSE)
+                msg.trace = trace
+
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"[TCP] MI:{length}:{_h(raw_payload)} ({len(msg.commands)} command(s))")
 
-            payload = ("emulator", Message.MESH_INDICATION, length, raw_payload, timestamp)
+            payload = ("emulator", Message.MESH_INDICATION, length, msg, timestamp)
             await recv_queue.put(payload)
 
     except asyncio.IncompleteReadError:
@@ -67,6 +82,145 @@ async def handle_tcp_connection(reader: asyncio.StreamReader, writer: asyncio.St
         await writer.wait_closed()
 
 
+# TCP Protocol (MI protocol, BufferedProtocol)
+class GatewayProtocol(asyncio.BufferedProtocol):
+    """
+    Zero-await MI framing on top of a preallocated receive buffer.
+
+    The transport writes straight into ``self.buffer``; every complete frame
+    available after a read is decoded in a single ``buffer_updated`` call.
+    Unconsumed bytes are compacted to the front of the buffer, so a frame
+    never wraps. On a bad header the parser scans forward to the next
+    ``MI`` marker instead of sliding a fixed number of bytes.
+
+    When a blocking ``recv_queue`` fills up, the transport stops reading
+    until the queue has room again, pushing backpressure out to the gateway
+    over TCP instead of buffering in memory.
+    """
+
+    def __init__(self, recv_queue: asyncio.Queue, buffer_size: int = recv_buffer_size):
+        self.recv_queue = recv_queue
+        self.buffer = bytearray(max(buffer_size, 2 * MI_MAX_FRAME))
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+        self.transport = None
+        self.addr = None
+        self.resyncs = 0
+        self.dropped_bytes = 0
+        self.paused = False
+        self._resume_task = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.addr = transport.get_extra_info("peername")
+        logger.info(f"[TCP] Connection from {self.addr[0]}:{self.addr[1]}")
+
+    def connection_lost(self, exc):
+        if exc:
+            logger.warning(f"[TCP] Connection lost: {self.addr[0]}:{self.addr[1]} ({exc})")
+        else:
+            logger.info(f"[TCP] Disconnected: {self.addr[0]}:{self.addr[1]}")
+        if self._resume_task:
+            self._resume_task.cancel()
+
+    def get_buffer(self, sizehint):
+        if len(self.buffer) - self.end < MI_MAX_FRAME:
+            self._compact()
+        return self.view[self.end:]
+
+    def buffer_updated(self, nbytes):
+        self.end += nbytes
+        try:
+            self._drain_frames()
+        except Exception:
+            logger.exception("[TCP] Exception in handler")
+        if self.start == self.end:
+            self.start = self.end = 0
+
+    def _queue_blocked(self):
+        return self.recv_queue.full() and getattr(self.recv_queue, "policy", "block") == "block"
+
+    def _pause(self):
+        self.paused = True
+        self.transport.pause_reading()
+        self._resume_task = asyncio.get_running_loop().create_task(self._resume_when_ready())
+        logger.debug(f"[TCP] recv_queue full; paused reading from {self.addr}")
+
+    async def _resume_when_ready(self):
+        if hasattr(self.recv_queue, "wait_for_space"):
+            await self.recv_queue.wait_for_space()
+        else:
+            while self.recv_queue.full():
+                await asyncio.sleep(0.01)
+        self.paused = False
+        self._resume_task = None
+        self.buffer_updated(0)
+        if not self.paused and not self.transport.is_closing():
+            self.transport.resume_reading()
+
+    def _compact(self):
+        pending = self.end - self.start
+        if pending and self.start:
+            self.buffer[:pending] = self.buffer[self.start:self.end]
+        self.start, self.end = 0, pending
+
+    def _resync(self):
+        """Skip to the next MI marker; keep a trailing 'M' that may start one."""
+        buf, start, end = self.buffer, self.start, self.end
+        idx = buf.find(MI_MARKER, start + 1, end)
+        if idx < 0:
+            idx = end - 1 if buf[end - 1] == MI_MARKER[0] else end
+        skipped = idx - start
+        self.resyncs += 1
+        self.dropped_bytes += skipped
+        logger.warning(
+            f"[TCP] Invalid header from {self.addr}: skipped {skipped} byte(s) to resync"
+        )
+        self.start = idx
+
+    def _drain_frames(self):
+        buf = self.buffer
+        timestamp = None
+        while self.end - self.start >= MI_HEADER_LEN:
+            if self._queue_blocked():
+                self._pause()
+                break
+
+            start = self.start
+            if buf[start] != MI_MARKER[0] or buf[start + 1] != MI_MARKER[1]:
+                self._resync()
+                continue
+
+            length = buf[start + 2]
+            frame_end = start + MI_HEADER_LEN + length
+            if frame_end > self.end:
+                break
+
+            # One copy per frame: decoded commands keep views into it, and
+            # the receive buffer is reused by the next read.
+            raw_payload = bytes(self.view[start + MI_HEADER_LEN:frame_end])
+            self.start = frame_end
+
+            if timestamp is None:
+                timestamp = utcepochnow()
+            trace = tracing.sample() if tracing.enabled else None
+
+            try:
+                msg = Message.decode(raw_payload, timestamp)
+            except Exception:
+                logger.exception("[TCP] Failed to parse message")
+                continue
+            if trace is not None:
+                tracing.stamp(trace, tracing.PARSE)
+                msg.trace = trace
+
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"[TCP] MI:{length}:{_h(raw_payload)} ({len(msg.commands)} command(s))")
+
+            self.recv_queue.put_nowait(("emulator", Message.MESH_INDICATION, length, msg, timestamp))
+
+
 # UDP Autodiscovery Handler (MARCO → POLO)
 class AutodiscoveryProtocol(asyncio.DatagramProtocol):
     def __init__(self):
@@ -103,14 +257,42 @@ class AutodiscoveryProtocol(asyncio.DatagramProtocol):
             return "127.0.0.1"
 
 # Server launcher
-async def start_gateway_servers(recv_queue: asyncio.Queue):
+async def start_tcp_server(recv_queue: asyncio.Queue, host: str = comm_host, port: int = comm_port,
+                           transport: str = transport_mode, reuse_port: bool = False):
+    """
+    Start the MI TCP listener using either the buffered or the stream transport.
+
+    With ``reuse_port`` the socket is bound with SO_REUSEPORT so several
+    worker processes can share ``comm_port`` and the kernel spreads
+    incoming gateway connections between them.
+    """
+    if transport == "stream":
+        return await asyncio.start_server(
+            lambda r, w: handle_tcp_connection(r, w, recv_queue),
+            host=host,
+            port=port,
+            reuse_port=reuse_port or None
+        )
+
+    loop = asyncio.get_running_loop()
+    return await loop.create_server(
+        lambda: GatewayProtocol(recv_queue),
+        host=host,
+        port=port,
+        reuse_port=reuse_port or None
+    )
+
+
+async def start_gateway_servers(recv_queue: asyncio.Queue, reuse_port: bool = False, autodiscovery: bool = True):
     # Start TCP server
-    tcp_server = await asyncio.start_server(
-        lambda r, w: handle_tcp_connection(r, w, recv_queue),
-        host=comm_host,
-        port=comm_port
+    tcp_server = await start_tcp_server(recv_queue, reuse_port=reuse_port)
+    logger.info(
+        f"[TCP] Gateway TCP server ({transport_mode}) listening on {comm_host}:{comm_port}"
+        + (" (SO_REUSEPORT)" if reuse_port else "")
     )
-    logger.info(f"[TCP] Gateway TCP server listening on {comm_host}:{comm_port}")
+
+    if not autodiscovery:
+        return tcp_server, None
 
     # Start UDP autodiscovery
     loop = asyncio.get_running_loop()
@@ -8,25 +8,36 @@ collector, and async handler chain (BSON → Compression → Pitcher).
 """
 
 import asyncio
+import collections
 import os
 import random
 import shutil
 import time
 from datetime import datetime, time as dtime, timedelta, timezone, UTC
 from bson import BSON
+from nats.aio.client import Client as NATS
 from DAQ.commands.protocol import Message, DataIndication
-from DAQ.commands.strategy import CMD_FUNCS, MeshCommands
+from DAQ.commands.strategy import CMD_FUNCS, MeshCommands, call, command, is_macaddr, validate
 from DAQ.util.handlers.common import (
     BSONHandler,
     CompressionHandler,
     HandlerManager,
     IHandler,
+    make_queue,
 )
+from DAQ.util.handlers.deadband import DeadbandHandler
+from DAQ.util.handlers.localcache import LocalCache, RedisBackingStore
+from DAQ.util.handlers.rollup import RollupHandler
 from DAQ.services.core.data.pitcher import Pitcher
 from DAQ.services.core.collector.collector import DeviceCollector
-from DAQ.util.config import load_config
+from DAQ.util.compression import get_codec
+from DAQ.util.config import get_redis_conn, get_topic, load_config
 from DAQ.util.hex import _h
+from DAQ.util.history import encode_reply, epoch_seconds, make_history
+from DAQ.util.spool import make_spool
+from DAQ.util import tracing
 from DAQ.util.logger import make_logger
+from DAQ.util.metrics import register_stage
 from DAQ.util.process.base import ProcessBase
 from DAQ.gateway.manager import GatewayManager
 
@@ -66,25 +77,46 @@ def sunrise_today():
 class DAQProcess(ProcessBase, MeshCommands):
     MAX_REQUEST_ID = 65535
 
-    def __init__(self):
+    def __init__(self, worker_index: int = 0, workers: int = 1):
         super().__init__()
         self.logger = make_logger(self.__class__.__name__)
+        # In multi-worker mode every worker shares comm_port via SO_REUSEPORT;
+        # only worker 0 answers autodiscovery and polls local devices.
+        self.worker_index = worker_index
+        self.workers = workers
+        self.is_primary = worker_index == 0
         self._request_id = random.randrange(0, self.MAX_REQUEST_ID)
         self._make_map()
         self.sunrise = sunrise_today()
         self.requests = {}
         self.last_device_data = {}
+        # Last hours of samples per MAC, queried with the query_history
+        # command (NATS request/reply on command_topic) or GET /history
+        self.history = make_history(f"worker{worker_index}")
+        self.command_nats = None
+        # Records emitted by sync command handlers, awaited into the BSON
+        # queue so a full queue backs up recv_queue instead of piling up tasks
+        self.outbox = collections.deque()
+
+        # Config
+        self.throttle_delay = cfg.get("daq", {}).get("throttle_delay", 0.01)
 
         # Gateway
-        self.recv_queue: asyncio.Queue = asyncio.Queue()
+        self.recv_queue: asyncio.Queue = make_queue("recv")
+        self.recv_metrics = register_stage("recv", self.recv_queue)
         self.gateway_manager = GatewayManager(
             cfg['gateway']['comm_host'],
             cfg['gateway']['comm_port'],
             self.recv_queue,
+            reuse_port=workers > 1,
+            autodiscovery=self.is_primary,
         )
 
-        # Handler chain: BSON → Compression → Pitcher
-        self.pitcher = Pitcher(IHandler.GENERIC)
+        # Handler chain: BSON → Compression → Pitcher. In columnar and
+        # timeseries batch formats records skip per-record BSON and go
+        # straight to Compression.
+        self.batch_format = cfg.get("daq", {}).get("batch_format", CompressionHandler.FORMAT_COLUMNAR)
+        self.pitcher = Pitcher(IHandler.GENERIC, spool=make_spool(f"worker{worker_index}/Pitcher"))
         self.compression = CompressionHandler(IHandler.COMPILER)
         self.bson_handler = BSONHandler(IHandler.COMPILER)
 
@@ -93,24 +125,80 @@ class DAQProcess(ProcessBase, MeshCommands):
         self.compression.processed_queue = self.pitcher.data_queue
 
         self.handler_manager = HandlerManager()
-        self.handler_manager.add_handler(self.bson_handler)
+        self.compression.set('format', self.batch_format)
+        self.record_queue = self._entry_queue(self.bson_handler, self.compression)
+
+        # Report-by-exception: records within deadband of the last one sent
+        # for their device are dropped before batching
+        self.deadband = None
+        if (cfg.get("daq", {}).get("deadband") or {}).get("enabled", False):
+            self.deadband = DeadbandHandler(IHandler.COMPILER)
+            self.deadband.processed_queue = self.record_queue
+            self.record_queue = self.deadband.data_queue
+
+        # Rollups: 1/5-minute aggregates emitted into the same chain. The
+        # stage sits in front of it (and of the deadband, so aggregates see
+        # every sample), so records enter on its queue instead
+        self.rollup = None
+        rollup_cfg = cfg.get("daq", {}).get("rollup") or {}
+        if rollup_cfg.get("enabled", False):
+            self.rollup = RollupHandler(IHandler.COMPILER, cache=self._rollup_cache(rollup_cfg.get("cache") or {}))
+            self.rollup.processed_queue = self.record_queue
+            self.record_queue = self.rollup.data_queue
+
+        # Registered head-first: the manager stops stages in this order, so
+        # each one drains into stages that are still running
+        for handler in (self.rollup, self.deadband):
+            if handler is not None:
+                self.handler_manager.add_handler(handler)
+        if self.batch_format == CompressionHandler.FORMAT_BSON:
+            self.handler_manager.add_handler(self.bson_handler)
         self.handler_manager.add_handler(self.compression)
         self.handler_manager.add_handler(self.pitcher)
 
+        # Priority lane: fault-bearing records skip batching and go out on
+        # their own subject over a separate connection
+        prio_cfg = cfg.get("daq", {}).get("priority", {})
+        self.priority_enabled = prio_cfg.get("enabled", True)
+        self.priority_op_mask = prio_cfg.get("op_stat_mask", 0)
+        self.priority_reg_mask = prio_cfg.get("reg_stat_mask", 0)
+        if self.priority_enabled:
+            self.priority_pitcher = Pitcher(
+                IHandler.GENERIC, name="priority.Pitcher", subject=get_topic("external_priority"),
+                spool=make_spool(f"worker{worker_index}/priority.Pitcher"),
+            )
+            self.priority_compression = CompressionHandler(IHandler.COMPILER, name="priority.CompressionHandler")
+            self.priority_bson_handler = BSONHandler(IHandler.COMPILER, name="priority.BSONHandler")
+
+            self.priority_bson_handler.processed_queue = self.priority_compression.data_queue
+            self.priority_compression.processed_queue = self.priority_pitcher.data_queue
+            self.priority_compression.set('batch_on', 1)
+            self.priority_compression.set('batch_at', 0)
+            self.priority_compression.set('format', self.batch_format)
+            self.priority_record_queue = self._entry_queue(self.priority_bson_handler, self.priority_compression)
+
+            if self.batch_format == CompressionHandler.FORMAT_BSON:
+                self.handler_manager.add_handler(self.priority_bson_handler)
+            self.handler_manager.add_handler(self.priority_compression)
+            self.handler_manager.add_handler(self.priority_pitcher)
+
         # Collector (devices → raw payloads)
         self.collector = DeviceCollector()
         self.collector_manager = HandlerManager()
         self.collector_manager.add_handler(self.collector)
 
-        # Config
-        self.throttle_delay = cfg.get("daq", {}).get("throttle_delay", 0.01)
-        self.backpressure_threshold = cfg.get("daq", {}).get("backpressure_qsize", 10)
-
         # Configure compression
         try:
             comp_cfg = cfg.get("daq", {}).get("compression", {})
             self.compression.set('batch_on', comp_cfg.get("batch_on", 4))
             self.compression.set('batch_at', comp_cfg.get("batch_at", 0.5))
+            self.compression.set('codec', get_codec(comp_cfg.get("codec")).name)
+            self.compression.set('executor', comp_cfg.get("executor", CompressionHandler.INLINE))
+            self.compression.set('executor_workers', comp_cfg.get("executor_workers"))
+            self.compression.set('drain_timeout', comp_cfg.get("drain_timeout", 10))
+            if self.priority_enabled:
+                # Single-record batches: cheaper inline than a pool round trip
+                self.priority_compression.set('codec', self.compression.get('codec'))
         except Exception as e:
             self.logger.exception("Failed to configure compression handler")
 
@@ -127,6 +215,34 @@ class DAQProcess(ProcessBase, MeshCommands):
         except Exception as e:
             self.logger.warning("Could not set irradiance conversion: %s", e)
 
+        devices_cfg = cfg.get('devices') or {}
+        for key in ('report_interval', 'max_concurrency', 'io_workers', 'jitter'):
+            if devices_cfg.get(key) is not None:
+                self.collector.set(key, devices_cfg[key])
+        # Device readings join gateway records at the head of the chain
+        self.collector.processed_queue = self.record_queue
+
+    def _rollup_cache(self, cache_cfg):
+        """Write-back Redis cache for rollup filter state, if enabled."""
+        if not cache_cfg.get("enabled", False):
+            return None
+        try:
+            backing_store = RedisBackingStore(get_redis_conn(db=cache_cfg.get("db")))
+        except Exception as e:
+            self.logger.warning("Rollup cache disabled: %s", e)
+            return None
+        return LocalCache(
+            backing_store=backing_store,
+            max_items=cache_cfg.get("max_items", 10000),
+            flush_interval=cache_cfg.get("flush_interval", 30.0),
+        )
+
+    def _entry_queue(self, bson_handler, compression):
+        """Queue that record dicts enter the chain on for the configured batch format."""
+        if self.batch_format == CompressionHandler.FORMAT_BSON:
+            return bson_handler.data_queue
+        return compression.data_queue
+
     def _make_map(self):
         self.CMD_MAPPER = {name: getattr(self, name) for name in CMD_FUNCS if hasattr(self, name)}
 
@@ -143,7 +259,10 @@ class DAQProcess(ProcessBase, MeshCommands):
         self.logger.info("DAQProcess starting gateway and handlers")
         await self.gateway_manager.start()
         await self.handler_manager.start()
-        await self.collector_manager.start()
+        if self.is_primary:
+            await self.collector_manager.start()
+        if self.history is not None:
+            await self.start_command_listener()
 
     async def stop(self):
         self.logger.info("DAQProcess stopping...")
@@ -159,7 +278,17 @@ class DAQProcess(ProcessBase, MeshCommands):
             await self.gateway_manager.stop()
         except Exception:
             self.logger.exception("gateway_manager stop failed")
-        cleanup_temp_files()
+        if self.command_nats is not None:
+            try:
+                await self.command_nats.close()
+            except Exception:
+                self.logger.exception("command listener close failed")
+            self.command_nats = None
+        if self.history is not None:
+            self.history.close()
+        # Workers must not sweep /tmp: the coordinator still holds its lock file there
+        if self.workers == 1:
+            cleanup_temp_files()
 
     async def run(self):
         await self.start()
@@ -167,7 +296,9 @@ class DAQProcess(ProcessBase, MeshCommands):
             self.logger.info("DAQProcess entering async run loop...")
             while True:
                 payload = await self.recv_queue.get()
+                started = time.perf_counter()
                 await self.process_gateway_indication(payload)
+                self.recv_metrics.processed(time.perf_counter() - started)
         except asyncio.CancelledError:
             self.logger.info("DAQProcess cancelled.")
         finally:
@@ -179,7 +310,7 @@ class DAQProcess(ProcessBase, MeshCommands):
 
     async def process_gateway_indication(self, payload):
         if isinstance(payload, dict):
-            await self.bson_handler.data_queue.put(payload)
+            await self.record_queue.put(payload)
             return
 
         try:
@@ -189,21 +320,124 @@ class DAQProcess(ProcessBase, MeshCommands):
             return
 
         if msg_type == Message.MESH_INDICATION:
-            try:
-                msg = Message.from_raw(msg_type, length, raw, received_on)
-            except Exception:
-                self.logger.critical(
-                    "Unable to parse MESH_INDICATION: [%s,%s,%s]"
-                    % (msg_type, length, _h(raw))
-                )
-                return
+            if isinstance(raw, Message):
+                # Already decoded by the gateway transport
+                msg = raw
+            else:
+                try:
+                    msg = Message.decode(raw, received_on)
+                except Exception:
+                    self.logger.critical(
+                        "Unable to parse MESH_INDICATION: [%s,%s,%s]"
+                        % (msg_type, length, _h(raw))
+                    )
+                    return
             for command in msg.commands:
                 self.command_response(command, gwid)
+            await self.flush_outbox()
 
         elif msg_type == Message.COMMAND_REQUEST:
             cmd_req = BSON(raw).decode()
             self.dispatch_command_request(cmd_req, gwid=gwid)
 
+    # ---------------------
+    # Command requests over NATS
+    # ---------------------
+
+    @staticmethod
+    def worker_command_topic(topic, worker_index):
+        return f"{topic}.worker{worker_index}"
+
+    async def start_command_listener(self):
+        """
+        Answer BSON ``{func, args}`` requests on command_topic (request/reply).
+        Only the primary subscribes to command_topic, so every request gets
+        exactly one reply; the other workers listen on their own
+        ``<command_topic>.worker<N>`` subject for the primary's lookups.
+        """
+        topic = get_topic("command")
+        if not topic:
+            return
+        if not self.is_primary:
+            topic = self.worker_command_topic(topic, self.worker_index)
+        self.command_nats = NATS()
+        try:
+            await self.command_nats.connect(servers=[cfg["nats"]["server"]], max_reconnect_attempts=-1)
+            await self.command_nats.subscribe(topic, cb=self.handle_command_message)
+            self.logger.info(f"[COMMAND] Listening for requests on {topic}")
+        except Exception as e:
+            self.logger.error(f"[COMMAND] Cannot listen on {topic}: {e}")
+            self.command_nats = None
+
+    async def handle_command_message(self, msg):
+        try:
+            cmd_req = BSON(msg.data).decode()
+        except Exception as e:
+            self.logger.warning(f"[COMMAND] Undecodable request: {e}")
+            cmd_req, result = {}, {"status": False, "msg": f"Undecodable request: {e}"}
+        else:
+            result = self.dispatch_command_request(cmd_req)
+            # None: not held by this worker (e.g. a MAC it has no history for)
+            if result is None and self.is_primary and self.workers > 1:
+                result = await self.ask_workers(msg.data)
+            if result is None:
+                result = {"status": False, "msg": "Not found"}
+        if msg.reply:
+            try:
+                await self.command_nats.publish(msg.reply, BSON.encode(result))
+            except Exception as e:
+                self.logger.error(f"[COMMAND] Cannot reply to {cmd_req.get('func')}: {e}")
+
+    async def ask_workers(self, data):
+        """Forward a request the primary could not answer; the first successful reply wins."""
+        topic = get_topic("command")
+        timeout = cfg.get("daq", {}).get("history", {}).get("peer_timeout", 2.0)
+        requests = [
+            asyncio.ensure_future(
+                self.command_nats.request(self.worker_command_topic(topic, index), data, timeout=timeout))
+            for index in range(1, self.workers)
+        ]
+        try:
+            for request in asyncio.as_completed(requests):
+                try:
+                    result = BSON((await request).data).decode()
+                except Exception as e:
+                    self.logger.debug(f"[COMMAND] No answer from a worker: {e}")
+                    continue
+                if result.get("status"):
+                    return result
+            return None
+        finally:
+            for request in requests:
+                request.cancel()
+
+    def emit(self, payload, priority=False):
+        """Queue a record for the BSON chain (delivered by flush_outbox)."""
+        self.outbox.append((payload, priority and self.priority_enabled))
+
+    async def flush_outbox(self):
+        while self.outbox:
+            payload, priority = self.outbox.popleft()
+            queue = self.priority_record_queue if priority else self.record_queue
+            if tracing.enabled and isinstance(payload, dict) and tracing.TRACE_KEY in payload:
+                tracing.stamp(payload[tracing.TRACE_KEY], tracing.ENQUEUE)
+            if priority and self.rollup is not None:
+                # Fast-lane records still count towards the aggregates
+                self.rollup.observe(payload)
+            if priority and self.deadband is not None:
+                # ...and are what the cloud last saw for the device
+                self.deadband.note_sent(payload)
+            await queue.put(payload)
+
+    def is_priority(self, cmd, response):
+        """A record takes the fast lane if its frame is PRIOR or it carries an alarm."""
+        header = cmd.header
+        return bool(
+            (header is not None and header.mesh_ctrl.prior)
+            or response.get('op_stat', 0) & self.priority_op_mask
+            or response.get('reg_stat', 0) & self.priority_reg_mask
+        )
+
     def command_response(self, cmd, gwid=None):
         response = cmd.response()
         self.dispatch_command_handlers(cmd, response)
@@ -253,6 +487,9 @@ class DAQProcess(ProcessBase, MeshCommands):
         if 'reg_stat' not in response or 'op_stat' not in response:
             return False
 
+        priority = self.is_priority(cmd, response)
+        trace = getattr(cmd.header, 'trace', None)
+        payloads = []
         for data in response['data']:
             freezetime = self.from_seconds_since_sunrise(data['timestamp'])
             payload = dict(
@@ -271,8 +508,33 @@ class DAQProcess(ProcessBase, MeshCommands):
                 temperature=data.get('temperature', 0.0),
                 irradiance=data.get('irradiance', 0.0),
             )
+            if trace is not None:
+                payload[tracing.TRACE_KEY] = list(trace)
             # Push through pipeline
-            asyncio.create_task(self.bson_handler.data_queue.put(payload))
+            self.emit(payload, priority)
             self.last_device_data[payload['type']] = payload
+            payloads.append(payload)
 
+        if self.history is not None:
+            self.history.record(response['macaddr'], payloads)
         return True
+
+    # ---------------------
+    # Commands
+    # ---------------------
+
+    @command
+    @validate('macaddr', is_macaddr, cmp=call, required=True)
+    def query_history(self, macaddr=None, start=None, end=None, fields=None, limit=None):
+        """
+        Samples of ``macaddr`` between ``start`` and ``end`` (epoch seconds
+        or datetimes; negative numbers are relative to now) from the local
+        history, as little-endian column bytes (see DAQ.util.history).
+        """
+        if self.history is None:
+            return {"status": False, "msg": "History is disabled"}
+        now = time.time()
+        result = self.history.query(macaddr, epoch_seconds(start, now), epoch_seconds(end, now), fields, limit)
+        if result is None:
+            return None  # another worker may hold it; see handle_command_message
+        return encode_reply(macaddr.upper(), *result)
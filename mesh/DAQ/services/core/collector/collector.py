@@ -1,15 +1,58 @@
-import multiprocessing
+"""
+DeviceCollector
+---------------
+
+Polls locally attached devices (Modbus meters/inverters, weather stations)
+and feeds their readings into the record chain.
+
+Each device gets its own asyncio poll task on a fixed schedule of
+``interval`` seconds (per device, default ``devices.report_interval``).
+Connector I/O is blocking, so ``verify()``/``read_data()`` run on a bounded
+thread pool of ``io_workers``; at most ``max_concurrency`` reads are in
+flight at once. Start times are staggered and every tick is offset by up to
+``jitter * interval`` so devices sharing a bus do not all fire together.
+A read that is still running when its next tick is due counts as an
+overrun and the missed ticks are skipped rather than queued.
+
+Modbus devices share connections per endpoint (see
+``DAQ.devices.modbus.ModbusClientPool``). Reads wait for a slot on their bus
+before taking one of the ``max_concurrency`` slots, so devices queued on a
+busy serial bus never hold up devices on other buses, and throughput grows
+with the number of independent buses.
+
+  devices:
+    report_interval: 5
+    max_concurrency: 8
+    io_workers: 8
+    jitter: 0.1
+    modbus: {tcp_connections: 2, async_client: false}
+    all:
+      - {identifier: "SHARK 100", args: [], kwargs: {host: ..., port: 502}, interval: 10}
+"""
+
+import asyncio
+import concurrent.futures
 import json
 import math
+import random
+import time
+
 from DAQ.util.handlers.common import IHandler
 from DAQ.util.utctime import utcnow
 from DAQ.devices import connectors
+
+
 class DeviceCollector(IHandler):
 
     def __init__(self, *args, **kwargs):
         super(DeviceCollector, self).__init__(*args, **kwargs)
 
-        self.do_collecting = multiprocessing.Event()
+        self.do_collecting = asyncio.Event()
+        self.do_collecting.set()
+        self.executor = None
+        self._semaphore = None
+        self._bus_limits = {}
+        self._pollers = []
 
     def wake(self):
         self.do_collecting.set()
@@ -17,58 +60,151 @@ class DeviceCollector(IHandler):
     def sleep(self):
         self.do_collecting.clear()
 
-    def worker(self, data_queue, processed_queue):
-        devices_value = self.get('devices')
+    def build_connectors(self):
+        devices_value = self.get('devices') or []
         device_meta = json.loads(devices_value) if isinstance(devices_value, (str, bytes)) else devices_value
+        default_interval = self.get('report_interval', 5)
 
-        convert_irradiance = self.get('convert_irradiance', False)
-
-        device_connectors = []
-
+        devices = []
         for device in device_meta:
-            connector = connectors[device['identifier']]
+            connector = connectors.get(device['identifier'])
+            if connector is None:
+                self.logger.warning("Unknown device identifier %r; skipping" % device['identifier'])
+                continue
 
-            device_connector = connector(*device['args'], **device['kwargs'])
+            device_connector = connector(*device.get('args', []), **device.get('kwargs', {}))
             device_connector.logger = self.logger
-
-            device_connectors.append(device_connector)
-
-        while self._check_living():
-
-            if self.do_collecting.is_set():
-
-                for device in device_connectors:
-                    try:
-                        device.verify()
-                    except:
-                        device.verified = False
-
-                    self.logger.info("Verifying %s -- %s" % (device.__class__.__name__, getattr(device, 'verified')))
-
-                for device in device_connectors:
-                    if not device.verified:
-                        continue
-
-                    self.logger.info("Reading %s" % (device.__class__.__name__))
-                    data = device.read_data()
-
-                    if data is not None:
-
-                        if convert_irradiance \
-                        and 'irradiance' in data \
-                        and data['irradiance'] is not None \
-                        and not math.isnan(data['irradiance']):
-                            data['irradiance'] = data['irradiance'] * 1000.0
-
-                        data['freezetime'] = utcnow()
-                        data['type'] = device.__dtype__
-
-                        # for k in data:
-                        #     self.logger.info('%s = %s' % (k, data[k]))
-
-                        self.processed_queue.put(data)
-
-
-
-        for device in device_connectors:
-            device.close()
+            devices.append((device_connector, float(device.get('interval', default_interval))))
+
+        return devices
+
+    def read_device(self, device):
+        """Blocking verify/read of one device; runs on the I/O pool."""
+        if not getattr(device, 'verified', False):
+            try:
+                device.verify()
+            except Exception:
+                device.verified = False
+            self.logger.info("Verifying %s -- %s" % (device.__class__.__name__, getattr(device, 'verified')))
+            if not device.verified:
+                return None
+
+        try:
+            data = device.read_data()
+        except Exception:
+            # Re-verify (and reconnect) before the next read
+            device.verified = False
+            raise
+
+        if data is None:
+            return None
+
+        if self.get('convert_irradiance', False) \
+        and 'irradiance' in data \
+        and data['irradiance'] is not None \
+        and not math.isnan(data['irradiance']):
+            data['irradiance'] = data['irradiance'] * 1000.0
+
+        data['freezetime'] = utcnow()
+        data['type'] = device.__dtype__
+        return data
+
+    def bus_limit(self, device):
+        """Admission semaphore for the Modbus bus behind ``device`` (None if it has none)."""
+        bus = getattr(getattr(device, 'client', None), 'bus', None)
+        if bus is None:
+            return None
+        limit = self._bus_limits.get(bus.key)
+        if limit is None:
+            limit = self._bus_limits[bus.key] = asyncio.Semaphore(bus.size)
+        return limit
+
+    async def read(self, device):
+        loop = asyncio.get_running_loop()
+        async with self._semaphore:
+            return await loop.run_in_executor(self.executor, self.read_device, device)
+
+    async def poll(self, device, interval):
+        name = device.__class__.__name__
+        jitter = self.get('jitter', 0.1) * interval
+        bus_limit = self.bus_limit(device)
+
+        next_at = time.monotonic() + random.uniform(0, interval)
+        while self._running:
+            await asyncio.sleep(max(0.0, next_at - time.monotonic()) + random.uniform(0, jitter))
+            await self.do_collecting.wait()
+
+            started = time.perf_counter()
+            try:
+                if bus_limit is None:
+                    data = await self.read(device)
+                else:
+                    async with bus_limit:
+                        data = await self.read(device)
+            except Exception as e:
+                self.set('poll_errors', self.get('poll_errors', 0) + 1)
+                self.logger.warning("Reading %s failed: %s" % (name, e))
+                data = None
+            self.metrics.processed(time.perf_counter() - started)
+            self.set('polls', self.get('polls', 0) + 1)
+
+            if data is not None:
+                await self.processed_queue.put(data)
+
+            next_at += interval
+            behind = time.monotonic() - next_at
+            if behind > 0:
+                missed = math.ceil(behind / interval)
+                next_at += missed * interval
+                self.set('overruns', self.get('overruns', 0) + missed)
+                self.logger.debug("%s overran its %.1fs interval; skipped %d tick(s)" % (name, interval, missed))
+
+    def load_modbus(self):
+        """
+        Import the Modbus connectors (registering them in ``connectors``) and
+        bind the shared pool to this loop. Deferred to here so pymodbus is
+        only needed when local devices are configured.
+        """
+        try:
+            from DAQ.devices.modbus import get_modbus_pool
+        except ImportError as e:
+            self.logger.warning("Modbus devices unavailable: %s" % e)
+            return None
+        pool = get_modbus_pool()
+        pool.bind_loop(asyncio.get_running_loop())
+        return pool
+
+    async def run(self):
+        if not self.get('devices'):
+            self.logger.info("No local devices configured")
+            return
+
+        modbus_pool = self.load_modbus()
+        devices = self.build_connectors()
+        if not devices:
+            self.logger.info("None of the configured local devices are available")
+            return
+
+        io_workers = self.get('io_workers', 8)
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=io_workers, thread_name_prefix=self.name)
+        self._semaphore = asyncio.Semaphore(self.get('max_concurrency', io_workers))
+        self._pollers = [
+            asyncio.create_task(self.poll(device, interval), name=f"{self.name}.{device.__class__.__name__}")
+            for device, interval in devices
+        ]
+        self.logger.info("Polling %d device(s) on %d Modbus bus(es) with %d I/O worker(s)"
+                         % (len(devices), len(modbus_pool.buses) if modbus_pool else 0, io_workers))
+
+        try:
+            await asyncio.gather(*self._pollers)
+        finally:
+            for poller in self._pollers:
+                poller.cancel()
+            for device, _ in devices:
+                try:
+                    device.close()
+                except Exception:
+                    pass
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
@@ -5,13 +5,47 @@ Pitcher Handler
 
 Async handler that publishes payloads to an external NATS server.
 Designed to integrate with the async handler framework (IHandler).
+
+Publishing is pipelined: each iteration drains up to ``max_batch`` queued
+payloads, publishes them, and flushes the NATS connection once. Throughput
+is shaped by token buckets in bytes/s and messages/s instead of a fixed
+sleep per message:
+
+  daq:
+    publish:
+      rate_bytes: 0        # bytes/s (0 = unlimited)
+      rate_messages: 0     # messages/s (0 = unlimited)
+      burst: 1.0           # seconds of rate allowed as a burst
+      max_batch: 64        # payloads per flush
+
+With a spool (see DAQ.util.spool) payloads are stored on disk instead of
+dropped while the uplink is down, when a publish fails, or when the queue is
+deeper than ``daq.spool.queue_threshold``. Once anything is spooled, new
+payloads are appended behind it so delivery stays in order; a replay task
+publishes the spool oldest-first and acknowledges each batch after the NATS
+flush confirms the server has it.
+
+With ``daq.jetstream.enabled`` payloads are published to a JetStream stream
+instead of core NATS, for at-least-once delivery. Up to ``max_inflight``
+publishes await their PubAck concurrently in one sliding window that lives
+across batches: a new payload goes out as soon as any earlier one is
+acknowledged, so a slow ack only holds its own slot. Each publish carries a
+``Nats-Msg-Id`` derived from the payload's sequence number (or spool
+position) so the stream drops duplicates. Only the unacknowledged payloads
+are retried; what is still unacknowledged after ``max_retries`` goes to the
+spool.
 """
 
 import asyncio
+import socket
+import time
 from nats.aio.client import Client as NATS
+from nats.js.errors import NotFoundError
 from DAQ.util.handlers.common import IHandler
 from DAQ.util.logger import make_logger
 from DAQ.util.config import get_topic, load_config
+from DAQ.util.ratelimit import TokenBucket
+from DAQ.util import tracing
 
 
 cfg = load_config()
@@ -19,25 +53,82 @@ logger = make_logger("Pitcher")
 
 external_server = cfg["nats"]["external_publish_server"]
 external_topic = get_topic("external_mesh")
+publish_cfg = cfg.get("daq", {}).get("publish", {})
+spool_cfg = cfg.get("daq", {}).get("spool") or {}
+jetstream_cfg = cfg.get("daq", {}).get("jetstream") or {}
+
+
+class PublishError(Exception):
+    """Some payloads of a batch were not acknowledged; ``unacked`` lists them."""
+
+    def __init__(self, message, unacked):
+        super().__init__(message)
+        self.unacked = unacked
 
 
 class Pitcher(IHandler):
     """Publishes messages from its data_queue to an external NATS subject."""
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, subject=None, spool=None, **kwargs):
         super().__init__(*args, **kwargs)
 
         self.logger = make_logger(self.__class__.__name__)
         self.ext_nats = NATS()
         self.connected = False
-        self.subject = external_topic
-        self.throttle_delay = cfg.get("daq", {}).get("throttle_delay", 0.01)
+        self.subject = subject or external_topic
+
+        burst = publish_cfg.get("burst", 1.0)
+        self.byte_bucket = TokenBucket(publish_cfg.get("rate_bytes", 0), burst)
+        self.message_bucket = TokenBucket(publish_cfg.get("rate_messages", 0), burst)
+        self.max_batch = publish_cfg.get("max_batch", 64)
+        self.flush_timeout = publish_cfg.get("flush_timeout", 5.0)
+
+        self._window_start = time.monotonic()
+        self._window_messages = 0
+        self._window_bytes = 0
+
+        self.spool = spool
+        self.spool_threshold = spool_cfg.get("queue_threshold", 400)
+        self.replay_interval = spool_cfg.get("replay_interval", 1.0)
+        self._replayer: asyncio.Task | None = None
+
+        self.js = None
+        self.jetstream = jetstream_cfg.get("enabled", False)
+        self.max_inflight = jetstream_cfg.get("max_inflight", 64)
+        self.ack_timeout = jetstream_cfg.get("ack_timeout", 5.0)
+        self.max_retries = jetstream_cfg.get("max_retries", 3)
+        self.msg_id_prefix = f"{jetstream_cfg.get('msg_id_prefix') or socket.gethostname()}.{self.name}"
+        # Live sequence numbers restart at 0, so the session keeps their
+        # IDs from colliding with the previous run inside the dedup window
+        self._session = int(time.time())
+        self._sequence = 0
+        # The in-flight window: one slot per publish awaiting its PubAck
+        self._window = asyncio.Semaphore(self.max_inflight)
+        self._acks: dict[asyncio.Task, tuple] = {}
 
     async def connect(self):
         if not self.connected:
-            await self.ext_nats.connect(servers=[external_server])
+            # Keep reconnecting forever; the spool covers the gap
+            await self.ext_nats.connect(servers=[external_server], max_reconnect_attempts=-1)
             self.connected = True
             self.logger.info(f"[Pitcher] Connected to external NATS at {external_server}")
+            if self.jetstream:
+                self.js = self.ext_nats.jetstream()
+                await self.ensure_stream()
+
+    async def ensure_stream(self):
+        stream = jetstream_cfg.get("stream")
+        if not stream:
+            return
+        try:
+            await self.js.stream_info(stream)
+        except NotFoundError:
+            subjects = jetstream_cfg.get("subjects") or [self.subject]
+            await self.js.add_stream(name=stream, subjects=subjects)
+            self.logger.info(f"[Pitcher] Created JetStream stream {stream} for {subjects}")
+
+    def uplink_ready(self):
+        return self.connected and self.ext_nats.is_connected
 
     async def disconnect(self):
         if self.connected:
@@ -48,23 +139,260 @@ class Pitcher(IHandler):
             self.connected = False
             self.logger.info("[Pitcher] Disconnected from NATS")
 
+    def _next_batch(self, first):
+        """
+        ``first`` plus whatever else is already queued, up to max_batch, as
+        ``(payload, queue_wait, msg_id)`` items.
+        """
+        batch = [(first, getattr(self.data_queue, "last_wait", 0.0), None)]
+        while len(batch) < self.max_batch and not self.data_queue.empty():
+            payload = self.data_queue.get_nowait()
+            batch.append((payload, getattr(self.data_queue, "last_wait", 0.0), None))
+        return batch
+
+    def _live_msg_id(self):
+        self._sequence += 1
+        return f"{self.msg_id_prefix}.{self._session}.{self._sequence}"
+
+    def _spool_msg_id(self, position):
+        segment, offset = position
+        return f"{self.msg_id_prefix}.spool.{segment}.{offset}"
+
+    async def _rate_limit(self, payload):
+        delay = max(self.message_bucket.reserve(1), self.byte_bucket.reserve(len(payload)))
+        if delay:
+            await asyncio.sleep(delay)
+
+    def _record_published(self, count, nbytes, waits):
+        self.set('published_messages', self.get('published_messages', 0) + count)
+        self.set('published_bytes', self.get('published_bytes', 0) + nbytes)
+        if waits:
+            self.set('queue_wait_last', waits[-1])
+            self.set('queue_wait_max', max(self.get('queue_wait_max', 0.0), max(waits)))
+
+        self._window_messages += count
+        self._window_bytes += nbytes
+        elapsed = time.monotonic() - self._window_start
+        if elapsed >= 1.0:
+            self.set('publish_rate_messages', self._window_messages / elapsed)
+            self.set('publish_rate_bytes', self._window_bytes / elapsed)
+            self._window_start += elapsed
+            self._window_messages = 0
+            self._window_bytes = 0
+
+    def _publishable(self, batch):
+        """Drop non-bytes payloads and give the rest a message ID."""
+        items = []
+        for payload, waited, msg_id in batch:
+            if not isinstance(payload, (bytes, bytearray)):
+                self.logger.warning(f"[Pitcher] Skipping non-bytes payload: {type(payload)}")
+                continue
+            items.append((payload, waited, msg_id or self._live_msg_id()))
+        return items
+
+    async def publish_batch(self, batch):
+        """Publish ``batch`` and return once all of it is flushed (or acknowledged)."""
+        items = self._publishable(batch)
+        if not items:
+            return
+
+        started = time.perf_counter()
+        if self.js is not None:
+            await self._publish_jetstream(items)
+        else:
+            for payload, _, _ in items:
+                await self._rate_limit(payload)
+                headers = tracing.publish_headers() if tracing.enabled else None
+                await self.ext_nats.publish(self.subject, payload, headers=headers)
+            await self.ext_nats.flush(timeout=self.flush_timeout)
+
+        self.metrics.processed((time.perf_counter() - started) / len(items), len(items))
+        nbytes = sum(len(payload) for payload, _, _ in items)
+        self._record_published(len(items), nbytes, [waited for _, waited, _ in items])
+        self.logger.debug(f"[Pitcher] Published {len(items)} payload(s), {nbytes} bytes → {self.subject}")
+
+    async def _publish_acked(self, item):
+        """
+        Publish one item and await its PubAck, retrying up to ``max_retries``
+        times. Returns whether the stream acknowledged the payload.
+        """
+        payload, _, msg_id = item
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                self.set('ack_retries', self.get('ack_retries', 0) + 1)
+                await asyncio.sleep(min(0.1 * 2 ** attempt, 2.0))
+            await self._rate_limit(payload)
+            headers = {"Nats-Msg-Id": msg_id}
+            if tracing.enabled:
+                headers.update(tracing.publish_headers())
+            try:
+                ack = await self.js.publish(self.subject, payload, timeout=self.ack_timeout, headers=headers)
+            except Exception as e:
+                self.logger.debug(f"[Pitcher] No PubAck for {msg_id}: {e}")
+                continue
+            if ack.duplicate:
+                self.set('duplicates', self.get('duplicates', 0) + 1)
+            return True
+        return False
+
+    async def _in_window(self, coro, name):
+        """Start ``coro`` once a window slot is free; the slot is freed when it finishes."""
+        try:
+            await self._window.acquire()
+        except BaseException:
+            coro.close()
+            raise
+        task = asyncio.create_task(coro, name=name)
+        # A done callback also runs for a task cancelled before it started
+        task.add_done_callback(lambda _: self._window.release())
+        return task
+
+    async def _publish_jetstream(self, items):
+        """Publish ``items`` through the shared window and wait for all their acks."""
+        sends = []
+        try:
+            for item in items:
+                sends.append(await self._in_window(self._publish_acked(item), f"{self.name}.replay_ack"))
+            acked = await asyncio.gather(*sends)
+        except BaseException:
+            for send in sends:
+                send.cancel()
+            raise
+        unacked = [item for item, ok in zip(items, acked) if not ok]
+        if unacked:
+            raise PublishError(f"{len(unacked)} of {len(items)} publish(es) unacknowledged", unacked)
+
+    async def submit_jetstream(self, batch):
+        """
+        Hand live payloads to the in-flight window without waiting for their
+        acks; blocks only while the window is full. Each payload is accounted
+        for (or spooled) by its own ack task.
+        """
+        for item in self._publishable(batch):
+            task = await self._in_window(self._deliver(item), f"{self.name}.ack")
+            self._acks[task] = item
+            task.add_done_callback(self._retire)
+
+    def _retire(self, task):
+        self._acks.pop(task, None)
+
+    async def _deliver(self, item):
+        started = time.perf_counter()
+        if await self._publish_acked(item):
+            self.metrics.processed(time.perf_counter() - started)
+            self._record_published(1, len(item[0]), [item[1]])
+            return
+        self.set('publish_failures', self.get('publish_failures', 0) + 1)
+        if self.spool is not None:
+            self.logger.warning(f"[Pitcher] {item[2]} unacknowledged after {self.max_retries} retries; spooling it")
+            self.spool_batch([item])
+            self.spool.sync()
+        else:
+            self.logger.error(f"[Pitcher] {item[2]} unacknowledged after {self.max_retries} retries; dropping it")
+
+    async def drain_acks(self):
+        """Wait (bounded) for in-flight live publishes; spool whatever is still unacknowledged."""
+        if not self._acks:
+            return
+        _, pending = await asyncio.wait(list(self._acks), timeout=self.ack_timeout * (self.max_retries + 1))
+        unacked = [self._acks[task] for task in pending if task in self._acks]
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        if unacked and self.spool is not None:
+            self.logger.warning(f"[Pitcher] Spooling {len(unacked)} unacknowledged payload(s) on stop")
+            self.spool_batch(unacked)
+
+    def _should_spool(self):
+        return self.spool is not None and (
+            self.spool.pending
+            or not self.uplink_ready()
+            or self.data_queue.qsize() > self.spool_threshold
+        )
+
+    def spool_batch(self, batch):
+        # A payload that was already published keeps its message ID, so a
+        # replay of one that landed after all is dropped by the stream
+        for payload, _, msg_id in batch:
+            if isinstance(payload, (bytes, bytearray)):
+                self.spool.append(payload, key=msg_id)
+        self._record_spool()
+
+    def _record_spool(self):
+        for key, value in self.spool.stats().items():
+            self.set(f'spool_{key}', value)
+
+    async def replay(self):
+        """Drain the spool oldest-first whenever the uplink is up."""
+        while self._running:
+            try:
+                if not self.connected:
+                    await self.connect()
+                if not self.spool.pending or not self.uplink_ready():
+                    await asyncio.sleep(self.replay_interval)
+                    continue
+                # Replays reuse the ID a payload was first published under (or
+                # one derived from its spool position), so a partial JetStream
+                # failure replays without duplicating what landed
+                entries, cursor = self.spool.read(self.max_batch)
+                await self.publish_batch([
+                    (payload, 0.0, msg_id or self._spool_msg_id(position)) for position, msg_id, payload in entries
+                ])
+                self.spool.ack(cursor)
+                self._record_spool()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.set('replay_failures', self.get('replay_failures', 0) + 1)
+                self.logger.warning(f"[Pitcher] Spool replay failed: {e}")
+                await asyncio.sleep(self.replay_interval)
+
     async def run(self):
-        await self.connect()
+        if self.spool is None:
+            await self.connect()
+        else:
+            # Connecting may block until the uplink is back; spool meanwhile
+            self._replayer = asyncio.create_task(self.replay(), name=f"{self.name}.replay")
+
         try:
             while self._running:
-                try:
-                    # Wait for next payload
-                    payload = await asyncio.wait_for(self.data_queue.get(), timeout=1.0)
-                    if not isinstance(payload, (bytes, bytearray)):
-                        self.logger.warning(f"[Pitcher] Skipping non-bytes payload: {type(payload)}")
-                        continue
-                    await self.ext_nats.publish(self.subject, payload)
-                    self.logger.debug(f"[Pitcher] Published {len(payload)} bytes → {self.subject}")
-                    await asyncio.sleep(self.throttle_delay)
-                except asyncio.TimeoutError:
+                payload = await self.data_queue.get()
+                batch = self._next_batch(payload)
+                if self._should_spool():
+                    self.spool_batch(batch)
+                    if self.data_queue.empty():
+                        self.spool.sync()  # group commit once the queue is drained
                     continue
+                try:
+                    if self.js is not None:
+                        await self.submit_jetstream(batch)
+                    else:
+                        await self.publish_batch(batch)
                 except Exception as e:
-                    self.logger.error(f"[Pitcher] Publish failed: {e}", exc_info=True)
-                    await asyncio.sleep(1.0)  # backoff before retry
+                    self.set('publish_failures', self.get('publish_failures', 0) + 1)
+                    if self.spool is not None:
+                        unacked = getattr(e, 'unacked', batch)
+                        self.logger.warning(f"[Pitcher] Publish failed ({e}); spooling {len(unacked)} payload(s)")
+                        self.spool_batch(unacked)
+                        self.spool.sync()
+                    else:
+                        self.logger.error(f"[Pitcher] Publish failed: {e}", exc_info=True)
+                        await asyncio.sleep(1.0)  # backoff before retry
         finally:
+            await self.drain_acks()
             await self.disconnect()
+
+    async def stop(self):
+        if self._replayer:
+            self._replayer.cancel()
+            try:
+                await self._replayer
+            except asyncio.CancelledError:
+                pass
+            self._replayer = None
+        await super().stop()
+        if self.spool is not None:
+            # Keep whatever is still queued for the next start
+            while not self.data_queue.empty():
+                self.spool_batch([(self.data_queue.get_nowait(), 0.0, None)])
+            self.spool.close()
@@ -11,19 +11,153 @@ All handlers are asyncio-native and use asyncio.Queue for data flow.
 """
 
 import asyncio
+import collections
+import concurrent.futures
+import multiprocessing
+import os
 import time
-import bz2
+import numpy as np
 from bson import BSON
+from DAQ.util import compression, timeseries, tracing
+from DAQ.util.batch import encode_batch
+from DAQ.util.config import load_config
 from DAQ.util.logger import make_logger
+from DAQ.util.metrics import Histogram, register_stage
 from DAQ.util.utctime import utcepochnow
 
 
+# ---------------------
+# Bounded pipeline queues
+# ---------------------
+
+def mac_key(item):
+    """Coalescing key for pipeline items: the MAC address, if there is one."""
+    if isinstance(item, dict):
+        return item.get('macaddr')
+    if isinstance(item, tuple) and len(item) == 5:
+        # Gateway indication: (gwid, msg_type, length, Message, received_on)
+        return getattr(item[3], 'addr', None)
+    return None
+
+
+class BoundedQueue(asyncio.Queue):
+    """
+    asyncio.Queue with an overload policy applied when it reaches maxsize.
+
+    - ``block``: ``put`` waits for space (``put_nowait`` raises QueueFull);
+      producers that cannot await use :meth:`wait_for_space` to pause.
+    - ``drop_oldest``: the oldest item is discarded to make room.
+    - ``coalesce``: a pending item with the same key (MAC) is replaced by the
+      new one in place; items without a pending twin fall back to drop_oldest.
+
+    ``drops`` and ``coalesced`` count what each policy discarded, ``puts``
+    counts accepted items, ``last_wait`` is how long the most recently
+    dequeued item sat queued and ``wait_histogram`` collects those waits.
+    """
+
+    BLOCK = 'block'
+    DROP_OLDEST = 'drop_oldest'
+    COALESCE = 'coalesce'
+    POLICIES = (BLOCK, DROP_OLDEST, COALESCE)
+
+    def __init__(self, maxsize=0, policy=BLOCK, key=mac_key, name=None):
+        if policy not in self.POLICIES:
+            raise ValueError(f"Unknown queue policy {policy!r}; expected one of {self.POLICIES}")
+        self.policy = policy
+        self.key = key
+        self.name = name
+        self.drops = 0
+        self.coalesced = 0
+        self.puts = 0
+        self.last_wait = 0.0
+        self.wait_histogram = Histogram()
+        self._space = asyncio.Event()
+        super().__init__(maxsize)
+
+    def _init(self, maxsize):
+        self._queue = collections.deque()
+        self._latest = {}
+
+    def _put(self, item):
+        key = self.key(item) if self.policy == self.COALESCE else None
+        slot = [key, item, time.monotonic()]
+        self._queue.append(slot)
+        self.puts += 1
+        if key is not None:
+            self._latest[key] = slot
+
+    def _get(self):
+        key, item, queued_at = slot = self._queue.popleft()
+        if key is not None and self._latest.get(key) is slot:
+            del self._latest[key]
+        self.last_wait = time.monotonic() - queued_at
+        self.wait_histogram.observe(self.last_wait)
+        self._space.set()
+        return item
+
+    def put_nowait(self, item):
+        if self.policy != self.BLOCK and self.full():
+            if self.policy == self.COALESCE:
+                slot = self._latest.get(self.key(item))
+                if slot is not None:
+                    slot[1] = item
+                    self.coalesced += 1
+                    self.puts += 1
+                    return
+            self.get_nowait()
+            self.task_done()
+            self.drops += 1
+        super().put_nowait(item)
+
+    async def put(self, item):
+        if self.policy == self.BLOCK:
+            return await super().put(item)
+        return self.put_nowait(item)
+
+    async def wait_for_space(self):
+        """Wait until the queue can accept at least one item."""
+        while self.full():
+            self._space.clear()
+            await self._space.wait()
+
+    def stats(self):
+        return {
+            'name': self.name,
+            'policy': self.policy,
+            'qsize': self.qsize(),
+            'maxsize': self.maxsize,
+            'drops': self.drops,
+            'coalesced': self.coalesced,
+        }
+
+
+def make_queue(stage, maxsize=None, policy=None):
+    """
+    Build the queue for a pipeline ``stage`` from config.yaml:
+
+      daq:
+        backpressure_qsize: 1000     # default maxsize for every stage
+        queues:
+          <stage>: {maxsize: ..., policy: block | drop_oldest | coalesce}
+    """
+    daq_cfg = load_config().get("daq", {})
+    stage_cfg = (daq_cfg.get("queues") or {}).get(stage) or {}
+    if maxsize is None:
+        maxsize = stage_cfg.get("maxsize", daq_cfg.get("backpressure_qsize", 0))
+    if policy is None:
+        policy = stage_cfg.get("policy", BoundedQueue.BLOCK)
+    return BoundedQueue(int(maxsize or 0), policy=policy, name=stage)
+
+
 # ---------------------
 # HandlerManager
 # ---------------------
 
 class HandlerManager:
-    """Manages a set of async IHandler instances."""
+    """
+    Manages a set of async IHandler instances. Handlers are started and
+    stopped in the order they were added, so a chain is added upstream first.
+    """
 
     def __init__(self):
         self.handlers = []
@@ -55,12 +189,15 @@ class IHandler:
     def __init__(self, handler_type=GENERIC, **kwargs):
         self.handler_type = handler_type
         self.kwargs = kwargs
+        self.name = kwargs.get('name', self.__class__.__name__)
         self.logger = make_logger(self.__class__.__name__)
         self.state = {}
 
-        # Async data flow
-        self.data_queue: asyncio.Queue = asyncio.Queue()
-        self.processed_queue: asyncio.Queue = asyncio.Queue()
+        # Async data flow (bounded per config; processed_queue is usually
+        # rewired to the next stage's data_queue)
+        self.data_queue: asyncio.Queue = make_queue(self.name)
+        self.processed_queue: asyncio.Queue = make_queue(self.name)
+        self.metrics = register_stage(self.name, self.data_queue, self.state)
 
         # Internal lifecycle
         self._task: asyncio.Task | None = None
@@ -127,7 +264,9 @@ class BSONHandler(IHandler):
                 if not isinstance(payload, dict):
                     self.logger.warning(f"[BSON] Skipping non-dict payload: {type(payload)}")
                     continue
+                started = time.perf_counter()
                 encoded = self.encode(payload)
+                self.metrics.processed(time.perf_counter() - started)
                 await self.processed_queue.put(encoded)
                 self.logger.debug(f"[BSON] Encoded payload of size {len(encoded)} bytes")
             except Exception as e:
@@ -136,35 +275,227 @@ class BSONHandler(IHandler):
     def encode(self, payload: dict) -> bytes:
         return BSON.encode(payload)
 
+    async def stop(self):
+        was_running = self._running
+        await super().stop()
+        if was_running:
+            # Pass on what is still queued; the stages downstream stop later
+            while not self.data_queue.empty():
+                payload = self.data_queue.get_nowait()
+                if isinstance(payload, dict):
+                    await self.processed_queue.put(self.encode(payload))
+
 
 # ---------------------
 # Compression Handler
 # ---------------------
 
+def encode_and_compress(batch_format, codec_name, cache):
+    """
+    Encode and compress one batch. Module-level so it can run in a
+    ProcessPoolExecutor as well as a thread pool or inline.
+    """
+    if batch_format == CompressionHandler.FORMAT_COLUMNAR:
+        body = encode_batch(cache['cache'])
+    elif batch_format == CompressionHandler.FORMAT_TIMESERIES:
+        body = timeseries.encode_batch(cache['cache'])
+    else:
+        body = BSON.encode(cache)
+    return compression.compress(body, compression.get_codec(codec_name))
+
+
 class CompressionHandler(IHandler):
-    """Compresses batches of BSON-encoded payloads."""
+    """
+    Compresses batches of payloads.
+
+    With ``format`` set to ``columnar`` the batch is encoded once by
+    :func:`DAQ.util.batch.encode_batch` (record dicts in, one array per
+    field out); ``timeseries`` uses :func:`DAQ.util.timeseries.encode_batch`
+    (delta-of-delta timestamps and XOR-coded values per MAC); with ``bson``
+    the cached items are wrapped in a BSON ``{'cache': [...]}`` document as
+    before.
+
+    The encoded batch is compressed with the ``codec`` named in state (see
+    :mod:`DAQ.util.compression`) and tagged with its codec id.
+
+    ``executor`` selects where that work runs: ``inline`` on the event loop,
+    or a ``thread``/``process`` pool of ``executor_workers``. Up to
+    ``2 * executor_workers`` batches are in flight at once and an emitter
+    task forwards results strictly in submission order. Time the event loop
+    itself spent per batch is kept in ``loop_blocked_*`` state, and rolling
+    percentiles of batch latency in ``batch_latency_*``.
+
+    On stop the partial batch and anything still queued are flushed and
+    in-flight batches are forwarded before the executor is shut down, for
+    at most ``drain_timeout`` seconds.
+    """
+
+    FORMAT_COLUMNAR = 'columnar'
+    FORMAT_TIMESERIES = 'timeseries'
+    FORMAT_BSON = 'bson'
+
+    INLINE = 'inline'
+    THREAD = 'thread'
+    PROCESS = 'process'
+
+    LATENCY_WINDOW = 512  # batches kept for batch_latency_* percentiles
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.executor = None
+        self._inflight: asyncio.Queue | None = None
+        self._emitter: asyncio.Task | None = None
+        self._pending = []  # partial batch left behind when run() is cancelled
+        self._latencies = collections.deque(maxlen=self.LATENCY_WINDOW)
+
+    def encode(self, cache):
+        batch_format = self.get('format', self.FORMAT_BSON)
+        if batch_format == self.FORMAT_COLUMNAR:
+            return encode_batch(cache['cache'])
+        if batch_format == self.FORMAT_TIMESERIES:
+            return timeseries.encode_batch(cache['cache'])
+        return BSON.encode(cache)
 
-    async def run(self):
-        cache = {'cache': [], 'last_processed': time.time()}
-        while self._running:
+    async def start(self):
+        if self._running:
+            return
+        mode = self.get('executor', self.INLINE)
+        workers = self.get('executor_workers') or min(4, os.cpu_count() or 1)
+        if mode == self.THREAD:
+            self.executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=workers, thread_name_prefix=self.name)
+        elif mode == self.PROCESS:
+            self.executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+        if self.executor is not None:
+            self._inflight = asyncio.Queue(maxsize=2 * workers)
+            self._emitter = asyncio.create_task(self._emit_in_order(), name=f"{self.name}.emitter")
+            self.logger.info(f"[COMPRESS] Using {mode} executor with {workers} worker(s)")
+        await super().start()
+
+    async def stop(self):
+        was_running = self._running
+        await super().stop()
+        if was_running:
             try:
-                data = await asyncio.wait_for(self.data_queue.get(), timeout=1.0)
-                cache['cache'].append(data)
+                await asyncio.wait_for(self._drain(), self.get('drain_timeout', 10))
             except asyncio.TimeoutError:
+                self.logger.warning("[COMPRESS] Timed out draining batches on stop")
+            except Exception as e:
+                self.logger.error(f"[COMPRESS] Failed to drain batches on stop: {e}", exc_info=True)
+        if self._emitter:
+            self._emitter.cancel()
+            try:
+                await self._emitter
+            except asyncio.CancelledError:
                 pass
+            self._emitter = None
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+    async def _drain(self):
+        """Flush the partial batch and queued records, then wait for in-flight batches."""
+        cache, self._pending = self._pending, []
+        while not self.data_queue.empty():
+            cache.append(self.data_queue.get_nowait())
+        batch_on = self.get('batch_on', 500)
+        for i in range(0, len(cache), batch_on):
+            await self._flush({'cache': cache[i:i + batch_on], 'last_processed': time.time()})
+        if self._inflight is not None:
+            await self._inflight.join()
+
+    def _record_blocked(self, seconds):
+        self.set('loop_blocked_last', seconds)
+        self.set('loop_blocked_total', self.get('loop_blocked_total', 0.0) + seconds)
+        self.set('loop_blocked_max', max(self.get('loop_blocked_max', 0.0), seconds))
+        self.set('batches', self.get('batches', 0) + 1)
+
+    async def _flush(self, cache):
+        if tracing.enabled:
+            tracing.stamp_records(cache['cache'], tracing.FLUSH)
+        batch_format = self.get('format', self.FORMAT_BSON)
+        codec_name = self.get('codec')
+        started = time.perf_counter()
+        count = len(cache['cache'])
+        if self.executor is None:
+            compressed = encode_and_compress(batch_format, codec_name, cache)
+            elapsed = time.perf_counter() - started
+            self._record_blocked(elapsed)
+            self.metrics.processed(elapsed / count, count)
+            await self.processed_queue.put(compressed)
+            return
+
+        future = asyncio.get_running_loop().run_in_executor(
+            self.executor, encode_and_compress, batch_format, codec_name, cache)
+        self._record_blocked(time.perf_counter() - started)
+        # Blocks once the in-flight window is full, bounding pending batches
+        await self._inflight.put((future, started, count))
+
+    async def _emit_in_order(self):
+        while True:
+            future, started, count = await self._inflight.get()
+            try:
+                compressed = await future
+                self.metrics.processed((time.perf_counter() - started) / count, count)
+                await self.processed_queue.put(compressed)
+            except Exception as e:
+                self.logger.error(f"[COMPRESS] Failed to compress batch: {e}", exc_info=True)
+            finally:
+                self._inflight.task_done()
+
+    def _record_latency(self, seconds):
+        """Track how long the oldest record of each batch waited for its flush."""
+        self._latencies.append(seconds)
+        p50, p90, p99 = np.percentile(self._latencies, (50, 90, 99))
+        self.set('batch_latency_p50', float(p50))
+        self.set('batch_latency_p90', float(p90))
+        self.set('batch_latency_p99', float(p99))
+        self.set('batch_latency_max', max(self.get('batch_latency_max', 0.0), seconds))
 
-            batch_on = self.get('batch_on', 500)
-            batch_at = self.get('batch_at', 60)
-
-            if cache['cache'] and (
-                    len(cache['cache']) >= batch_on
-                    or time.time() - cache['last_processed'] >= batch_at
-            ):
-                reason = "size" if len(cache['cache']) >= batch_on else "time"
-                self.logger.info(f"[COMPRESS] Compressing {len(cache['cache'])} records due to {reason}")
-                try:
-                    compressed = bz2.compress(BSON.encode(cache))
-                    await self.processed_queue.put(compressed)
-                except Exception as e:
-                    self.logger.error(f"[COMPRESS] Failed to compress batch: {e}", exc_info=True)
-                cache = {'cache': [], 'last_processed': time.time()}
+    async def run(self):
+        """
+        Flush a batch when it reaches ``batch_on`` records or when its oldest
+        record is ``batch_at`` seconds old, whichever comes first. The loop
+        sleeps exactly until that deadline (or the next record) and drains
+        already-queued records without awaiting.
+        """
+        loop = asyncio.get_running_loop()
+        cache = []
+        first_at = None
+        getter = None
+        try:
+            while self._running:
+                batch_on = self.get('batch_on', 500)
+                batch_at = self.get('batch_at', 60)
+
+                if getter is None:
+                    getter = loop.create_task(self.data_queue.get())
+                timeout = None if not cache else max(0.0, first_at + batch_at - time.monotonic())
+                done, _ = await asyncio.wait((getter,), timeout=timeout)
+
+                if done:
+                    cache.append(getter.result())
+                    getter = None
+                    if first_at is None:
+                        first_at = time.monotonic()
+                    while len(cache) < batch_on and not self.data_queue.empty():
+                        cache.append(self.data_queue.get_nowait())
+
+                age = time.monotonic() - first_at if cache else 0.0
+                if cache and (len(cache) >= batch_on or age >= batch_at):
+                    reason = "size" if len(cache) >= batch_on else "time"
+                    self.logger.debug(f"[COMPRESS] Compressing {len(cache)} records due to {reason}")
+                    self._record_latency(age)
+                    try:
+                        await self._flush({'cache': cache, 'last_processed': time.time()})
+                    except Exception as e:
+                        self.logger.error(f"[COMPRESS] Failed to compress batch: {e}", exc_info=True)
+                    cache = []
+                    first_at = None
+        finally:
+            if getter is not None:
+                if getter.done() and not getter.cancelled():
+                    cache.append(getter.result())
+                getter.cancel()
+            self._pending = cache
@@ -0,0 +1,155 @@
+"""
+Report-by-exception (deadband) stage
+------------------------------------
+
+Forwards a record only when it differs meaningfully from the last record
+*sent* for the same device, or when the device has been silent upstream
+for ``max_silence`` seconds (a heartbeat, so the cloud can tell "steady"
+from "gone").
+
+A record differs when any of its fields moved beyond that field's
+deadband, when a non-numeric field (or ``op_stat``/``reg_stat``) changed
+at all, or when a field appeared or disappeared. Deadbands are either
+absolute (a number) or relative to the last sent value (``"N%"``):
+
+  daq:
+    deadband:
+      enabled: false
+      max_silence: 300
+      default: "1%"
+      fields: {Vi: 0.5, Vo: 0.5, Ii: 0.05, Io: 0.05, temperature: 1.0}
+
+Rollup aggregates and traced records always pass. Devices are keyed by
+``macaddr`` (gateway records) or ``serial_number`` (local devices), per
+record type.
+"""
+
+import asyncio
+import math
+import time
+
+from DAQ.util import tracing
+from DAQ.util.config import load_config
+from DAQ.util.handlers.common import IHandler
+
+
+#: Never compared: sample times and per-record bookkeeping
+IGNORED_FIELDS = frozenset(('freezetime', 'localtime', 'timestamp', tracing.TRACE_KEY))
+
+#: Compared exactly; any change is sent
+EXACT_FIELDS = frozenset(('op_stat', 'reg_stat'))
+
+
+def parse_deadband(spec):
+    """``0.5`` -> (0.5, 0.0) absolute; ``"2%"`` -> (0.0, 0.02) relative."""
+    if isinstance(spec, str) and spec.strip().endswith('%'):
+        return 0.0, float(spec.strip()[:-1]) / 100.0
+    return float(spec), 0.0
+
+
+def device_key(record):
+    return record.get('type'), record.get('macaddr', record.get('serial_number'))
+
+
+class DeadbandHandler(IHandler):
+    """Suppresses records that are within deadband of the last one sent."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        deadband_cfg = load_config().get('daq', {}).get('deadband') or {}
+        self.max_silence = float(deadband_cfg.get('max_silence', 300))
+        self.default = parse_deadband(deadband_cfg.get('default', '1%'))
+        self.deadbands = {field: parse_deadband(spec)
+                          for field, spec in (deadband_cfg.get('fields') or {}).items()}
+
+        self.last_sent = {}     # device key -> (monotonic sent time, record)
+        self.suppressed = {}    # device key -> records suppressed since the last send
+
+    def changed(self, record, last):
+        """Name of the first field outside its deadband, or None."""
+        if record.keys() != last.keys():
+            return 'fields'
+
+        for field, value in record.items():
+            if field in IGNORED_FIELDS:
+                continue
+            previous = last[field]
+            if field in EXACT_FIELDS \
+            or not isinstance(value, (int, float)) or isinstance(value, bool) \
+            or not isinstance(previous, (int, float)) or isinstance(previous, bool):
+                if value != previous:
+                    return field
+                continue
+
+            if math.isnan(value) or math.isnan(previous):
+                if math.isnan(value) != math.isnan(previous):
+                    return field
+                continue
+
+            absolute, relative = self.deadbands.get(field, self.default)
+            if abs(value - previous) > max(absolute, relative * abs(previous)):
+                return field
+
+        return None
+
+    def should_send(self, record, now=None):
+        if not isinstance(record, dict) \
+        or 'rollup_interval' in record or tracing.TRACE_KEY in record:
+            return True
+
+        now = time.monotonic() if now is None else now
+        key = device_key(record)
+        previous = self.last_sent.get(key)
+        if previous is None:
+            return True
+
+        sent_at, last = previous
+        if now - sent_at >= self.max_silence:
+            self.set('heartbeats', self.get('heartbeats', 0) + 1)
+            return True
+        return self.changed(record, last) is not None
+
+    def note_sent(self, record, now=None):
+        """Make ``record`` the reference for its device (also for records sent by other lanes)."""
+        if isinstance(record, dict) and 'rollup_interval' not in record:
+            key = device_key(record)
+            self.last_sent[key] = (time.monotonic() if now is None else now, record)
+            self.suppressed.pop(key, None)
+
+    def filter(self, record):
+        if self.should_send(record):
+            self.note_sent(record)
+            self.set('forwarded', self.get('forwarded', 0) + 1)
+            return True
+
+        key = device_key(record)
+        self.suppressed[key] = self.suppressed.get(key, 0) + 1
+        suppressed = self.get('suppressed', 0) + 1
+        self.set('suppressed', suppressed)
+        self.set('suppression_ratio', suppressed / (suppressed + self.get('forwarded', 0)))
+        return False
+
+    async def run(self):
+        while self._running:
+            try:
+                record = await self.data_queue.get()
+                started = time.perf_counter()
+                send = self.filter(record)
+                self.metrics.processed(time.perf_counter() - started)
+                if send:
+                    await self.processed_queue.put(record)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.logger.error(f"[Deadband] Error: {e}", exc_info=True)
+
+    async def stop(self):
+        was_running = self._running
+        await super().stop()
+        if was_running:
+            # Pass on what is still queued; the stages downstream stop later
+            while not self.data_queue.empty():
+                record = self.data_queue.get_nowait()
+                if self.filter(record):
+                    await self.processed_queue.put(record)
@@ -1,3 +1,7 @@
+import asyncio
+import time
+from collections import OrderedDict, defaultdict
+
 
 class Singleton(object):
     _instance = None
@@ -12,9 +16,13 @@ class LocalBackingStore(Singleton):
     Implements a single global dictionary to be used as
     a key-value store. This is useful for a local in-memory
     cache for a process.
+
+    Keys are kept in insertion/recency order so a cache on
+    top of it can evict least recently used entries.
     """
     def __init__(self):
-        self._data = {}
+        if '_data' not in self.__dict__:
+            self._data = OrderedDict()
 
     def __getitem__(self, key):
         return self._data[key]
@@ -22,74 +30,259 @@ class LocalBackingStore(Singleton):
     def __setitem__(self, key, value):
         self._data[key] = value
 
+    def __delitem__(self, key):
+        del self._data[key]
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def __iter__(self):
+        return iter(self._data)
+
     def __getattr__(self, key):
         return getattr(self._data, key)
 
     def clear(self):
-        self._data = {}
+        self._data = OrderedDict()
+
+    def get_many(self, keys):
+        return {key: self._data.get(key) for key in keys}
+
+    def hgetall(self, name):
+        return dict(self._data.get(name) or {})
+
+    def write(self, values, hashes=None):
+        self._data.update(values)
+        for name, fields in (hashes or {}).items():
+            self._data.setdefault(name, {}).update(fields)
 
 class RedisBackingStore(object):
     """
     Implements a connection of backing store to redis.
+
+    ``mgr`` is anything with an ``rdb`` redis client, or the client
+    itself. Bulk reads use one MGET; writes go out as a single
+    non-transactional pipeline of one MSET plus one HSET per hash.
     """
     def __init__(self, mgr):
         self.mgr = mgr
 
+    @property
+    def rdb(self):
+        return getattr(self.mgr, 'rdb', self.mgr)
+
     def __getitem__(self, key):
-        return self.mgr.rdb[key]
+        return self.rdb[key]
 
     def __setitem__(self, key, value):
-        self.mgr.rdb[key] = value
+        self.rdb[key] = value
 
     def get(self, key):
-        return self.mgr.rdb.get(key)
+        return self.rdb.get(key)
+
+    def get_many(self, keys):
+        return dict(zip(keys, self.rdb.mget(keys))) if keys else {}
+
+    def hgetall(self, name):
+        return self.rdb.hgetall(name)
+
+    def write(self, values, hashes=None):
+        pipe = self.rdb.pipeline(transaction=False)
+        if values:
+            pipe.mset(values)
+        for name, fields in (hashes or {}).items():
+            if fields:
+                pipe.hset(name, mapping=fields)
+        pipe.execute()
 
 class LocalCache(object):
     """
-    Implements simple cache-switching.
+    Implements a write-back cache in front of a backing store.
 
-    Will look up keys based on the "local" backing store,
-    if they do not exists in the local store, then it will
-    perform a lookup in the remote backing store and assign
-    that returned value to the local store.
+    Reads are served locally; a miss is fetched from the backing
+    store (:meth:`prefetch` fetches many misses with one MGET) and
+    remembered, including misses that came back empty. Writes only
+    mark the key dirty; :meth:`flush` sends every dirty key and hash
+    field in one pipelined round trip, either when
+    :meth:`flush_due` says ``flush_interval`` has passed or at
+    shutdown.
 
-    Able to sync a local backing store with remote backing store
+    At most ``max_items`` keys are kept; the least recently used are
+    evicted first. A dirty key that is evicted is held until the next
+    flush, so nothing written is lost.
     """
-    def __init__(self, local, backing_store=None):
-        self.local = local
+    def __init__(self, local=None, backing_store=None, max_items=100000, flush_interval=30.0):
+        self.local = local if local is not None else OrderedDict()
         self.backing_store = backing_store
+        self.max_items = max_items
+        self.flush_interval = flush_interval
+
+        self.dirty = set()
+        self.dirty_fields = defaultdict(set)
+        self._evicted = {}
+        self._partial = set()   # hashes written before they were ever read
+        self._flushed_at = time.monotonic()
+
+        self.hits = 0
+        self.misses = 0
+        self.flushes = 0
 
     def __setitem__(self, key, value):
-        #print "SETL", key, '->', value
+        self._store(key, value)
+        self.dirty.add(key)
+
+    def __contains__(self, key):
+        return key in self.local
+
+    def __len__(self):
+        return len(self.local)
+
+    def _store(self, key, value):
+        self._evicted.pop(key, None)
         self.local[key] = value
+        self.local.move_to_end(key)
+        while len(self.local) > self.max_items:
+            oldest, oldest_value = self.local.popitem(last=False)
+            if oldest in self.dirty or oldest in self.dirty_fields:
+                self._evicted[oldest] = oldest_value
 
     def clear_local(self):
         self.local.clear()
 
-    def get(self, key):
+    def get(self, key, default=None):
         """
         If the cache is stored localy then return it,
         otherwise attempt to acquire the value from the
         backing store.
         """
-        if self.local.has_key(key):
-            #print "RETL", key,"->", self.local[key]
-            return self.local[key]
+        if key in self.local:
+            self.hits += 1
+            self.local.move_to_end(key)
+            value = self.local[key]
+        elif key in self._evicted:
+            self.hits += 1
+            value = self._evicted[key]
+            self._store(key, value)
         else:
-            self.local[key] = self.backing_store.get(key)
-            #print "RETR", key,"->",self.local[key]
-            return self.local[key]
+            self.misses += 1
+            value = None
+            if self.backing_store is not None:
+                value = self.backing_store.get(key)
+            self._store(key, value)
+        return default if value is None else value
 
-    def sync(self):
-        for key,value in self.local.iteritems():
-            #print "SYNC", key, "->", value
-            self.backing_store[key] = value
+    def prefetch(self, keys):
+        """Load every key not cached yet with a single bulk read."""
+        missing = [key for key in keys if key not in self.local and key not in self._evicted]
+        if missing and self.backing_store is not None:
+            self.misses += len(missing)
+            for key, value in self.backing_store.get_many(missing).items():
+                self._store(key, value)
+        return len(missing)
 
-if __name__ == '__main__':
-    print("Testing singleton?")
+    def get_many(self, keys):
+        self.prefetch(keys)
+        return {key: self.get(key) for key in keys}
+
+    def hset(self, name, field, value):
+        fields = self.local.get(name)
+        if not isinstance(fields, dict):
+            fields = self._evicted.get(name)
+            if not isinstance(fields, dict):
+                fields = {}
+                self._partial.add(name)
+        fields[field] = value
+        self._store(name, fields)
+        self.dirty_fields[name].add(field)
+
+    def hgetall(self, name):
+        if name in self.local and name not in self._partial:
+            self.hits += 1
+            self.local.move_to_end(name)
+            return self.local[name] or {}
+
+        fields = self.local.get(name)
+        if fields is None:
+            fields = self._evicted.get(name)
+        if (fields is None or name in self._partial) and self.backing_store is not None:
+            self.misses += 1
+            #: Local writes win over what the backing store has
+            fields = {**(self.backing_store.hgetall(name) or {}), **(fields or {})}
+        self._partial.discard(name)
+        self._store(name, fields or {})
+        return fields or {}
+
+    def hget(self, name, field, default=None):
+        return self.hgetall(name).get(field, default)
+
+    def flush_due(self):
+        return bool(self.dirty or self.dirty_fields) \
+            and time.monotonic() - self._flushed_at >= self.flush_interval
 
-    cache = LocalCache(RedisBackingStore(1))
-    print(id(cache), id(cache.backing_store))
+    def take_dirty(self):
+        """Detach the pending writes as ``(values, hashes)`` and mark everything clean."""
+        def current(key):
+            return self.local[key] if key in self.local else self._evicted.get(key)
 
-    cache2 = LocalCache(RedisBackingStore(2))
-    print(id(cache2), id(cache2.backing_store))
+        values = {key: current(key) for key in self.dirty}
+        hashes = {}
+        for name, fields in self.dirty_fields.items():
+            source = current(name) or {}
+            hashes[name] = {field: source[field] for field in fields if field in source}
+
+        self.dirty = set()
+        self.dirty_fields = defaultdict(set)
+        self._evicted = {}
+        self._flushed_at = time.monotonic()
+        return values, hashes
+
+    def restore_dirty(self, values, hashes):
+        """Put writes from a failed flush back, unless they were overwritten meanwhile."""
+        for key, value in values.items():
+            if key not in self.dirty:
+                if key not in self.local:
+                    self._evicted[key] = value
+                self.dirty.add(key)
+        for name, fields in hashes.items():
+            if name not in self.local:
+                self._evicted.setdefault(name, dict(fields))
+            self.dirty_fields[name].update(fields)
+
+    def flush(self):
+        """Write every dirty key in one pipelined round trip; returns how many were written."""
+        values, hashes = self.take_dirty()
+        if not values and not hashes:
+            return 0
+        try:
+            self.backing_store.write(values, hashes)
+        except Exception:
+            self.restore_dirty(values, hashes)
+            raise
+        self.flushes += 1
+        return len(values) + sum(len(fields) for fields in hashes.values())
+
+    async def aflush(self):
+        """:meth:`flush` with the backing store I/O on a worker thread."""
+        values, hashes = self.take_dirty()
+        if not values and not hashes:
+            return 0
+        try:
+            await asyncio.to_thread(self.backing_store.write, values, hashes)
+        except BaseException:
+            self.restore_dirty(values, hashes)
+            raise
+        self.flushes += 1
+        return len(values) + sum(len(fields) for fields in hashes.values())
+
+    def sync(self):
+        return self.flush()
+
+if __name__ == '__main__':
+    cache = LocalCache(backing_store=LocalBackingStore(), max_items=2)
+    cache['a'] = 1
+    cache['b'] = 2
+    cache['c'] = 3
+    print(cache.get('a'), cache.flush(), dict(cache.backing_store.items()))
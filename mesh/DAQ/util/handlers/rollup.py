@@ -1,608 +1,727 @@
-
-
-import copy
+"""
+Rollup engine
+-------------
+
+Incremental per-series aggregates over fixed intervals (1 and 5 minutes by
+default) for every device type in ``ROLLUP_MAPPER``.
+
+A :class:`PeriodManager` per device type owns one :class:`RollupPeriod` per
+interval. The manager gives every series (the record's ``map_fields``
+values, e.g. MAC + graph key) a compact integer id, and each open timeslot
+is a :class:`StatsRecord`: running sum/sum2/count/min/max arrays of shape
+``(series, fields)``. Appending a batch of records is one vectorized update
+per timeslot; ``mean``/``rms``/``stdev`` are derived from the sums only
+when the timeslot is emitted.
+
+Before they are accumulated, ``calc_fields`` samples are smoothed by a
+:class:`~DAQ.util.stats.LowPassFilterBank` (one channel per series and
+field, ``filter_frequency``; 0 disables it). Given a cache (normally a
+write-back :class:`~DAQ.util.handlers.localcache.LocalCache` over Redis),
+the filter state is saved to it in bulk whenever timeslots are emitted,
+flushed on the cache's interval and at shutdown, and restored on start.
+
+Timeslots are labelled with their end time (freezetime rounded up to the
+interval, as before) and emitted once ``grace`` seconds have passed since
+that end. Records for a timeslot that was already emitted are counted as
+late and dropped.
+
+Expiry is indexed by min-heaps of ``(deadline, timeslot)`` with lazy
+deletion: a timeslot is pushed once when it opens, entries whose slot was
+already closed are discarded when they surface, and a staleness entry that
+surfaces for a slot updated since is re-armed rather than moved on every
+update. Checking for due slots is a peek at the heap top, and expiring one
+is O(log n).
+
+:class:`RollupHandler` runs the engine as a pipeline stage in front of the
+batching chain:
+
+  daq:
+    rollup:
+      enabled: false
+      intervals: [60, 300]
+      types: [mon, env, acm, inv]
+      grace: 15
+      forward_raw: true
+      filter_frequency: 4
+"""
+
+import asyncio
+import base64
+import datetime
+import heapq
+import io
+import json
 import math
 import time
-from collections import defaultdict
-from DAQ.util.devices import PANEL_LEVEL
-from DAQ.util.devices import ROLLUP_MAPPER
-from DAQ.util.stats import LowPassFloat
-from DAQ.util.time_rounding import round_to_nearest_second
-from DAQ.util.utctime import utcepochnow
-from DAQ.util.utctime import utcnow
-
-
-THRESHHOLD_CURRENT_PERCENTAGE = .035
-
-class PeriodManager():
-    def __init__(self, type, cache):
-        self.type = type
-        self.cache = cache
-        self.periods = {}
-
-    def clear(self):
-        for period in self.periods.values():
-            period.clear()
-        self.periods = {}
-
-    def process_expirations(self):
-        now = utcnow()
-
-        for period in self.periods.values():
-            period.expire_all_before(now)
-
-    def remove_interval(self, interval):
-        try:
-            del self.periods[interval]
-        except KeyError:
-            pass
-
-    def get_interval_values(self):
-        return self.periods.keys()
-
-    def get_interval_periods(self):
-        return self.periods.values()
-
-    def get_intervals(self):
-        return self.periods.items()
-
-    def add_interval(self, interval, overlap=None):
-        self.periods[interval] = RollupPeriod(self.type, interval, self.cache,
-                                              overlap=overlap)
-
-    def append(self, record):
-        for period in self.periods.values():
-            #: A period makes a copy of the record, no need to copy here.
-            period.append(record)
-
-    def expire_all_old(self):
-        for period in self.periods.values():
-            period.expire_timeslot(period.get_oldest_not_updated())
-
-    def expire_all_before(self, timeslot):
-        for period in self.periods.values():
-            period.expire_all_before(timeslot)
-
-class RollupPeriod():
-    def __init__(self, type, interval, cache, overlap=None):
-        self.calc_fields = ROLLUP_MAPPER[type]['calc_fields']
-        self.map_fields = ROLLUP_MAPPER[type]['map_fields']
-        self.accum_fields = ROLLUP_MAPPER[type]['accum_fields']
-        #: at the moment, an accumulated field can look at
-        #: row.field_max for the accumulated value for that
-        #: 5 minute period. This may change at some point
-        self.calc_fields.extend(self.accum_fields)
 
-        self.type = type
-        self.cache = cache
+import numpy as np
 
-        self.last_update = time.time()
+from DAQ.util.config import load_config
+from DAQ.util.devices import DTYPE_MAPPER, PANEL_LEVEL, ROLLUP_MAPPER
+from DAQ.util.handlers.common import IHandler
+from DAQ.util.stats import LowPassFilterBank
+from DAQ.util.utctime import datetime_to_epoch, epoch_to_datetime, utcepochnow
 
-        self.overlap = overlap
-        self.set_interval(interval)
 
-    def clear(self):
-        for record in self.get_all_records():
-            record.clear()
-        self.timeslots = {}
-        self.timeslot_updates = {}
-        self.timeslots_string_current = {}
-        self.last_freezetime = {}
-        self.interval = None
+#: Bit-field columns AND-ed over a timeslot for panel records
+FLAG_FIELDS = ('op_stat', 'reg_stat')
 
-    def set_interval(self, interval):
-        self.interval = interval
-        self.expire = interval * 2 # reset filter if a whole rollup interval is missed
+_INITIAL_SERIES = 16
 
-        self.last_freezetime = defaultdict(lambda: None)
-        self.timeslot_updates = {}
-        self.timeslots = {}
-        self.timeslots_string_current = defaultdict(dict)
 
-    def expire_all_before(self, timeslot):
-        for ts in [_ts for _ts in self.timeslots if _ts <= timeslot]:
-            self.expire_timeslot(ts)
+def _epoch(value):
+    if isinstance(value, datetime.datetime):
+        return datetime_to_epoch(value)
+    return float(value)
 
-    def get_oldest(self):
-        oldest = None
 
-        for timeslot in self.timeslots.keys():
-            if timeslot < oldest or oldest is None:
-                oldest = timeslot
+def _float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return math.nan
 
-        return oldest
 
-    def get_oldest_not_updated(self):
-        now = utcepochnow()
-
-        non_updating_timeslots = [ts for ts,upd in self.timeslot_updates.items()
-                                   if now - upd > self.expire]
+def _flag(value):
+    """Status bits as an int; a missing or unparseable value is all-ones (no effect on the AND)."""
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return -1
 
-        non_updating_timeslots.sort()
 
-        if len(non_updating_timeslots):
-            return non_updating_timeslots[0]
-        else:
-            return None
+class SeriesIndex():
+    """Compact integer ids for the distinct ``map_fields`` values seen."""
 
-    def get_all_records(self):
-        for timeslot in sorted(self.timeslots.keys()):
-            for record in self.timeslots[timeslot].values():
-                yield record
+    def __init__(self, map_fields, keys=()):
+        self.map_fields = map_fields
+        self.ids = {}
+        self.fields = []
+        for key in keys:
+            self.key_id(tuple(key))
 
-        raise StopIteration
+    def __len__(self):
+        return len(self.fields)
 
-    def get_records(self, timeslot):
-        try:
-            return self.timeslots[timeslot].values()
-        except KeyError:
-            return None
-
-    def expire_timeslot(self, timeslot):
-        try:
-            del self.timeslots[timeslot]
-        except KeyError:
-            pass
+    @property
+    def keys(self):
+        return list(self.ids)
 
-        try:
-            del self.timeslot_updates[timeslot]
-        except KeyError:
-            pass
+    def key_id(self, key):
+        sid = self.ids.get(key)
+        if sid is None:
+            sid = self.ids[key] = len(self.fields)
+            self.fields.append({field: value for field, value in zip(self.map_fields, key)
+                                if value is not None})
+        return sid
 
-    def append(self, rrecord):
-        rounded_times = list()
+    def id_of(self, record):
+        return self.key_id(tuple(record.get(field) for field in self.map_fields))
 
-        rounded_times.append(round_to_nearest_second(rrecord['freezetime'],
-                                                     to_nearest=self.interval,
-                                                     rounding_func=math.ceil))
 
-#        if self.overlap is not None:
-#            overlap_freezetime = rrecord['freezetime'] + self.overlap
-#
-#            rounded_time_overlap = round_to_nearest_second(overlap_freezetime,
-#                                                           to_nearest=self.interval,
-#                                                           rounding_func=math.ceil)
-#
-#            if rounded_time_overlap != rounded_times[0]:
-#                rounded_times.append(rounded_time_overlap)
+class StatsCol():
+    """One rolled-up field: its column in the arrays and its output keys."""
 
-        for rounded_time in rounded_times:
-            #: Copy the record for modifications later
-            record = copy.copy(rrecord)
+    STATS = ('sum', 'sum2', 'count', 'min', 'max', 'mean', 'rms', 'stdev')
 
-            record['freezetime'] = rounded_time
-            record['rollup_interval'] = self.interval
+    def __init__(self, name, index):
+        self.name = name
+        self.index = index
+        self.keys = [(name + '_' + stat, stat) for stat in self.STATS]
+
+    def to_dict(self, table, row):
+        """Output fields for series ``row`` from the computed ``table`` arrays."""
+        data = {}
+        for key, stat in self.keys:
+            value = table[stat][row, self.index]
+            data[key] = int(value) if stat == 'count' else float(value)
+        return data
 
-            key_record = '|'.join([str(record[k]) for k in self.map_fields])
 
-            self.timeslot_updates[rounded_time] = utcepochnow()
+class AccumedStatsCol(StatsCol):
+    """
+    A field that is an accumulating counter (energy registers): only its
+    range over the timeslot is meaningful.
+    """
 
-            if not self.timeslots.has_key(rounded_time):
-                self.timeslots[rounded_time] = {}
+    STATS = ('count', 'min', 'max', 'diff')
 
-            if not self.timeslots[rounded_time].has_key(key_record):
-                self.timeslots[rounded_time][key_record] = StatsRecord(self, record)
-            else:
-                self.timeslots[rounded_time][key_record].append(record)
 
 class StatsRecord():
-    def __init__(self, period, record):
-        self.period = period
-
-        self.record = record
-
-        self.calc_cols = []
+    """
+    Running statistics of one timeslot for every series of a period.
 
-        for field in self.period.calc_fields:
-            if field not in record.keys():
-                continue
+    Arrays are indexed ``[series id, field]`` and grow with the period's
+    series registry.
+    """
 
-            key_record = '|'.join([str(self.record[k])
-                                   for k in self.period.map_fields])
-            key_record += '|%s' % (field)
-
-            col = StatsCol if field not in self.period.accum_fields else AccumedStatsCol
-            self.calc_cols.append(col(field, record=self, key_record=key_record))
-            # self.calc_cols[-1].append(record[field])
-
-        if self.period.type == PANEL_LEVEL:
-            ts = self.period.timeslots_string_current[self.record['freezetime']]
-
-            if not ts.has_key(self.record['id_string']):
-                key_record = self.record['id_string']
-
-                ts[self.record['id_string']] = {'Io': StatsCol('Io', record=self, key_record=key_record+'|Io')}
-
-            # ts_string = ts[self.record['id_string']]
+    def __init__(self, period, timeslot):
+        self.period = period
+        self.timeslot = timeslot
+        self.updated = time.monotonic()
+
+        size = max(_INITIAL_SERIES, len(period.series))
+        fields = len(period.fields)
+        self.sum = np.zeros((size, fields))
+        self.sum2 = np.zeros((size, fields))
+        self.count = np.zeros((size, fields), dtype=np.int64)
+        self.min = np.full((size, fields), np.inf)
+        self.max = np.full((size, fields), -np.inf)
+        self.seen = np.zeros(size, dtype=bool)
+        self.flags = np.full((size, len(period.flag_fields)), -1, dtype=np.int64)
+
+    def _grow(self, size):
+        grow = size - len(self.seen)
+        fields = len(self.period.fields)
+        self.sum = np.vstack((self.sum, np.zeros((grow, fields))))
+        self.sum2 = np.vstack((self.sum2, np.zeros((grow, fields))))
+        self.count = np.vstack((self.count, np.zeros((grow, fields), dtype=np.int64)))
+        self.min = np.vstack((self.min, np.full((grow, fields), np.inf)))
+        self.max = np.vstack((self.max, np.full((grow, fields), -np.inf)))
+        self.seen = np.concatenate((self.seen, np.zeros(grow, dtype=bool)))
+        self.flags = np.vstack((self.flags, np.full((grow, self.flags.shape[1]), -1, dtype=np.int64)))
+
+    def extend(self, sids, values, flags=None):
+        """Fold rows ``values[i]`` into series ``sids[i]``; a series may repeat."""
+        top = int(sids.max()) + 1
+        if top > len(self.seen):
+            self._grow(max(top, 2 * len(self.seen)))
+
+        valid = ~np.isnan(values)
+        data = np.where(valid, values, 0.0)
+        np.add.at(self.sum, sids, data)
+        np.add.at(self.sum2, sids, data * data)
+        np.add.at(self.count, sids, valid)
+        np.fmin.at(self.min, sids, values)
+        np.fmax.at(self.max, sids, values)
+        if flags is not None:
+            np.bitwise_and.at(self.flags, sids, flags)
+        self.seen[sids] = True
+        self.updated = time.monotonic()
+
+    def append(self, sid, values, flags=None):
+        if sid >= len(self.seen):
+            self._grow(max(sid + 1, 2 * len(self.seen)))
+
+        valid = ~np.isnan(values)
+        data = np.where(valid, values, 0.0)
+        self.sum[sid] += data
+        self.sum2[sid] += data * data
+        self.count[sid] += valid
+        np.fmin(self.min[sid], values, out=self.min[sid])
+        np.fmax(self.max[sid], values, out=self.max[sid])
+        if flags is not None:
+            np.bitwise_and(self.flags[sid], flags, out=self.flags[sid])
+        self.seen[sid] = True
+        self.updated = time.monotonic()
+
+    def table(self):
+        """Derived statistics for every series, as ``{stat: array}``."""
+        empty = self.count == 0
+        count = np.where(empty, 1, self.count)
+        with np.errstate(invalid='ignore'):
+            mean = self.sum / count
+            square = self.sum2 / count
+            table = {
+                'sum': np.where(empty, np.nan, self.sum),
+                'sum2': np.where(empty, np.nan, self.sum2),
+                'count': self.count,
+                'min': np.where(empty, np.nan, self.min),
+                'max': np.where(empty, np.nan, self.max),
+                'mean': np.where(empty, np.nan, mean),
+                'rms': np.where(empty, np.nan, np.sqrt(square)),
+                'stdev': np.where(empty, np.nan, np.sqrt(np.maximum(square - mean * mean, 0.0))),
+            }
+            #: A counter that rolled over inside the slot restarts near zero
+            table['diff'] = np.where(table['min'] < table['max'] / 2,
+                                     table['min'], table['max'] - table['min'])
+        return table
+
+    def to_dicts(self):
+        period = self.period
+        table = self.table()
+        freezetime = epoch_to_datetime(self.timeslot)
+        records = []
+
+        for sid in np.flatnonzero(self.seen):
+            record = dict(period.series.fields[sid])
+            record['type'] = period.type
+            record['freezetime'] = freezetime
+            record['rollup_interval'] = period.interval
+
+            for col in period.cols:
+                record.update(col.to_dict(table, sid))
+
+            for index, name in enumerate(period.flag_fields):
+                if self.flags[sid, index] != -1:
+                    record[name] = int(self.flags[sid, index])
+
+            if period.type == PANEL_LEVEL:
+                record['Pi_mean'] = record.get('Ii_mean', math.nan) * record.get('Vi_mean', math.nan)
+                record['Po_mean'] = record.get('Io_mean', math.nan) * record.get('Vo_mean', math.nan)
+                #: Watt-hours over the slot
+                record['Eo'] = record['Po_mean'] * period.interval / 3600
+
+            records.append(record)
+
+        return records
 
-            # if self.record['Io'] != 0.0:
-            #     ts_string['Io'].append(self.record['Io'])
-        self.append(self.record)
 
-        for field in self.period.calc_fields:
-            if field in record:
-                del self.record[field]
+class RollupPeriod():
+    def __init__(self, type, interval, cache=None, grace=0, series=None):
+        mapper = ROLLUP_MAPPER[type]
+        self.map_fields = list(mapper.get('map_fields', []))
+        self.calc_fields = list(mapper.get('calc_fields', []))
+        self.accum_fields = list(mapper.get('accum_fields', []))
+        #: at the moment, an accumulated field can look at
+        #: row.field_max for the accumulated value for that
+        #: period. This may change at some point
+        self.fields = self.calc_fields + self.accum_fields
+        self.cols = [StatsCol(name, i) for i, name in enumerate(self.calc_fields)]
+        self.cols += [AccumedStatsCol(name, len(self.calc_fields) + i)
+                      for i, name in enumerate(self.accum_fields)]
+        self.flag_fields = FLAG_FIELDS if type == PANEL_LEVEL else ()
 
-        if self.period.type == PANEL_LEVEL:
-            del self.record['Pi']
-            del self.record['Po']
+        self.type = type
+        self.cache = cache
+        self.grace = grace
+        #: Shared with the other intervals when owned by a PeriodManager
+        self.series = series if series is not None else SeriesIndex(self.map_fields)
 
-        # self.append(self.record)
+        self.set_interval(interval)
 
     def clear(self):
-        self.period = None
-        self.record = None
-
-    def to_dict(self):
-        for field in self.calc_cols:
-            self.record.update(field.to_dict())
-
-        # calculate energy in joules
-        if self.period.type == PANEL_LEVEL:
-            ts = self.period.timeslots_string_current[self.record['freezetime']]
-            ts_string = ts[self.record['id_string']]
-
-            #: Only update string cube if the current data is similar.
-            if not (self.record['Io_mean'] == 0.0 \
-                    or math.isnan(self.record['Io_mean'])):
-                ts_string['Io'].calc()
-
-                if self.record['Io_mean'] / ts_string['Io']['mean'] > THRESHHOLD_CURRENT_PERCENTAGE:
-                    self.record.update(ts_string['Io'].to_dict(calc=False))
-
-            try:
-                self.record['Pi_mean'] = self.record['Ii_mean'] * self.record['Vi_mean']
-            except TypeError:
-                self.record['Pi_mean'] = float('nan')
-
-            try:
-                self.record['Po_mean'] = self.record['Io_mean'] * self.record['Vo_mean']
-            except TypeError:
-                self.record['Po_mean'] = float('nan')
-
-            try:
-                self.record['Eo'] = self.record['Po_mean'] * self.period.interval / 3600
-            except TypeError:
-                self.record['Eo'] = float('nan')
-
-        return self.record
-
-    def append(self, record):
-        for field in self.calc_cols:
-            field.append(record[field.name])
+        self.timeslots = {}
+        self._deadlines = []    # (timeslot + grace, timeslot)
+        self._stale = []        # (monotonic time the slot goes stale, timeslot)
+        self.emitted_through = None
+        self.late = 0
 
-        if self.period.type == PANEL_LEVEL:
-            ts = self.period.timeslots_string_current[record['freezetime']]
-            ts_string = ts[record['id_string']]
+    def set_interval(self, interval):
+        self.interval = interval
+        self.expire = interval * 2
+        self.clear()
 
-            if record['Io'] != 0.0:
-                if ts_string['Io'].last_data:
-                    if record['Io'] / ts_string['Io'].last_data > THRESHHOLD_CURRENT_PERCENTAGE:
-                        ts_string['Io'].append(record['Io'])
-                else:
-                    ts_string['Io'].append(record['Io'])
+    def timeslot_of(self, record):
+        return int(math.ceil(_epoch(record['freezetime']) / self.interval) * self.interval)
+
+    def _prune(self, heap):
+        """Drop heap entries of timeslots that were already closed."""
+        while heap and heap[0][1] not in self.timeslots:
+            heapq.heappop(heap)
+
+    def _prune_stale(self):
+        """
+        Prune the stale index after a slot closes. Closed slots queued behind
+        an older open one cannot be popped, so once they outnumber the open
+        slots the index is rebuilt from ``timeslots``.
+        """
+        self._prune(self._stale)
+        if len(self._stale) > 2 * len(self.timeslots) + 16:
+            self._stale = [(slot.updated + self.expire, timeslot) for timeslot, slot in self.timeslots.items()]
+            heapq.heapify(self._stale)
+
+    @property
+    def next_deadline(self):
+        """Epoch at which the next timeslot becomes due (None if none are open)."""
+        self._prune(self._deadlines)
+        return self._deadlines[0][0] if self._deadlines else None
 
-            self.record['op_stat'] &= record['op_stat']
-            self.record['reg_stat'] &= record['reg_stat']
+    def get_oldest(self):
+        self._prune(self._deadlines)
+        return self._deadlines[0][1] if self._deadlines else None
 
-class StatsCol():
-    def __init__(self, name, store_array=False, do_filter=True, record=None, key_record=None):
-        self.name = name
-        self.store_array = store_array
-        self.do_filter = do_filter
-        self.record = record
-        self.key_record = key_record
-
-        if self.do_filter:
-            if self.record:
-                self.key_lpf = 'rollupcache:%s:lpf' % (self.key_record)
-                self.key_ts = 'rollupcache:%s:ts' % (self.key_record)
-
-                lpf = self.record.period.cache.get(self.key_lpf)
-                ts = self.record.period.cache.get(self.key_ts)
-
-                if lpf and ts:
-                    ts = int(ts)
-
-                    #: Reset LPF if the last known data is way old.
-                    #: otherwise use the cached value.
-                    #: conversely, if processing old data then the
-                    #: lpf should be reset.
-                    if abs(self.record.record['freezetime'] - ts) >= self.record.period.expire:
-                        initial = 0.0
-#                        print self.key_lpf, "Resetting LPF due to old records", self.record.record['freezetime'], ts
-                    else:
-#                        print self.key_lpf, "Loading value", float(self.record.period.cache[self.key_lpf])
-                        initial = float(lpf)
-
-                        #: just in case the cache has nan, discard that
-                        #: nan and replace with 0 since nans are viral.
-                        if math.isnan(initial):
-                            initial = 0.0
-
-                            #: Reset the cache so that it no longer contains nan
-                            self.record.period.cache[self.key_lpf] = str(0.0)
-                else:
-#                    print self.key_lpf, 'no LPF cache available for loading'
-                    initial = 0.0
+    def get_oldest_not_updated(self):
+        """The open timeslot that has gone longest without an update past ``expire``."""
+        now = time.monotonic()
+        heap = self._stale
+        while heap:
+            stale_at, timeslot = heap[0]
+            slot = self.timeslots.get(timeslot)
+            if slot is None:
+                heapq.heappop(heap)
+            elif slot.updated + self.expire > stale_at:
+                heapq.heapreplace(heap, (slot.updated + self.expire, timeslot))
+            elif stale_at < now:
+                return timeslot
             else:
-                initial = 0.0
-
-            self.filtered_data = LowPassFloat(frequency=4, initial=initial)
-        else:
-            initial = None
+                break
+        return None
 
-        self.sum = None
-        self.sum2 = None
-        self.count = None
-        self.min = None
-        self.max = None
-        self.mean = None
-        self.rms = None
-        self.stdev = None
-
-        self.last_data = initial
-
-        self.array = []
-        self.identifiers = []
+    def get_all_records(self):
+        for timeslot in sorted(self.timeslots):
+            yield from self.timeslots[timeslot].to_dicts()
 
-    def __getitem__(self, key):
+    def get_records(self, timeslot):
         try:
-            return getattr(self, key)
-        except:
+            return self.timeslots[timeslot].to_dicts()
+        except KeyError:
             return None
 
-    def recalc(self):
-        assert len(self.array), "Must have elements in the array to calculate from"
-
-        self.clear()
-
-        self.append(self.array)
-
-    def clear(self, array=False):
-        self.sum = None
-        self.sum2 = None
-        self.count = None
-        self.min = None
-        self.max = None
-        self.mean = None
-        self.rms = None
-        self.stdev = None
-
-        if array:
-            self.array = []
-            self.identifiers = []
-
-    def append(self, data, store_array=True, identifier=None):
-        if data is None:
-            return
+    def append(self, record, values=None, flags=None):
+        """
+        Fold ``record`` into its timeslot; ``values`` (the record's
+        ``fields`` as a float array) may be passed in when several periods
+        share them. Returns False for a record whose timeslot was already
+        emitted.
+        """
+        timeslot = self.timeslot_of(record)
+        if self.emitted_through is not None and timeslot <= self.emitted_through:
+            self.late += 1
+            return False
+
+        if values is None:
+            values = np.fromiter((_float(record.get(f)) for f in self.fields), np.float64, len(self.fields))
+        if flags is None and self.flag_fields and all(f in record for f in self.flag_fields):
+            flags = np.array([int(record[f]) for f in self.flag_fields], dtype=np.int64)
+
+        self._slot(timeslot).append(self.series.id_of(record), values, flags)
+        return True
+
+    def extend(self, epochs, sids, values, flags=None):
+        """
+        Fold a batch into its timeslots: row ``i`` of ``values`` (and
+        ``flags``) belongs to series ``sids[i]`` at ``epochs[i]``. Returns
+        the number of rows dropped as late.
+        """
+        timeslots = (np.ceil(epochs / self.interval) * self.interval).astype(np.int64)
+        late = 0
+        if self.emitted_through is not None:
+            on_time = timeslots > self.emitted_through
+            late = len(timeslots) - int(on_time.sum())
+            if late:
+                self.late += late
+                timeslots, sids, values = timeslots[on_time], sids[on_time], values[on_time]
+                flags = None if flags is None else flags[on_time]
+
+        if len(timeslots) == 1:
+            self._slot(int(timeslots[0])).append(sids[0], values[0], None if flags is None else flags[0])
+            return late
+
+        for timeslot in np.unique(timeslots):
+            rows = timeslots == timeslot
+            self._slot(int(timeslot)).extend(sids[rows], values[rows], None if flags is None else flags[rows])
+        return late
+
+    def _slot(self, timeslot):
+        slot = self.timeslots.get(timeslot)
+        if slot is None:
+            slot = self.timeslots[timeslot] = StatsRecord(self, timeslot)
+            heapq.heappush(self._deadlines, (timeslot + self.grace, timeslot))
+            heapq.heappush(self._stale, (slot.updated + self.expire, timeslot))
+        return slot
 
-        if isinstance(data, (tuple, list)):
-            for x in data:
-                self.append(x)
-            return
-
-        try:
-            data = float(data)
-        except TypeError:
-            return
+    def expire_timeslot(self, timeslot):
+        """Close ``timeslot`` and return its rolled-up records."""
+        slot = self.timeslots.pop(timeslot, None)
+        if slot is None:
+            return []
+        self._prune_stale()
+        if self.emitted_through is None or timeslot > self.emitted_through:
+            self.emitted_through = timeslot
+        return slot.to_dicts()
+
+    def expire_all_before(self, now):
+        """Emit every timeslot that ended at least ``grace`` seconds before ``now``."""
+        records = []
+        heap = self._deadlines
+        while heap and heap[0][0] <= now:
+            _, timeslot = heapq.heappop(heap)
+            records.extend(self.expire_timeslot(timeslot))
+        return records
 
-        #: Don't corrupt valid data that we do have with a nan
-        if math.isnan(data):
-            return
 
-        #: DO NOT include invalid data reports in the
-        #: count of records
-        if self.count is None:
-            self.count = 1
-        else:
-            self.count += 1
+class PeriodManager():
+    def __init__(self, type, cache=None, grace=0, filter_frequency=4):
+        self.type = type
+        self.cache = cache
+        self.grace = grace
+        self.periods = {}
+        self.next_deadline = None
 
-        if self.do_filter:
-            #: if open circuit arrives, set to open circuit immediately.
-            if data != 0.0:
-                self.filtered_data += data
+        mapper = ROLLUP_MAPPER[type]
+        self.calc_fields = list(mapper.get('calc_fields', []))
+        self.fields = self.calc_fields + list(mapper.get('accum_fields', []))
+        self.flag_fields = FLAG_FIELDS if type == PANEL_LEVEL else ()
+        self.series = SeriesIndex(list(mapper.get('map_fields', [])))
 
-                data = self.filtered_data.value
-            else:
-                data = 0.0
-                self.filtered_data.value = data
-
-            self.record.period.cache[self.key_lpf] = str(data)
-            self.record.period.cache[self.key_ts] = str(self.record.record['freezetime'])
-
-#            print self.key_lpf, str(self.record.record['freezetime']), str(data)
-
-        self.last_data = data
-
-        if self.store_array and store_array:
-            self.array.append(data)
-            self.identifiers.append(identifier)
-
-        if self.sum is not None:
-            self.sum += data
-            self.sum2 += data * data
-
-            if data < self.min:
-                self.min = data
-
-            if data > self.max:
-                self.max = data
-        else:
-            self.sum = data
-            self.sum2 = data * data
-            self.min = data
-            self.max = data
-
-    def calc(self):
-
-        #: Some reasonable defaults for a small number of
-        #: reports
-        if self.count == 0:
-            self.mean = None
-            self.stdev = None
-            self.rms = None
-        elif self.count == 1:
-            self.mean = self.sum
-            self.rms = self.sum
-            self.stdev = 0.0
-        else:
-            try:
-                self.mean = self.sum / self.count
-            except ZeroDivisionError: #: with the code added above this won't happen
-                self.mean = 0.0
-            except TypeError:
-                self.mean = None
+        self.filters = None
+        if filter_frequency and self.calc_fields:
+            self.filters = LowPassFilterBank(len(self.calc_fields), frequency=filter_frequency)
 
-            try:
-                self.stdev = math.sqrt( (self.sum2 / self.count)
-                                       -(self.mean * self.mean))
-            except ValueError:
-                self.stdev = 0.0
-            except TypeError:
-                self.stdev = None
+    @property
+    def cache_key(self):
+        return 'rollupcache:%s:lpf' % (self.type,)
 
-            try:
-                self.rms = math.sqrt(self.sum2 / self.count)
-            except ValueError:
-                self.rms = 0.0
-            except TypeError:
-                self.rms = None
-
-        if self.sum is None:
-            self.sum = float('nan')
-        if self.sum2 is None:
-            self.sum2 = float('nan')
-        if self.min is None:
-            self.min = float('nan')
-        if self.max is None:
-            self.max = float('nan')
-        if self.mean is None:
-            self.mean = float('nan')
-        if self.rms is None:
-            self.rms = float('nan')
-        if self.stdev is None:
-            self.stdev = float('nan')
-        if self.count is None:
-            self.count = 0
-
-    def to_dict(self, calc=True):
-        if calc:
-            self.calc()
-
-        data = {
-            self.name + '_sum': self.sum,
-            self.name + '_sum2': self.sum2,
-            self.name + '_count': self.count,
-            self.name + '_min': self.min,
-            self.name + '_max': self.max,
-            self.name + '_mean': self.mean,
-            self.name + '_rms': self.rms,
-            self.name + '_stdev': self.stdev,
-        }
+    def clear(self):
+        for period in self.periods.values():
+            period.clear()
+        self.periods = {}
+        self.next_deadline = None
+        self.series = SeriesIndex(self.series.map_fields)
+        if self.filters is not None:
+            self.filters = LowPassFilterBank(self.filters.fields, frequency=self.filters.frequency)
 
-        return data
+    def _update_deadline(self):
+        deadlines = [d for d in (p.next_deadline for p in self.periods.values()) if d is not None]
+        self.next_deadline = min(deadlines) if deadlines else None
 
-class AccumedStatsCol():
-    def __init__(self, name, store_array=False, record=None, key_record=None):
-        self.name = name
-        self.store_array = store_array
-        self.record = record
-        self.key_record = key_record
+    def process_expirations(self, now=None):
+        if now is None:
+            now = utcepochnow()
 
-        self.count = None
-        self.min = None
-        self.max = None
-        self.diff = None
+        if self.next_deadline is None or now < self.next_deadline:
+            return []
 
-        self.array = []
-        self.identifiers = []
+        records = []
+        for period in self.periods.values():
+            records.extend(period.expire_all_before(now))
+        self._update_deadline()
+        return records
 
-    def __getitem__(self, key):
+    def remove_interval(self, interval):
         try:
-            return getattr(self, key)
-        except:
-            return None
-
-    def recalc(self):
-        assert len(self.array), "Must have elements in the array to calculate from"
-
-        self.clear()
-
-        self.append(self.array)
-
-    def clear(self, array=False):
-        self.count = None
-        self.min = None
-        self.max = None
-        self.diff = None
+            del self.periods[interval]
+        except KeyError:
+            pass
 
-        if array:
-            self.array = []
-            self.identifiers = []
+    def get_interval_values(self):
+        return self.periods.keys()
 
-    def append(self, data, store_array=True, identifier=None):
-        if data is None:
-            return
+    def get_interval_periods(self):
+        return self.periods.values()
 
-        if isinstance(data, (tuple, list)):
-            for x in data:
-                self.append(x)
+    def get_intervals(self):
+        return self.periods.items()
 
-        #: Include invalid data reports in the
-        #: count of records
-        if self.count is None:
-            self.count = 1
-        else:
-            self.count += 1
+    def add_interval(self, interval):
+        self.periods[interval] = RollupPeriod(self.type, interval, self.cache,
+                                              grace=self.grace, series=self.series)
+        if self.filters is not None:
+            #: reset a filter if a whole rollup interval is missed
+            self.filters.reset_after = 2 * min(self.periods)
 
+    def append(self, record):
+        """Fold ``record`` into every interval; returns how many periods dropped it as late."""
+        return self.extend([record])
+
+    def extend(self, records):
+        """
+        Filter and fold a batch of records into every interval with one
+        vectorized update per period and timeslot. Returns the number of
+        (record, interval) pairs dropped as late.
+        """
+        count = len(records)
+        if not count or not self.periods:
+            return 0
+
+        sids = np.fromiter((self.series.id_of(r) for r in records), np.intp, count)
+        epochs = np.fromiter((_epoch(r['freezetime']) for r in records), np.float64, count)
         try:
-            data = float(data)
-        except TypeError:
-            return
-
-        #: Don't corrupt valid data that we do have with a nan
-        if math.isnan(data):
+            #: None becomes NaN here
+            values = np.array([[r.get(f) for f in self.fields] for r in records], dtype=np.float64)
+        except (TypeError, ValueError):
+            values = np.array([[_float(r.get(f)) for f in self.fields] for r in records], dtype=np.float64)
+        values = values.reshape(count, len(self.fields))
+        flags = None
+        if self.flag_fields:
+            #: A record without flags ANDs all-ones, leaving the slot's unchanged
+            flags = np.fromiter((_flag(r.get(f)) for r in records for f in self.flag_fields),
+                                np.int64, count * len(self.flag_fields)).reshape(count, len(self.flag_fields))
+
+        if self.filters is not None:
+            calc = len(self.calc_fields)
+            values[:, :calc] = self.filters.add(sids, values[:, :calc], epochs)
+
+        late = 0
+        for period in self.periods.values():
+            late += period.extend(epochs, sids, values, flags)
+
+        if late < count * len(self.periods):
+            deadline = min(math.ceil(epochs.min() / p.interval) * p.interval + p.grace
+                           for p in self.periods.values())
+            if self.next_deadline is None or deadline < self.next_deadline:
+                self.next_deadline = deadline
+        return late
+
+    def save_filters(self, cache=None):
+        """Store the whole filter bank (and the series it is indexed by) under one cache key."""
+        cache = self.cache if cache is None else cache
+        if cache is None or self.filters is None or not len(self.series):
             return
+        buf = io.BytesIO()
+        np.savez(buf, series=np.array(json.dumps(self.series.keys)), **self.filters.snapshot())
+        #: base64 so the blob survives clients with decode_responses=True
+        cache[self.cache_key] = base64.b64encode(buf.getvalue()).decode('ascii')
+
+    def load_filters(self, cache=None):
+        """Restore a bank saved by :meth:`save_filters`; only before any record is seen."""
+        cache = self.cache if cache is None else cache
+        if cache is None or self.filters is None or len(self.series):
+            return False
+        blob = cache.get(self.cache_key)
+        if not blob:
+            return False
+        with np.load(io.BytesIO(base64.b64decode(blob))) as snapshot:
+            keys = json.loads(str(snapshot['series']))
+            self.filters.restore(snapshot)
+        for key in keys:
+            self.series.key_id(tuple(key))
+        return True
 
-        if self.store_array and store_array:
-            self.array.append(data)
-            self.identifiers.append(identifier)
+    def expire_all_old(self):
+        records = []
+        for period in self.periods.values():
+            records.extend(period.expire_timeslot(period.get_oldest_not_updated()))
+        self._update_deadline()
+        return records
 
-        if self.min is not None:
-            if data < self.min:
-                self.min = data
-            if data > self.max:
-                self.max = data
+    def expire_all_before(self, timeslot):
+        records = []
+        for period in self.periods.values():
+            records.extend(period.expire_all_before(timeslot))
+        self._update_deadline()
+        return records
+
+
+class RollupHandler(IHandler):
+    """
+    Pipeline stage that rolls records up per ``daq.rollup`` and emits each
+    finished timeslot's aggregates (``rollup_interval`` set) downstream.
+    Raw records are passed through unless ``forward_raw`` is off.
+    """
+
+    def __init__(self, *args, cache=None, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        rollup_cfg = load_config().get('daq', {}).get('rollup') or {}
+        self.intervals = [int(i) for i in rollup_cfg.get('intervals', [60, 300])]
+        self.forward_raw = rollup_cfg.get('forward_raw', True)
+        self.check_interval = rollup_cfg.get('check_interval', 1.0)
+        self.max_batch = rollup_cfg.get('max_batch', 1024)
+        self.cache = cache
 
-            #: In case the number rolls over?
-            if self.min < (self.max/2):
-                self.diff = self.min
-            else:
-                self.diff = self.max - self.min
-        else:
-            self.min = data
-            self.max = data
-            self.diff = 0.0
-
-    def calc(self):
-        if self.min is None:
-            self.min = float('nan')
-        if self.max is None:
-            self.max = float('nan')
-        if self.diff is None:
-            self.diff = float('nan')
-        if self.count is None:
-            self.count = 0
-
-    def to_dict(self):
-        self.calc()
-
-        data = {
-            self.name + '_count': self.count,
-            self.name + '_min': self.min,
-            self.name + '_max': self.max,
-            self.name + '_diff': self.diff,
-        }
+        grace = rollup_cfg.get('grace', 15)
+        filter_frequency = rollup_cfg.get('filter_frequency', 4)
+        self.managers = {}
+        for dtype in rollup_cfg.get('types', list(ROLLUP_MAPPER)):
+            manager = self.managers[dtype] = PeriodManager(dtype, cache, grace=grace,
+                                                           filter_frequency=filter_frequency)
+            for interval in self.intervals:
+                manager.add_interval(interval)
+
+    def _manager(self, record):
+        if not isinstance(record, dict) or 'rollup_interval' in record \
+        or record.get('freezetime') is None:
+            return None
+        return self.managers.get(DTYPE_MAPPER.get(record.get('type'), record.get('type')))
+
+    def observe(self, record):
+        """Fold ``record`` into the rollups without forwarding it."""
+        self.observe_batch([record])
+
+    def observe_batch(self, records):
+        batches = {}
+        for record in records:
+            manager = self._manager(record)
+            if manager is not None:
+                batches.setdefault(manager, []).append(record)
+
+        late = 0
+        for manager, batch in batches.items():
+            late += manager.extend(batch)
+            self.set('records', self.get('records', 0) + len(batch))
+        if late:
+            self.set('late', self.get('late', 0) + late)
+
+    def _next_batch(self, first):
+        batch = [first]
+        while len(batch) < self.max_batch and not self.data_queue.empty():
+            batch.append(self.data_queue.get_nowait())
+        return batch
+
+    async def emit_expired(self):
+        now = utcepochnow()
+        emitted = 0
+        for manager in self.managers.values():
+            for record in manager.process_expirations(now):
+                await self.processed_queue.put(record)
+                emitted += 1
+        if emitted:
+            self.set('emitted', self.get('emitted', 0) + emitted)
+            self.set('series', sum(len(manager.series) for manager in self.managers.values()))
+            self.logger.debug(f"[Rollup] Emitted {emitted} aggregate record(s)")
+            if self.cache is not None:
+                for manager in self.managers.values():
+                    manager.save_filters()
+
+        if self.cache is not None and self.cache.flush_due():
+            try:
+                self.set('cache_flushed', self.get('cache_flushed', 0) + await self.cache.aflush())
+            except Exception as e:
+                self.set('cache_flush_failures', self.get('cache_flush_failures', 0) + 1)
+                self.logger.warning(f"[Rollup] Cache flush failed: {e}")
 
-        return data
+    async def run(self):
+        if self.cache is not None:
+            try:
+                await asyncio.to_thread(self.cache.prefetch, [m.cache_key for m in self.managers.values()])
+            except Exception as e:
+                self.logger.warning(f"[Rollup] Could not prefetch saved filter state: {e}")
+            for manager in self.managers.values():
+                try:
+                    manager.load_filters()
+                except Exception as e:
+                    self.logger.warning(f"[Rollup] Discarding saved {manager.type} filter state: {e}")
+
+        next_check = time.monotonic() + self.check_interval
+        while self._running:
+            try:
+                try:
+                    record = await asyncio.wait_for(
+                        self.data_queue.get(), timeout=max(0.0, next_check - time.monotonic()))
+                except asyncio.TimeoutError:
+                    record = None
+
+                if record is not None:
+                    batch = self._next_batch(record)
+                    started = time.perf_counter()
+                    try:
+                        self.observe_batch(batch)
+                        self.metrics.processed((time.perf_counter() - started) / len(batch), len(batch))
+                    finally:
+                        # A rollup failure must not cost the raw records
+                        if self.forward_raw:
+                            for record in batch:
+                                await self.processed_queue.put(record)
+
+                if time.monotonic() >= next_check:
+                    next_check = time.monotonic() + self.check_interval
+                    await self.emit_expired()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.logger.error(f"[Rollup] Error: {e}", exc_info=True)
+
+    async def stop(self):
+        was_running = self._running
+        await super().stop()
+        if was_running:
+            # Fold in and pass on what is still queued; the stages downstream stop later
+            batch = []
+            while not self.data_queue.empty():
+                batch.append(self.data_queue.get_nowait())
+            try:
+                self.observe_batch(batch)
+            except Exception as e:
+                self.logger.error(f"[Rollup] Error: {e}", exc_info=True)
+            if self.forward_raw:
+                for record in batch:
+                    await self.processed_queue.put(record)
+        if self.cache is not None:
+            for manager in self.managers.values():
+                manager.save_filters()
+            try:
+                await self.cache.aflush()
+            except Exception as e:
+                self.logger.warning(f"[Rollup] Final cache flush failed: {e}")
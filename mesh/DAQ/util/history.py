@@ -0,0 +1,385 @@
+"""
+Edge-local telemetry history
+----------------------------
+
+Keeps the last few hours of samples of every device in fixed-size,
+memory-mapped ring files, so "what did panel X do in the last hour" can be
+answered on site while the uplink is down::
+
+    <path>/0000FA29EB6D0001.ring
+    <path>/0000FA29EB6D0002.ring
+    ...
+
+Each ring file is a header followed by one column per field, ``slots``
+entries each::
+
+    magic     4s   b"MRNG"
+    version   u16  RING_VERSION
+    nfields   u16  number of value columns
+    slots     u32  capacity of every column
+    fields    u32  crc32 of the comma-joined field names
+    head      u64  samples ever written (next slot is head % slots)
+    last      u32  timestamp of the newest sample
+    times          slots * u32, epoch seconds
+    columns        nfields * slots * f32, in FIELDS order
+
+Columns are NumPy views of the mapping, so appends are plain array stores
+and a range query that does not cross the wrap point is a zero-copy slice.
+The head is written after the samples; a crash loses at most the samples
+of the frame being written. Dirty rings are msync'ed every
+``flush_interval`` seconds.
+
+Disk use is bounded by ``max_devices`` rings of ``hours * 3600 /
+sample_interval`` slots; past ``max_devices`` the ring written to least
+recently is deleted. Range queries assume each device's samples arrive in
+time order, which the gateways guarantee.
+"""
+
+import json
+import mmap
+import os
+import struct
+import time
+import zlib
+
+import numpy as np
+
+from DAQ.util.config import load_config
+from DAQ.util.logger import make_logger
+
+logger = make_logger("History")
+
+RING = struct.Struct("<4sHHIIQI")
+RING_MAGIC = b"MRNG"
+RING_VERSION = 1
+RING_HEADER_SIZE = 64
+RING_SUFFIX = ".ring"
+
+FIELDS = ("Vi", "Vo", "Ii", "Io", "Pi", "Po", "temperature", "irradiance", "op_stat", "reg_stat")
+TIME_DTYPE = np.dtype("<u4")
+VALUE_DTYPE = np.dtype("<f4")
+
+
+def ring_size(slots, nfields):
+    return RING_HEADER_SIZE + slots * (TIME_DTYPE.itemsize + nfields * VALUE_DTYPE.itemsize)
+
+
+def _fields_crc(fields):
+    return zlib.crc32(",".join(fields).encode())
+
+
+class HistoryRing:
+    """One device's ring file, mapped in place."""
+
+    def __init__(self, path, slots, fields=FIELDS):
+        self.path = path
+        self.slots = int(slots)
+        self.fields = tuple(fields)
+        self.dirty = False
+
+        size = ring_size(self.slots, len(self.fields))
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fresh = os.fstat(fd).st_size != size
+            if fresh:
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, size)
+            self._map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+
+        if not fresh:
+            magic, version, nfields, slots, crc, head, last = RING.unpack_from(self._map)
+            fresh = (magic, version, nfields, slots, crc) != (
+                RING_MAGIC, RING_VERSION, len(self.fields), self.slots, _fields_crc(self.fields))
+            if fresh:
+                logger.warning(f"[History] {path} has another layout; starting it over")
+        if fresh:
+            self.head, self.last = 0, 0
+            self._store_header()
+        else:
+            self.head, self.last = head, last
+
+        offset = RING_HEADER_SIZE
+        self.times = np.frombuffer(self._map, dtype=TIME_DTYPE, count=self.slots, offset=offset)
+        offset += self.times.nbytes
+        self.values = np.frombuffer(self._map, dtype=VALUE_DTYPE, count=self.slots * len(self.fields),
+                                    offset=offset).reshape(len(self.fields), self.slots)
+        if fresh:
+            self.times[:] = 0
+
+    def _store_header(self):
+        RING.pack_into(self._map, 0, RING_MAGIC, RING_VERSION, len(self.fields), self.slots,
+                       _fields_crc(self.fields), self.head, self.last)
+
+    def __len__(self):
+        return min(self.head, self.slots)
+
+    def write(self, times, values):
+        """Append ``times`` (n,) and ``values`` (nfields, n), oldest first."""
+        count = len(times)
+        if count > self.slots:
+            times, values = times[-self.slots:], values[:, -self.slots:]
+            self.head += count - self.slots
+            count = self.slots
+        start = self.head % self.slots
+        first = min(count, self.slots - start)
+        self.times[start:start + first] = times[:first]
+        self.values[:, start:start + first] = values[:, :first]
+        if first < count:
+            self.times[:count - first] = times[first:]
+            self.values[:, :count - first] = values[:, first:]
+        self.head += count
+        self.last = int(times[-1])
+        self._store_header()
+        self.dirty = True
+
+    def segments(self):
+        """Slot ranges holding samples, oldest first."""
+        if self.head <= self.slots:
+            return [(0, self.head)]
+        start = self.head % self.slots
+        return [(start, self.slots), (0, start)] if start else [(0, self.slots)]
+
+    def query(self, start=None, end=None, fields=None, limit=None):
+        """
+        Samples with ``start <= time <= end`` (epoch seconds, either bound
+        optional) as ``(times, {field: values})``. The arrays are read-only
+        views of the ring unless the range spans its wrap point; ``limit``
+        keeps the newest samples only.
+        """
+        fields = self.fields if fields is None else tuple(fields)
+        rows = [self.fields.index(field) for field in fields]
+        pieces = []
+        for lo, hi in self.segments():
+            times = self.times[lo:hi]
+            first = 0 if start is None else int(np.searchsorted(times, start, side="left"))
+            stop = len(times) if end is None else int(np.searchsorted(times, end, side="right"))
+            if first < stop:
+                pieces.append((lo + first, lo + stop))
+        if limit is not None:
+            pieces = _newest(pieces, int(limit))
+
+        if len(pieces) == 1:
+            lo, hi = pieces[0]
+            times = _read_only(self.times[lo:hi])
+            values = {field: _read_only(self.values[row, lo:hi]) for field, row in zip(fields, rows)}
+        else:
+            times = np.concatenate([self.times[lo:hi] for lo, hi in pieces] or [self.times[:0]])
+            values = {field: np.concatenate([self.values[row, lo:hi] for lo, hi in pieces] or [self.values[row, :0]])
+                      for field, row in zip(fields, rows)}
+        return times, values
+
+    def flush(self):
+        if self.dirty:
+            self._map.flush()
+            self.dirty = False
+
+    def close(self):
+        self.flush()
+        # Views must go before the mapping can be closed; one still held by
+        # a query result keeps it mapped until that is garbage collected
+        self.times = self.values = None
+        try:
+            self._map.close()
+        except BufferError:
+            pass
+
+
+def _read_only(view):
+    view.flags.writeable = False
+    return view
+
+
+def _newest(pieces, limit):
+    kept = []
+    for lo, hi in reversed(pieces):
+        if limit <= 0:
+            break
+        kept.append((max(lo, hi - limit), hi))
+        limit -= hi - kept[-1][0]
+    return kept[::-1]
+
+
+class HistoryStore:
+    """Ring files of every device seen, one directory per worker."""
+
+    def __init__(self, path, hours=24, sample_interval=5, max_devices=1024, flush_interval=30.0,
+                 fields=FIELDS):
+        self.path = path
+        self.slots = max(1, int(hours * 3600 / sample_interval))
+        self.max_devices = int(max_devices)
+        self.flush_interval = float(flush_interval)
+        self.fields = tuple(fields)
+        self.rings = {}
+        self.evicted = 0
+        self._flushed_at = time.monotonic()
+
+        os.makedirs(path, exist_ok=True)
+        for name in sorted(os.listdir(path)):
+            if name.endswith(RING_SUFFIX):
+                self.rings[name[:-len(RING_SUFFIX)]] = HistoryRing(
+                    os.path.join(path, name), self.slots, self.fields)
+        self._evict(self.max_devices)
+        logger.info(f"[History] {len(self.rings)} device(s) in {path}; "
+                    f"{self.slots} samples per device, at most {self.disk_bound / 1e6:.1f} MB")
+
+    @property
+    def disk_bound(self):
+        return self.max_devices * ring_size(self.slots, len(self.fields))
+
+    def _ring_path(self, macaddr):
+        return os.path.join(self.path, f"{macaddr}{RING_SUFFIX}")
+
+    def _evict(self, keep):
+        while len(self.rings) > keep:
+            macaddr = min(self.rings, key=lambda mac: self.rings[mac].last)
+            self.rings.pop(macaddr).close()
+            os.unlink(self._ring_path(macaddr))
+            self.evicted += 1
+            logger.warning(f"[History] Over {self.max_devices} devices; dropped the history of {macaddr}")
+
+    def ring(self, macaddr, create=False):
+        # Gateway records carry the MAC as hex bytes, commands as str
+        macaddr = (macaddr.decode() if isinstance(macaddr, bytes) else str(macaddr)).upper()
+        ring = self.rings.get(macaddr)
+        if ring is None and create:
+            self._evict(self.max_devices - 1)
+            ring = self.rings[macaddr] = HistoryRing(self._ring_path(macaddr), self.slots, self.fields)
+        return ring
+
+    def record(self, macaddr, records):
+        """Append the samples of one device (record dicts with ``freezetime``)."""
+        if not records:
+            return
+        times = np.fromiter((epoch_seconds(r.get("freezetime")) for r in records), TIME_DTYPE, len(records))
+        values = np.array([[r.get(field) or 0.0 for r in records] for field in self.fields], dtype=VALUE_DTYPE)
+        self.ring(macaddr, create=True).write(times, values)
+        self.flush_if_due()
+
+    def query(self, macaddr, start=None, end=None, fields=None, limit=None):
+        """Like :meth:`HistoryRing.query`; None if the device has no history here."""
+        ring = self.ring(macaddr)
+        if ring is None:
+            return None
+        return ring.query(start, end, fields, limit)
+
+    def flush_if_due(self):
+        if time.monotonic() - self._flushed_at >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        for ring in self.rings.values():
+            ring.flush()
+        self._flushed_at = time.monotonic()
+
+    def stats(self):
+        return {
+            'devices': len(self.rings),
+            'evicted': self.evicted,
+            'disk_bytes': len(self.rings) * ring_size(self.slots, len(self.fields)),
+        }
+
+    def close(self):
+        for ring in self.rings.values():
+            ring.close()
+        self.rings = {}
+
+
+def epoch_seconds(value, now=None):
+    """
+    Epoch seconds of a datetime or number; a negative number is relative
+    to ``now`` (``-3600`` is an hour ago). None stays None.
+    """
+    if value is None:
+        return None
+    if hasattr(value, "timestamp"):
+        return int(value.timestamp())
+    value = int(float(value))
+    if value < 0:
+        value += int(time.time() if now is None else now)
+    return value
+
+
+def make_history(name):
+    """
+    Build the history store for ``name`` from config.yaml, or None if it is
+    disabled or its directory cannot be used:
+
+      daq:
+        history:
+          enabled: false
+          path: /var/lib/mesh-daq/history   # one sub-directory per worker
+          hours: 24
+          sample_interval: 5
+          max_devices: 1024
+          flush_interval: 30
+    """
+    history_cfg = load_config().get("daq", {}).get("history") or {}
+    if not history_cfg.get("enabled", False):
+        return None
+    path = os.path.join(history_cfg.get("path", "/var/lib/mesh-daq/history"), name)
+    try:
+        return HistoryStore(
+            path,
+            hours=history_cfg.get("hours", 24),
+            sample_interval=history_cfg.get("sample_interval", 5),
+            max_devices=history_cfg.get("max_devices", 1024),
+            flush_interval=history_cfg.get("flush_interval", 30.0),
+        )
+    except OSError as e:
+        logger.error(f"[History] Cannot open history at {path}: {e}; continuing without one")
+        return None
+
+
+def encode_reply(macaddr, times, values):
+    """Query result as a BSON-ready dict of little-endian column bytes."""
+    return {
+        'status': True,
+        'macaddr': macaddr,
+        'count': len(times),
+        'fields': list(values),
+        'dtypes': {'times': TIME_DTYPE.str, 'values': VALUE_DTYPE.str},
+        'times': times.tobytes(),
+        'values': {field: column.tobytes() for field, column in values.items()},
+    }
+
+
+def decode_reply(reply):
+    """Inverse of :func:`encode_reply`: ``(times, {field: values})`` arrays."""
+    times = np.frombuffer(reply['times'], dtype=reply['dtypes']['times'])
+    values = {field: np.frombuffer(column, dtype=reply['dtypes']['values'])
+              for field, column in reply['values'].items()}
+    return times, values
+
+
+def http_query(store, params):
+    """
+    ``GET /history?mac=<macaddr>&start=-3600&end=...&fields=Vi,Pi&limit=N``
+    on the admin port, answered as JSON ``(status, content_type, body)``.
+    """
+    if store is None:
+        return "404 Not Found", "application/json", b'{"status": false, "msg": "History is disabled"}'
+    try:
+        macaddr = params["mac"]
+        fields = params["fields"].split(",") if params.get("fields") else None
+        limit = int(params["limit"]) if params.get("limit") else None
+        now = time.time()
+        result = store.query(macaddr, epoch_seconds(params.get("start"), now),
+                             epoch_seconds(params.get("end"), now), fields, limit)
+    except (KeyError, ValueError) as e:
+        body = {"status": False, "msg": f"Bad history query: {e}"}
+        return "400 Bad Request", "application/json", json.dumps(body).encode()
+    if result is None:
+        body = {"status": False, "msg": f"No history for {macaddr}"}
+        return "404 Not Found", "application/json", json.dumps(body).encode()
+
+    times, values = result
+    body = {
+        "status": True,
+        "macaddr": macaddr.upper(),
+        "count": len(times),
+        "times": times.tolist(),
+        "values": {field: column.tolist() for field, column in values.items()},
+    }
+    return "200 OK", "application/json", json.dumps(body).encode()
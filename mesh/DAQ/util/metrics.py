@@ -0,0 +1,218 @@
+"""
+Pipeline stage instrumentation
+------------------------------
+
+Every pipeline stage (the gateway ``recv`` queue and each IHandler) gets a
+:class:`StageMetrics` in :data:`REGISTRY`:
+
+- input queue depth, drops and coalesced items (read from the stage's
+  BoundedQueue at scrape time)
+- items in (queue puts) and items out, as counters and as per-second rates
+  over the interval since the previous scrape
+- a per-item processing-time histogram
+- a queue-wait histogram (time from put to get, observed by BoundedQueue)
+
+Recording an item is a couple of integer increments and one bisect into a
+fixed bucket list; all formatting happens in :func:`render_prometheus`, so
+nothing is spent on metrics unless someone scrapes them.
+
+:func:`start_admin_server` serves ``GET /metrics`` in the Prometheus text
+exposition format on a small local HTTP port, plus any extra ``routes``.
+"""
+
+import asyncio
+import time
+from bisect import bisect_left
+from urllib.parse import parse_qsl
+
+from DAQ.util.logger import make_logger
+
+logger = make_logger("Metrics")
+
+# Seconds; spans sub-millisecond decode up to minute-long batch windows
+BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0,
+)
+
+
+class Histogram:
+    """Fixed-bucket histogram; ``counts[i]`` is non-cumulative."""
+
+    __slots__ = ('bounds', 'counts', 'count', 'sum')
+
+    def __init__(self, bounds=BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value, count=1):
+        self.counts[bisect_left(self.bounds, value)] += count
+        self.count += count
+        self.sum += value * count
+
+    def cumulative(self):
+        """``(le, cumulative count)`` pairs ending with ``+Inf``."""
+        running = 0
+        for bound, count in zip(self.bounds + (float('inf'),), self.counts):
+            running += count
+            yield bound, running
+
+
+class StageMetrics:
+    """Counters and histograms for one pipeline stage."""
+
+    def __init__(self, stage, queue=None, state=None):
+        self.stage = stage
+        self.queue = queue
+        self.state = state
+        self.items_out = 0
+        self.processing = Histogram()
+        self._rate_at = time.monotonic()
+        self._rate_in = self._rate_out = 0
+
+    @property
+    def items_in(self):
+        return getattr(self.queue, 'puts', 0)
+
+    def processed(self, seconds, count=1):
+        """Record ``count`` items leaving the stage after ``seconds`` of work (per item)."""
+        self.processing.observe(seconds, count)
+        self.items_out += count
+
+    def rates(self):
+        """Items in/out per second since the previous call."""
+        now = time.monotonic()
+        elapsed = max(now - self._rate_at, 1e-9)
+        items_in, items_out = self.items_in, self.items_out
+        rates = ((items_in - self._rate_in) / elapsed, (items_out - self._rate_out) / elapsed)
+        self._rate_at, self._rate_in, self._rate_out = now, items_in, items_out
+        return rates
+
+
+REGISTRY = {}   # stage name -> StageMetrics
+
+
+def register_stage(stage, queue=None, state=None):
+    metrics = StageMetrics(stage, queue, state)
+    REGISTRY[stage] = metrics
+    return metrics
+
+
+# ---------------------
+# Prometheus text format
+# ---------------------
+
+def _labels(labels):
+    return ",".join(f'{key}="{value}"' for key, value in labels.items())
+
+
+def _histogram(lines, name, labels, histogram):
+    for bound, count in histogram.cumulative():
+        le = "+Inf" if bound == float('inf') else repr(bound)
+        lines.append(f'{name}_bucket{{{labels},le="{le}"}} {count}')
+    lines.append(f"{name}_sum{{{labels}}} {histogram.sum}")
+    lines.append(f"{name}_count{{{labels}}} {histogram.count}")
+
+
+def render_prometheus(registry=None, labels=None):
+    """Render every registered stage in the Prometheus text exposition format."""
+    registry = REGISTRY if registry is None else registry
+    base = dict(labels or {})
+    families = {
+        'queue_depth': ('gauge', "Items waiting in the stage's input queue", []),
+        'queue_dropped_total': ('counter', "Items discarded by the input queue's policy", []),
+        'queue_coalesced_total': ('counter', "Items replaced in place by a newer item for the same MAC", []),
+        'items_in_total': ('counter', "Items put on the stage's input queue", []),
+        'items_out_total': ('counter', "Items the stage finished processing", []),
+        'items_in_rate': ('gauge', "Items in per second since the previous scrape", []),
+        'items_out_rate': ('gauge', "Items out per second since the previous scrape", []),
+        'processing_seconds': ('histogram', "Per-item processing time", []),
+        'queue_wait_seconds': ('histogram', "Time items spent waiting in the input queue", []),
+        'state': ('gauge', "Numeric handler state values", []),
+    }
+
+    for stage in sorted(registry):
+        metrics = registry[stage]
+        labels = _labels({**base, 'stage': stage})
+        queue = metrics.queue
+        rate_in, rate_out = metrics.rates()
+
+        if queue is not None:
+            families['queue_depth'][2].append(f"{{{labels}}} {queue.qsize()}")
+            families['queue_dropped_total'][2].append(f"{{{labels}}} {getattr(queue, 'drops', 0)}")
+            families['queue_coalesced_total'][2].append(f"{{{labels}}} {getattr(queue, 'coalesced', 0)}")
+        families['items_in_total'][2].append(f"{{{labels}}} {metrics.items_in}")
+        families['items_out_total'][2].append(f"{{{labels}}} {metrics.items_out}")
+        families['items_in_rate'][2].append(f"{{{labels}}} {rate_in:.3f}")
+        families['items_out_rate'][2].append(f"{{{labels}}} {rate_out:.3f}")
+        families['processing_seconds'][2].append((labels, metrics.processing))
+        wait = getattr(queue, 'wait_histogram', None)
+        if wait is not None:
+            families['queue_wait_seconds'][2].append((labels, wait))
+        for key, value in sorted((metrics.state or {}).items()):
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                families['state'][2].append(f'{{{labels},key="{key}"}} {value}')
+
+    lines = []
+    for family, (kind, help_text, samples) in families.items():
+        if not samples:
+            continue
+        name = f"mesh_stage_{family}"
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for sample in samples:
+            if kind == 'histogram':
+                _histogram(lines, name, *sample)
+            else:
+                lines.append(f"{name}{sample}")
+    lines.append("")
+    return "\n".join(lines)
+
+
+# ---------------------
+# Admin HTTP endpoint
+# ---------------------
+
+async def start_admin_server(host, port, labels=None, routes=None):
+    """
+    Serve ``GET /metrics`` on ``host:port``; returns the asyncio server.
+
+    ``routes`` maps further GET paths to callables taking the query
+    parameters as a dict and returning ``(status, content_type, body)``;
+    a route that raises is answered with a 500.
+    """
+    routes = routes or {}
+
+    async def handle(reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readline(), timeout=5)
+            while (await asyncio.wait_for(reader.readline(), timeout=5)) not in (b"\r\n", b"\n", b""):
+                pass
+            parts = request.decode("latin-1").split()
+            path, _, query = (parts[1] if len(parts) > 1 else "").partition("?")
+            if parts[:1] == ["GET"] and path == "/metrics":
+                status, content_type = "200 OK", "text/plain; version=0.0.4; charset=utf-8"
+                body = render_prometheus(labels=labels).encode()
+            elif parts[:1] == ["GET"] and path in routes:
+                try:
+                    status, content_type, body = routes[path](dict(parse_qsl(query)))
+                except Exception as e:
+                    logger.error(f"[Metrics] {path} failed: {e}", exc_info=True)
+                    status, content_type, body = "500 Internal Server Error", "text/plain", b"internal error\n"
+            else:
+                status, content_type, body = "404 Not Found", "text/plain", b"not found\n"
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    logger.info(f"[Metrics] Serving Prometheus metrics on http://{host}:{port}/metrics")
+    return server
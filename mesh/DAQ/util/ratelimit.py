@@ -0,0 +1,30 @@
+import time
+
+
+class TokenBucket:
+    """
+    Token bucket rate limiter.
+
+    ``rate`` tokens are added per second up to ``burst`` seconds' worth.
+    :meth:`reserve` always takes the tokens (the bucket may go into debt)
+    and returns how long the caller should wait before acting, so waiting
+    callers are served in order and the long-run rate stays at ``rate``.
+    A ``rate`` of 0 disables limiting.
+    """
+
+    def __init__(self, rate=0.0, burst=1.0):
+        self.rate = float(rate or 0.0)
+        self.capacity = self.rate * max(float(burst), 0.0) or self.rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def reserve(self, amount=1.0):
+        if not self.rate:
+            return 0.0
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= amount
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / self.rate
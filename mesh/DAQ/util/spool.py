@@ -0,0 +1,336 @@
+"""
+Durable store-and-forward spool
+-------------------------------
+
+Append-only FIFO of opaque payloads (compressed uplink batches) kept on disk
+while the uplink is down. Payloads are written to fixed-size segment files::
+
+    <path>/00000000000000000000.seg
+    <path>/00000000000000000001.seg
+    ...
+
+Each record is ``length u32 | crc32 u32 | key_length u16 | key | payload``,
+where length and crc cover key and payload; a zero length marks the end of a
+segment (segments are preallocated, so unused space reads as zero). The
+optional key travels with the payload, e.g. the message ID it was first
+published under.
+A payload larger than ``segment_size`` gets a segment of its own.
+
+Read and write cursors live in a small memory-mapped index file, updated in
+place. Appends are fsync'ed in batches (every ``fsync_every`` records or
+``fsync_interval`` seconds). On open the write cursor is re-derived from the
+CRC-valid records in the last segment, so records torn by a crash are
+dropped and records written after the last index flush are kept.
+
+Segments are deleted once every record in them has been acknowledged, and
+the oldest segment is discarded when the spool would grow past
+``max_bytes``.
+"""
+
+import mmap
+import os
+import struct
+import time
+import zlib
+
+from DAQ.util.config import load_config
+from DAQ.util.logger import make_logger
+
+logger = make_logger("Spool")
+
+RECORD = struct.Struct("<IIH")
+INDEX = struct.Struct("<4sIQQQQ")
+INDEX_MAGIC = b"MSPL"
+INDEX_VERSION = 2
+INDEX_FILE = "index"
+SEGMENT_SUFFIX = ".seg"
+
+
+class Spool:
+    """Segmented on-disk FIFO with an mmap'd cursor index."""
+
+    def __init__(self, path, segment_size=16 * 1024 * 1024, max_bytes=1024 * 1024 * 1024,
+                 fsync_every=32, fsync_interval=1.0):
+        self.path = path
+        self.segment_size = int(segment_size)
+        self.max_bytes = int(max_bytes or 0)
+        self.fsync_every = max(1, int(fsync_every))
+        self.fsync_interval = float(fsync_interval)
+
+        self.pending = 0           # records written but not yet acknowledged
+        self.appended = 0
+        self.acked = 0
+        self.dropped = 0           # records lost to the max_bytes bound
+
+        self._unsynced = 0
+        self._synced_at = time.monotonic()
+        self._write_fd = None
+        self._read_fd = None
+        self._read_fd_segment = None
+
+        os.makedirs(path, exist_ok=True)
+        self._open_index()
+        self._recover()
+
+    # ---------------------
+    # Index / recovery
+    # ---------------------
+
+    def _open_index(self):
+        index_path = os.path.join(self.path, INDEX_FILE)
+        fd = os.open(index_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fresh = os.fstat(fd).st_size < INDEX.size
+            if fresh:
+                os.ftruncate(fd, mmap.PAGESIZE)
+            self._index = mmap.mmap(fd, mmap.PAGESIZE)
+        finally:
+            os.close(fd)
+
+        if fresh:
+            self.read_segment = self.read_offset = 0
+            self.write_segment = self.write_offset = 0
+            self._store_index()
+            return
+
+        magic, version, rs, ro, ws, wo = INDEX.unpack_from(self._index)
+        if magic != INDEX_MAGIC or version != INDEX_VERSION:
+            raise ValueError(f"Unrecognized spool index in {self.path}")
+        self.read_segment, self.read_offset = rs, ro
+        self.write_segment, self.write_offset = ws, wo
+
+    def _store_index(self):
+        INDEX.pack_into(self._index, 0, INDEX_MAGIC, INDEX_VERSION,
+                        self.read_segment, self.read_offset,
+                        self.write_segment, self.write_offset)
+
+    def _recover(self):
+        # The write cursor ends at the last intact record of the last segment
+        self._open_write_segment()
+        self.write_offset = self.read_offset if self.read_segment == self.write_segment else 0
+        for offset, length in self._scan(self.write_segment, self.write_offset):
+            self.write_offset = offset + RECORD.size + length
+
+        # Count what is still unacknowledged
+        for segment in range(self.read_segment, self.write_segment + 1):
+            start = self.read_offset if segment == self.read_segment else 0
+            self.pending += sum(1 for _ in self._scan(segment, start))
+
+        for segment in self._segments():
+            if segment < self.read_segment:
+                self._unlink(segment)
+        self._store_index()
+        if self.pending:
+            logger.info(f"[Spool] Recovered {self.pending} pending record(s) from {self.path}")
+
+    def _scan(self, segment, offset):
+        """Yield ``(offset, length)`` of valid records in ``segment`` from ``offset``."""
+        try:
+            with open(self._segment_path(segment), "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return
+        while offset + RECORD.size <= len(data):
+            length, crc, _ = RECORD.unpack_from(data, offset)
+            start = offset + RECORD.size
+            if not length or start + length > len(data):
+                return
+            if zlib.crc32(data[start:start + length]) != crc:
+                logger.warning(f"[Spool] CRC mismatch in segment {segment} at {offset}; truncating")
+                return
+            yield offset, length
+            offset = start + length
+
+    # ---------------------
+    # Segments
+    # ---------------------
+
+    def _segment_path(self, segment):
+        return os.path.join(self.path, f"{segment:020d}{SEGMENT_SUFFIX}")
+
+    def _segments(self):
+        return sorted(int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(self.path)
+                      if name.endswith(SEGMENT_SUFFIX))
+
+    def _unlink(self, segment):
+        if self._read_fd_segment == segment:
+            self._close_read_fd()
+        try:
+            os.unlink(self._segment_path(segment))
+        except FileNotFoundError:
+            pass
+
+    def _open_write_segment(self):
+        self._write_fd = os.open(self._segment_path(self.write_segment), os.O_RDWR | os.O_CREAT, 0o644)
+        if os.fstat(self._write_fd).st_size < self.segment_size:
+            os.ftruncate(self._write_fd, self.segment_size)
+
+    def _roll(self):
+        if self.write_offset + RECORD.size <= self.segment_size:
+            # End marker, in case a crash left stale bytes past the cursor
+            os.pwrite(self._write_fd, bytes(RECORD.size), self.write_offset)
+        self.sync()
+        os.close(self._write_fd)
+        self.write_segment += 1
+        self.write_offset = 0
+        self._open_write_segment()
+        self._store_index()
+        self._enforce_limit()
+
+    def _enforce_limit(self):
+        if not self.max_bytes:
+            return
+        while (self.write_segment - self.read_segment + 1) * self.segment_size > self.max_bytes \
+                and self.read_segment < self.write_segment:
+            lost = sum(1 for offset, _ in self._scan(self.read_segment, self.read_offset))
+            self.pending -= lost
+            self.dropped += lost
+            self._unlink(self.read_segment)
+            self.read_segment += 1
+            self.read_offset = 0
+            logger.warning(f"[Spool] Over {self.max_bytes} bytes; discarded {lost} oldest record(s)")
+        self._store_index()
+
+    @property
+    def disk_bytes(self):
+        return (self.write_segment - self.read_segment + 1) * self.segment_size
+
+    # ---------------------
+    # Append
+    # ---------------------
+
+    def append(self, payload, key=None):
+        key = key.encode() if isinstance(key, str) else (key or b"")
+        body = key + bytes(payload)
+        size = RECORD.size + len(body)
+        if self.write_offset and self.write_offset + size > self.segment_size:
+            self._roll()
+        header = RECORD.pack(len(body), zlib.crc32(body), len(key))
+        os.pwrite(self._write_fd, header + body, self.write_offset)
+        self.write_offset += size
+        self.pending += 1
+        self.appended += 1
+        self._unsynced += 1
+        if self._unsynced >= self.fsync_every:
+            self.sync()
+        else:
+            self.sync_if_due()
+
+    def sync(self):
+        """fsync appended records and advance the durable write cursor."""
+        if self._unsynced:
+            os.fsync(self._write_fd)
+            self._unsynced = 0
+        self._store_index()
+        self._index.flush()
+        self._synced_at = time.monotonic()
+
+    def sync_if_due(self):
+        if self._unsynced and time.monotonic() - self._synced_at >= self.fsync_interval:
+            self.sync()
+
+    # ---------------------
+    # Read / acknowledge
+    # ---------------------
+
+    def _close_read_fd(self):
+        if self._read_fd is not None:
+            os.close(self._read_fd)
+            self._read_fd = self._read_fd_segment = None
+
+    def _pread(self, segment, size, offset):
+        if self._read_fd_segment != segment:
+            self._close_read_fd()
+            self._read_fd = os.open(self._segment_path(segment), os.O_RDONLY)
+            self._read_fd_segment = segment
+        return os.pread(self._read_fd, size, offset)
+
+    def read(self, max_count):
+        """
+        Return up to ``max_count`` of the oldest unacknowledged records as
+        ``(position, key, payload)`` tuples, plus an opaque cursor to pass to
+        :meth:`ack` once they are delivered. ``position`` is the record's
+        ``(segment, offset)``, stable for as long as it stays spooled; ``key``
+        is the string given to :meth:`append`, or None.
+        """
+        entries = []
+        segment, offset = self.read_segment, self.read_offset
+        while len(entries) < max_count:
+            if segment == self.write_segment and offset >= self.write_offset:
+                break
+            header = self._pread(segment, RECORD.size, offset)
+            length, _, key_length = RECORD.unpack(header) if len(header) == RECORD.size else (0, 0, 0)
+            if not length:
+                if segment >= self.write_segment:
+                    break
+                segment, offset = segment + 1, 0
+                continue
+            body = self._pread(segment, length, offset + RECORD.size)
+            entries.append(((segment, offset), body[:key_length].decode() or None, body[key_length:]))
+            offset += RECORD.size + length
+        return entries, (segment, offset, [position for position, _, _ in entries])
+
+    def ack(self, cursor):
+        """Mark everything up to ``cursor`` delivered and delete finished segments."""
+        segment, offset, positions = cursor
+        if (segment, offset) <= (self.read_segment, self.read_offset):
+            return  # already discarded by the max_bytes bound
+        # The max_bytes bound may have discarded (and counted) the head of the
+        # batch while it was in flight; only what is still spooled is acked
+        read_position = (self.read_segment, self.read_offset)
+        count = sum(1 for position in positions if position >= read_position)
+        for finished in range(self.read_segment, segment):
+            self._unlink(finished)
+        self.read_segment, self.read_offset = segment, offset
+        self.pending -= count
+        self.acked += count
+        self._store_index()
+        self._index.flush()
+
+    def stats(self):
+        return {
+            'pending': self.pending,
+            'appended': self.appended,
+            'acked': self.acked,
+            'dropped': self.dropped,
+            'disk_bytes': self.disk_bytes,
+        }
+
+    def close(self):
+        if self._write_fd is not None:
+            self.sync()
+            os.close(self._write_fd)
+            self._write_fd = None
+        self._close_read_fd()
+        self._index.close()
+
+
+def make_spool(name):
+    """
+    Build the spool for pipeline stage ``name`` from config.yaml, or None if
+    spooling is disabled or the spool directory cannot be used:
+
+      daq:
+        spool:
+          enabled: true
+          path: /var/lib/mesh-daq/spool   # one sub-directory per stage
+          segment_size: 16777216
+          max_bytes: 1073741824
+          fsync_every: 32
+          fsync_interval: 1.0
+    """
+    spool_cfg = load_config().get("daq", {}).get("spool") or {}
+    if not spool_cfg.get("enabled", False):
+        return None
+    path = os.path.join(spool_cfg.get("path", "/var/lib/mesh-daq/spool"), name)
+    try:
+        return Spool(
+            path,
+            segment_size=spool_cfg.get("segment_size", 16 * 1024 * 1024),
+            max_bytes=spool_cfg.get("max_bytes", 1024 * 1024 * 1024),
+            fsync_every=spool_cfg.get("fsync_every", 32),
+            fsync_interval=spool_cfg.get("fsync_interval", 1.0),
+        )
+    except (OSError, ValueError) as e:
+        logger.error(f"[Spool] Cannot open spool at {path}: {e}; continuing without one")
+        return None
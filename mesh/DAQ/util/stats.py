@@ -1,7 +1,8 @@
 
 import math
 from collections import deque
-from scipy.stats import stats
+
+import numpy as np
 
 
 def frange(start, stop=None, increment=1.0, significant=5):
@@ -58,6 +59,8 @@ def is_outlier(x, mean, stdev):
         return False
 
 def meanstdv(the_list):
+    from scipy.stats import stats
+
     if the_list:
         return stats.mean(the_list), stats.stdev(the_list)
     else:
@@ -148,6 +151,127 @@ class LowPassFloatFIR(LowPassFloat):
 
         return self
 
+class LowPassFilterBank(object):
+    """
+    :class:`LowPassFloat` filters for many channels at once.
+
+    Rows are series and columns are fields; the IIR value, last raw sample,
+    iteration count and time of the last sample of every channel live in
+    contiguous arrays, so a batch of samples is filtered in one vectorized
+    call. Per channel the behaviour matches ``LowPassFloat`` as the rollup
+    used it: NaN samples are ignored, a 0.0 sample (open circuit) sets the
+    value to 0.0 immediately, and a channel that has not seen a sample for
+    ``reset_after`` seconds restarts from its next sample.
+    """
+
+    def __init__(self, fields, frequency=7, reset_after=None, capacity=16):
+        self.fields = fields
+        self.frequency = float(frequency)
+        self.stable_at = int(frequency * 3.125)
+        self.reset_after = reset_after
+
+        self.value = np.zeros((capacity, fields))
+        self.last_addition = np.zeros((capacity, fields))
+        self.iterations = np.zeros((capacity, fields), dtype=np.int32)
+        self.stamp = np.full(capacity, np.nan)
+
+    def __len__(self):
+        return len(self.stamp)
+
+    def reserve(self, size):
+        """Grow to at least ``size`` rows (new rows start reset)."""
+        if size <= len(self.stamp):
+            return
+        grow = max(size, 2 * len(self.stamp)) - len(self.stamp)
+        self.value = np.vstack((self.value, np.zeros((grow, self.fields))))
+        self.last_addition = np.vstack((self.last_addition, np.zeros((grow, self.fields))))
+        self.iterations = np.vstack((self.iterations, np.zeros((grow, self.fields), dtype=np.int32)))
+        self.stamp = np.concatenate((self.stamp, np.full(grow, np.nan)))
+
+    def reset(self, rows):
+        self.value[rows] = 0.0
+        self.last_addition[rows] = 0.0
+        self.iterations[rows] = 0
+
+    def add(self, rows, samples, times=None):
+        """
+        Filter ``samples`` (shape ``(len(rows), fields)``) into ``rows`` and
+        return the filtered values. ``times`` (epoch seconds per sample)
+        drive ``reset_after``. A row may appear more than once; repeats are
+        applied in order.
+        """
+        rows = np.asarray(rows, dtype=np.intp)
+        samples = np.asarray(samples, dtype=np.float64).reshape(len(rows), self.fields)
+        if len(rows):
+            self.reserve(int(rows.max()) + 1)
+
+        if len(rows) <= 1 or len(np.unique(rows)) == len(rows):
+            return self._add(rows, samples, times)
+
+        #: Repeated rows: filter in waves of unique rows, preserving order
+        filtered = np.empty_like(samples)
+        pending = np.arange(len(rows))
+        while len(pending):
+            _, first = np.unique(rows[pending], return_index=True)
+            wave = pending[np.sort(first)]
+            filtered[wave] = self._add(rows[wave], samples[wave],
+                                       None if times is None else np.asarray(times)[wave])
+            pending = np.setdiff1d(pending, wave, assume_unique=True)
+        return filtered
+
+    def _add(self, rows, samples, times):
+        if times is not None:
+            times = np.asarray(times, dtype=np.float64)
+            if self.reset_after is not None:
+                stale = np.abs(times - self.stamp[rows]) >= self.reset_after
+                stale |= np.isnan(self.stamp[rows])
+                self.reset(rows[stale])
+            self.stamp[rows] = times
+
+        value = self.value[rows]
+        valid = ~np.isnan(samples)
+        zero = valid & (samples == 0.0)
+        added = valid & ~zero
+
+        #: A channel at 0.0 jumps straight to its first sample
+        value = np.where(added & (value == 0.0), samples, value)
+        value = np.where(added, samples / self.frequency + value - value / self.frequency, value)
+        value[zero] = 0.0
+
+        self.value[rows] = value
+        self.last_addition[rows] = np.where(added, samples, self.last_addition[rows])
+        self.iterations[rows] += added
+        return value
+
+    @property
+    def stable(self):
+        return self.iterations > self.stable_at
+
+    @property
+    def stable_value(self):
+        return np.where(self.stable, self.value, self.last_addition)
+
+    def snapshot(self):
+        """All filter state as a dict of arrays (see :meth:`restore`)."""
+        return {
+            'frequency': np.array(self.frequency),
+            'value': self.value.copy(),
+            'last_addition': self.last_addition.copy(),
+            'iterations': self.iterations.copy(),
+            'stamp': self.stamp.copy(),
+        }
+
+    def restore(self, snapshot):
+        if float(snapshot['frequency']) != self.frequency \
+        or snapshot['value'].shape[1] != self.fields:
+            raise ValueError("Filter snapshot does not match this bank")
+        self.value = np.array(snapshot['value'], dtype=np.float64)
+        self.last_addition = np.array(snapshot['last_addition'], dtype=np.float64)
+        self.iterations = np.array(snapshot['iterations'], dtype=np.int32)
+        self.stamp = np.array(snapshot['stamp'], dtype=np.float64)
+        #: NaN is viral; never resume from a poisoned value
+        np.nan_to_num(self.value, copy=False, nan=0.0)
+
 def lowpass(data, frequency=7):
     history = None
     sample = None
@@ -0,0 +1,67 @@
+"""
+End-to-end record latency tracing
+---------------------------------
+
+With ``daq.tracing.enabled`` one in ``sample_every`` gateway frames starts a
+trace. Every record built from a traced frame carries it under
+:data:`TRACE_KEY` as a compact list::
+
+    [rx_wall, rx_mono, parse_us, enqueue_us, flush_us]
+
+``rx_wall``/``rx_mono`` are ``time.time()``/``time.monotonic()`` at receive;
+the stage stamps are monotonic microseconds since receive, so DAQ-side
+stages are immune to wall-clock steps:
+
+- ``parse``   Message decoded by the gateway transport
+- ``enqueue`` record handed to the BSON/compression chain
+- ``flush``   batch containing the record flushed by CompressionHandler
+              (columnar format only; BSON-format records are already
+              encoded by then)
+
+Traced records travel in the columnar batch's BSON blob instead of the
+column arrays (see ``DAQ.util.batch``). Pitcher adds the wall-clock publish
+time in the :data:`PUBLISH_HEADER` NATS header, and the catcher stamps
+decode and Redis-write times on arrival.
+"""
+
+import time
+
+from DAQ.util.config import load_config
+
+TRACE_KEY = "trace"
+PUBLISH_HEADER = "Mesh-Trace-Publish"
+
+# Indexes into a trace list
+RX_WALL, RX_MONO, PARSE, ENQUEUE, FLUSH = range(5)
+
+_tracing_cfg = load_config().get("daq", {}).get("tracing") or {}
+enabled = bool(_tracing_cfg.get("enabled", False))
+sample_every = max(1, int(_tracing_cfg.get("sample_every", 1000)))
+_countdown = sample_every
+
+
+def sample():
+    """Start a trace for one in ``sample_every`` calls; None otherwise."""
+    global _countdown
+    _countdown -= 1
+    if _countdown:
+        return None
+    _countdown = sample_every
+    return [time.time(), time.monotonic(), 0, 0, 0]
+
+
+def stamp(trace, stage):
+    trace[stage] = int((time.monotonic() - trace[RX_MONO]) * 1e6)
+
+
+def stamp_records(records, stage):
+    """Stamp ``stage`` on every traced record dict in ``records``."""
+    for record in records:
+        if isinstance(record, dict):
+            trace = record.get(TRACE_KEY)
+            if trace is not None:
+                stamp(trace, stage)
+
+
+def publish_headers():
+    return {PUBLISH_HEADER: repr(time.time())}
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""
+bench_codecs.py - Uplink compression codec comparison
+-----------------------------------------------------
+
+Builds uplink batches the way CompressionHandler does and reports, for each
+registered codec, the compression ratio and compress/decompress MB/s.
+
+Telemetry comes from a recorded gateway stream (the raw bytes a gateway
+sends to comm_port, e.g. captured with ``nc -l 59990 > capture.mi``) or,
+without ``--capture``, from the emulator's SolarPanelSimulator.
+
+    cd mesh && python benchmarks/bench_codecs.py --capture capture.mi --batch 500
+"""
+
+import argparse
+import os
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from bson import BSON
+
+from DAQ.commands.protocol import Message, DataIndication
+from DAQ.mesh.simulator import SolarPanelSimulator
+from DAQ.util import compression
+from DAQ.util.batch import encode_batch
+
+
+def records_from_capture(path):
+    """Decode MI frames from a raw gateway byte stream into 'mon' records."""
+    with open(path, "rb") as f:
+        stream = f.read()
+
+    sunrise = datetime.now(timezone.utc).replace(hour=6, minute=0, second=0, microsecond=0)
+    i = 0
+    while i + 3 <= len(stream):
+        if stream[i:i + 2] != b"MI":
+            i = stream.find(b"MI", i + 1)
+            if i < 0:
+                break
+            continue
+        length = stream[i + 2]
+        msg = Message.decode(stream[i + 3:i + 3 + length])
+        i += 3 + length
+        for cmd in msg.commands:
+            if not isinstance(cmd, DataIndication):
+                continue
+            response = cmd.response()
+            for data in response["data"]:
+                yield dict(
+                    type="mon", macaddr=response["macaddr"],
+                    freezetime=sunrise + timedelta(seconds=data["timestamp"]),
+                    localtime=datetime.now(timezone.utc),
+                    reg_stat=response["reg_stat"], op_stat=response["op_stat"],
+                    **{k: data[k] for k in DataIndication.FIELDS},
+                )
+
+
+def records_from_simulator(panels, samples):
+    simulators = [SolarPanelSimulator(seed=i) for i in range(panels)]
+    start = datetime.now(timezone.utc)
+    for n in range(samples):
+        for i, sim in enumerate(simulators):
+            s = sim.sample()
+            ts = start + timedelta(seconds=5 * n)
+            yield dict(
+                type="mon", macaddr=f"0000FA29EB6D{i:04X}",
+                freezetime=ts, localtime=ts + timedelta(microseconds=137 * i),
+                reg_stat=0, op_stat=0,
+                Vi=round(s.voltage, 2), Vo=round(s.voltage, 2),
+                Ii=round(s.current, 2), Io=round(s.current, 2),
+                Pi=round(s.power, 2), Po=round(s.power, 2),
+                temperature=round(s.temperature, 2), irradiance=round(s.irradiance, 1),
+            )
+
+
+def make_batches(records, batch_size, fmt):
+    batches, cache = [], []
+    for record in records:
+        cache.append(record)
+        if len(cache) >= batch_size:
+            batches.append(cache)
+            cache = []
+    if cache:
+        batches.append(cache)
+
+    if fmt == "columnar":
+        return [encode_batch(batch) for batch in batches]
+    return [BSON.encode({"cache": [BSON.encode(r) for r in batch]}) for batch in batches]
+
+
+def bench(codec, batches, repeat):
+    raw_bytes = sum(len(b) for b in batches)
+
+    started = time.perf_counter()
+    for _ in range(repeat):
+        packed = [compression.compress(b, codec) for b in batches]
+    compress_s = (time.perf_counter() - started) / repeat
+
+    started = time.perf_counter()
+    for _ in range(repeat):
+        for blob in packed:
+            compression.decompress(blob)
+    decompress_s = (time.perf_counter() - started) / repeat
+
+    wire_bytes = sum(len(p) for p in packed)
+    return raw_bytes, wire_bytes, raw_bytes / 1e6 / compress_s, raw_bytes / 1e6 / decompress_s
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--capture", help="raw MI byte stream recorded from a gateway")
+    parser.add_argument("--panels", type=int, default=64, help="simulated panels (no --capture)")
+    parser.add_argument("--samples", type=int, default=200, help="simulated samples per panel")
+    parser.add_argument("--batch", type=int, default=500, help="records per batch (daq.compression.batch_on)")
+    parser.add_argument("--format", choices=("columnar", "bson"), default="columnar")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--codecs", nargs="*", help="codec names (default: all registered)")
+    args = parser.parse_args()
+
+    if args.capture:
+        records = list(records_from_capture(args.capture))
+    else:
+        records = list(records_from_simulator(args.panels, args.samples))
+    batches = make_batches(records, args.batch, args.format)
+
+    print(f"{len(records)} records in {len(batches)} {args.format} batches of <= {args.batch}")
+    print(f"{'codec':>10} {'raw':>10} {'wire':>10} {'ratio':>7} {'comp MB/s':>10} {'decomp MB/s':>12}")
+    for name in args.codecs or sorted(compression.CODECS):
+        if name == "none" and not args.codecs:
+            continue
+        raw, wire, comp_mbs, decomp_mbs = bench(compression.get_codec(name), batches, args.repeat)
+        print(f"{name:>10} {raw:>10,} {wire:>10,} {raw / wire:>7.2f} {comp_mbs:>10.1f} {decomp_mbs:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
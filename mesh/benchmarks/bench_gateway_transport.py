@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""
+bench_gateway_transport.py - Gateway TCP ingest throughput
+----------------------------------------------------------
+
+Streams pre-built MI frames over loopback into the gateway TCP server and
+measures frames/s until every frame has been decoded onto recv_queue.
+Runs once per transport ("stream" = StreamReader/readexactly, "buffered" =
+GatewayProtocol) so the two can be compared on the same machine.
+
+    cd mesh && python benchmarks/bench_gateway_transport.py --frames 200000
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from DAQ.commands.protocol import Message, DataIndication
+from DAQ.gateway.server import logger as gateway_logger, start_tcp_server
+
+
+def build_frame(samples: int) -> bytes:
+    msg = Message()
+    msg.set_addr("fa29eb6d8701")
+    msg.dtype = Message.TYPE_PLM
+    cmd = DataIndication()
+    for i in range(samples):
+        cmd.add_data(i, 30.5, 30.2, 8.1, 8.0, 250.3, 249.9, temperature=41.2, irradiance=875.5)
+    msg.add_command(cmd)
+    payload = msg.decompile()
+    return b"MI" + bytes([len(payload)]) + payload
+
+
+async def run_once(transport: str, frame: bytes, frames: int, chunk: int) -> float:
+    recv_queue: asyncio.Queue = asyncio.Queue()
+    server = await start_tcp_server(recv_queue, host="127.0.0.1", port=0, transport=transport)
+    port = server.sockets[0].getsockname()[1]
+
+    per_write = max(1, chunk // len(frame))
+    block = frame * per_write
+
+    _, writer = await asyncio.open_connection("127.0.0.1", port)
+    started = time.perf_counter()
+    sent = 0
+    while sent < frames:
+        n = min(per_write, frames - sent)
+        writer.write(block if n == per_write else frame * n)
+        sent += n
+        await writer.drain()
+
+    received = 0
+    while received < frames:
+        await recv_queue.get()
+        received += 1
+    elapsed = time.perf_counter() - started
+
+    writer.close()
+    await writer.wait_closed()
+    server.close()
+    await server.wait_closed()
+    return elapsed
+
+
+async def main(args):
+    frame = build_frame(args.samples)
+    print(f"frame={len(frame)} bytes, frames={args.frames}, write chunk={args.chunk} bytes")
+    for transport in ("stream", "buffered"):
+        elapsed = await run_once(transport, frame, args.frames, args.chunk)
+        rate = args.frames / elapsed
+        mbps = rate * len(frame) / 1e6
+        print(f"{transport:>9}: {elapsed:7.3f}s  {rate:12,.0f} frames/s  {mbps:7.2f} MB/s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--frames", type=int, default=100_000)
+    parser.add_argument("--samples", type=int, default=1, help="DataIndication samples per frame")
+    parser.add_argument("--chunk", type=int, default=16384, help="bytes per client write")
+    gateway_logger.setLevel(logging.WARNING)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""
+bench_rollup.py - Rollup folding and timeslot expiry
+----------------------------------------------------
+
+Drives a monitor PeriodManager through ``--seconds`` of simulated time at
+1-second sample granularity across ``--series`` devices and reports the CPU
+time per record to fold batches into every interval and the time spent in
+process_expirations.
+
+It also checks that the per-period expiry indexes stay bounded by the open
+timeslots; a run where they grow with the number of slots ever opened
+exits with an error.
+
+    cd mesh && python benchmarks/bench_rollup.py --series 2000 --seconds 900 --intervals 1 60 300
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from DAQ.util.handlers.rollup import PeriodManager
+
+T0 = 1_700_000_000
+
+
+def records_at(second, series):
+    return [{'type': 'mon', 'macaddr': '%016X' % mac, 'graph_key': 'g', 'freezetime': T0 + second,
+             'Vi': 30.0 + mac % 7, 'Vo': 29.5, 'Ii': 8.0, 'Io': 8.1, 'op_stat': 0, 'reg_stat': 0}
+            for mac in range(series)]
+
+
+def index_sizes(manager):
+    return {interval: (len(period.timeslots), len(period._deadlines), len(period._stale))
+            for interval, period in manager.periods.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--series", type=int, default=1000, help="devices reporting every second")
+    parser.add_argument("--seconds", type=int, default=600, help="simulated seconds")
+    parser.add_argument("--intervals", type=int, nargs="+", default=[1, 60, 300], help="rollup intervals (s)")
+    parser.add_argument("--grace", type=float, default=2.0)
+    args = parser.parse_args()
+
+    manager = PeriodManager('mon', grace=args.grace)
+    for interval in args.intervals:
+        manager.add_interval(interval)
+
+    fold_s = expire_s = 0.0
+    emitted = worst = 0
+    for second in range(args.seconds):
+        batch = records_at(second, args.series)
+        started = time.process_time()
+        manager.extend(batch)
+        fold_s += time.process_time() - started
+
+        started = time.process_time()
+        emitted += len(manager.process_expirations(T0 + second))
+        expire_s += time.process_time() - started
+
+        for open_slots, deadlines, stale in index_sizes(manager).values():
+            worst = max(worst, deadlines - open_slots, stale - open_slots)
+
+    records = args.series * args.seconds
+    print(f"{records} records, {emitted} aggregates, intervals {args.intervals}")
+    print(f"fold   {fold_s / records * 1e6:8.2f} us/record")
+    print(f"expire {expire_s / args.seconds * 1e3:8.2f} ms/second of data")
+    print(f"index (open slots, deadlines, stale) per interval: {index_sizes(manager)}")
+
+    # Closed slots may linger in the heaps only until the next prune/rebuild
+    if worst > 2 * max(len(args.intervals), 8) + 16:
+        sys.exit(f"expiry index grew to {worst} entries beyond the open timeslots")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""
+bench_timeseries.py - Time-series batch format against bz2
+----------------------------------------------------------
+
+Runs uplink batches through whole sender/receiver pipelines (batch format
+plus compression codec) and reports bytes on the wire per record and the
+CPU time to encode+compress and to decompress+decode each batch.
+
+Telemetry is read the same way as bench_codecs.py: a recorded gateway byte
+stream (``--capture``) or the emulator's SolarPanelSimulator. The gain of
+the time-series format grows with the number of samples per device in a
+batch, so try several ``--batch`` sizes.
+
+    cd mesh && python benchmarks/bench_timeseries.py --capture capture.mi --batch 500 5000
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bson import BSON
+
+from bench_codecs import records_from_capture, records_from_simulator
+from DAQ.util import batch, compression, timeseries
+
+PIPELINES = ("bson/bz2", "columnar/bz2", "timeseries/none", "timeseries/bz2", "timeseries/zlib-6")
+
+
+def encode_bson(records):
+    return BSON.encode({"cache": [BSON.encode(r) for r in records]})
+
+
+def decode_bson(raw):
+    return [BSON(item).decode() for item in BSON(raw).decode()["cache"]]
+
+
+FORMATS = {
+    "bson": (encode_bson, decode_bson),
+    "columnar": (batch.encode_batch, batch.decode_batch),
+    "timeseries": (timeseries.encode_batch, timeseries.decode_batch),
+}
+
+
+def split(records, batch_size):
+    return [records[i:i + batch_size] for i in range(0, len(records), batch_size)]
+
+
+def bench(pipeline, batches, repeat):
+    fmt, codec_name = pipeline.split("/")
+    encode, decode = FORMATS[fmt]
+    codec = compression.get_codec(codec_name)
+
+    started = time.process_time()
+    for _ in range(repeat):
+        packed = [compression.compress(encode(records), codec) for records in batches]
+    encode_s = (time.process_time() - started) / repeat
+
+    started = time.process_time()
+    for _ in range(repeat):
+        for blob in packed:
+            decode(compression.decompress(blob))
+    decode_s = (time.process_time() - started) / repeat
+
+    return sum(len(p) for p in packed), encode_s, decode_s
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--capture", help="raw MI byte stream recorded from a gateway")
+    parser.add_argument("--panels", type=int, default=64, help="simulated panels (no --capture)")
+    parser.add_argument("--samples", type=int, default=200, help="simulated samples per panel")
+    parser.add_argument("--batch", type=int, nargs="+", default=[64, 500, 5000], help="records per batch")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--pipelines", nargs="*", default=PIPELINES, help="format/codec pairs")
+    args = parser.parse_args()
+
+    if args.capture:
+        records = list(records_from_capture(args.capture))
+    else:
+        records = list(records_from_simulator(args.panels, args.samples))
+
+    print(f"{len(records)} records")
+    print(f"{'batch':>6} {'pipeline':>18} {'wire':>10} {'B/rec':>7} {'enc us/rec':>11} {'dec us/rec':>11}")
+    for batch_size in args.batch:
+        batches = split(records, batch_size)
+        for pipeline in args.pipelines:
+            wire, encode_s, decode_s = bench(pipeline, batches, args.repeat)
+            print(f"{batch_size:>6} {pipeline:>18} {wire:>10,} {wire / len(records):>7.1f} "
+                  f"{encode_s / len(records) * 1e6:>11.2f} {decode_s / len(records) * 1e6:>11.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -6,20 +6,36 @@ rundaq.py - Launches the DAQ system
 - Ensures singleton execution via lock file
 - Launches DAQProcess under asyncio
 - Handles graceful shutdown on SIGINT/SIGTERM
+- With daq.workers > 1, runs a coordinator that supervises N worker
+  processes sharing comm_port via SO_REUSEPORT
+- Serves per-stage Prometheus metrics on a local admin port
+  (daq.admin.port, plus the worker index in multi-worker mode), and the
+  worker's local device history at ``GET /history``
 """
 
 import asyncio
 import logging
+import multiprocessing
 import os
 import atexit
 import signal
 import sys
 import fcntl
+import time
 
 from DAQ.util.logger import make_logger
+from DAQ.util.config import load_config
+from DAQ.util.history import http_query
+from DAQ.util.metrics import start_admin_server
 from DAQ.lib.process import DAQProcess
 
 logger = make_logger("rundaq")
+cfg = load_config()
+
+workers = int(cfg.get("daq", {}).get("workers", 1) or 1)
+heartbeat_interval = cfg.get("daq", {}).get("worker_heartbeat_interval", 1.0)
+heartbeat_timeout = cfg.get("daq", {}).get("worker_heartbeat_timeout", 15.0)
+admin_cfg = cfg.get("daq", {}).get("admin") or {}
 
 # Global references
 lockfile = None
@@ -60,33 +76,68 @@ def release_lock():
 # Async DAQ Lifecycle
 # ---------------------
 
-async def run_daq():
+async def run_daq(worker_index: int = 0, worker_count: int = 1):
     """Create and run the DAQ process until cancelled."""
     global daq
     logger.info(
         f"[rundaq] Running with PID={os.getpid()} UID={os.getuid()} CWD={os.getcwd()}"
+        f" worker={worker_index + 1}/{worker_count}"
     )
-    daq = DAQProcess()
+    daq = DAQProcess(worker_index=worker_index, workers=worker_count)
     await daq.run()
 
 
+async def heartbeat(heartbeats, worker_index: int, daq_task: asyncio.Task):
+    """
+    Publish liveness to the coordinator while the event loop is responsive
+    and the DAQ task is still running.
+    """
+    while not daq_task.done():
+        heartbeats[worker_index] = time.monotonic()
+        await asyncio.sleep(heartbeat_interval)
+
+
 def handle_signal(sig: str):
     """Signal handler for clean shutdown."""
     logger.warning(f"[rundaq] Caught signal {sig}. Shutting down...")
     shutdown_event.set()
 
 
-async def main_async():
+async def main_async(worker_index: int = 0, worker_count: int = 1, heartbeats=None) -> int:
+    """Run one DAQ worker; returns the process exit status (non-zero if the DAQ task died)."""
     # Trap shutdown signals
     loop = asyncio.get_running_loop()
     for sig in (signal.SIGTERM, signal.SIGINT):
         loop.add_signal_handler(sig, lambda s=sig: handle_signal(s.name))
 
     # Start DAQ as a background task
-    daq_task = asyncio.create_task(run_daq(), name="DAQProcessTask")
+    daq_task = asyncio.create_task(run_daq(worker_index, worker_count), name="DAQProcessTask")
+    heartbeat_task = None
+    if heartbeats is not None:
+        heartbeat_task = asyncio.create_task(heartbeat(heartbeats, worker_index, daq_task), name="HeartbeatTask")
 
-    # Wait until shutdown triggered
-    await shutdown_event.wait()
+    admin_server = None
+    if admin_cfg.get("enabled", True):
+        try:
+            admin_server = await start_admin_server(
+                admin_cfg.get("host", "127.0.0.1"),
+                admin_cfg.get("port", 9108) + worker_index,
+                labels={"worker": worker_index},
+                routes={"/history": lambda params: http_query(daq and daq.history, params)},
+            )
+        except OSError as e:
+            logger.error(f"[rundaq] Admin metrics endpoint unavailable: {e}")
+
+    # Wait until shutdown is triggered or the DAQ task ends on its own; the
+    # latter is a failure, so exit and let the coordinator (or the service
+    # manager) restart the worker
+    shutdown_task = asyncio.create_task(shutdown_event.wait(), name="ShutdownWait")
+    await asyncio.wait({daq_task, shutdown_task}, return_when=asyncio.FIRST_COMPLETED)
+    shutdown_task.cancel()
+    failed = daq_task.done() and not shutdown_event.is_set()
+    if failed:
+        error = None if daq_task.cancelled() else daq_task.exception()
+        logger.error(f"[rundaq] DAQProcess exited unexpectedly: {error!r}", exc_info=error)
 
     # Attempt clean shutdown
     if daq and hasattr(daq, "stop"):
@@ -97,11 +148,120 @@ async def main_async():
             logger.error(f"[rundaq] Error stopping DAQProcess: {e}")
 
     # Cancel main DAQ loop
+    if heartbeat_task:
+        heartbeat_task.cancel()
+    if admin_server:
+        admin_server.close()
     daq_task.cancel()
     try:
         await daq_task
     except asyncio.CancelledError:
         logger.info("[rundaq] DAQ task cancelled.")
+    except Exception:
+        pass  # already reported above
+    return 1 if failed else 0
+
+
+# ---------------------
+# Multi-worker mode
+# ---------------------
+
+def run_worker(worker_index: int, worker_count: int, heartbeats):
+    """Worker process entrypoint: one full gateway → NATS pipeline."""
+    try:
+        status = asyncio.run(main_async(worker_index, worker_count, heartbeats))
+    except KeyboardInterrupt:
+        status = 0
+    # A non-zero exit code makes the coordinator restart this worker
+    sys.exit(status)
+
+
+class Coordinator:
+    """
+    Owns the singleton lock and supervises N DAQ workers.
+
+    Workers are forked after config has been loaded, so they all share the
+    coordinator's view of config.yaml. Each worker stamps a slot in a shared
+    heartbeat array; a worker that exits or stops stamping for
+    ``heartbeat_timeout`` seconds is restarted.
+    """
+
+    def __init__(self, worker_count: int):
+        self.worker_count = worker_count
+        self.ctx = multiprocessing.get_context("fork")
+        self.heartbeats = self.ctx.Array("d", worker_count, lock=False)
+        self.procs: list = [None] * worker_count
+        self.restarts = [0] * worker_count
+        self.stopping = False
+
+    def spawn(self, index: int):
+        self.heartbeats[index] = time.monotonic()
+        proc = self.ctx.Process(
+            target=run_worker,
+            args=(index, self.worker_count, self.heartbeats),
+            name=f"daq-worker-{index}",
+        )
+        proc.start()
+        self.procs[index] = proc
+        logger.info(f"[rundaq] Started worker {index} (PID={proc.pid})")
+
+    def check(self):
+        now = time.monotonic()
+        for index, proc in enumerate(self.procs):
+            stale = now - self.heartbeats[index] > heartbeat_timeout
+            if proc.is_alive() and not stale:
+                continue
+            if proc.is_alive():
+                logger.error(f"[rundaq] Worker {index} (PID={proc.pid}) missed heartbeats; restarting")
+                proc.kill()
+            else:
+                logger.error(f"[rundaq] Worker {index} (PID={proc.pid}) exited with {proc.exitcode}; restarting")
+            proc.join(timeout=5)
+            self.restarts[index] += 1
+            self.spawn(index)
+
+    def health(self) -> dict:
+        now = time.monotonic()
+        return {
+            index: {
+                "pid": proc.pid,
+                "alive": proc.is_alive(),
+                "heartbeat_age": round(now - self.heartbeats[index], 3),
+                "restarts": self.restarts[index],
+            }
+            for index, proc in enumerate(self.procs)
+        }
+
+    def stop(self, *_):
+        self.stopping = True
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        for index in range(self.worker_count):
+            self.spawn(index)
+
+        last_report = time.monotonic()
+        while not self.stopping:
+            time.sleep(heartbeat_interval)
+            if self.stopping:
+                break
+            self.check()
+            if time.monotonic() - last_report >= 60:
+                logger.info(f"[rundaq] Worker health: {self.health()}")
+                last_report = time.monotonic()
+
+        logger.warning("[rundaq] Coordinator shutting down workers...")
+        for proc in self.procs:
+            if proc.is_alive():
+                proc.terminate()
+        for proc in self.procs:
+            proc.join(timeout=10)
+            if proc.is_alive():
+                logger.error(f"[rundaq] Worker PID={proc.pid} did not exit; killing")
+                proc.kill()
+                proc.join()
 
 
 # ---------------------
@@ -121,12 +281,18 @@ def main():
     acquire_lock()
     atexit.register(release_lock)
 
+    status = 0
     try:
-        asyncio.run(main_async())
+        if workers > 1:
+            logger.info(f"[rundaq] Starting coordinator with {workers} workers")
+            Coordinator(workers).run()
+        else:
+            status = asyncio.run(main_async())
     except KeyboardInterrupt:
         logger.info("[rundaq] KeyboardInterrupt caught. Exiting.")
     finally:
         release_lock()
+    sys.exit(status)
 
 
 if __name__ == "__main__":